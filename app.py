@@ -1,13 +1,131 @@
-from fastapi import FastAPI
+from services.startup import StartupMiddleware, profile
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from config import settings
+from services import clients, resilience, telemetry
+from services.ai import GEMINI_MODEL_NAME
+from services.colors import color_namer
+from services.ingest import load_duplicates
 from routes import images
 from routes import symantic
+import asyncio
+import json
+import math
 
-app = FastAPI()
+
+async def warm_up():
+    """
+    Create the clients and services ahead of the first request. Each step is logged when it fails and
+    the others still run, whatever is missing is created on first use.
+    """
+    with profile.phase("warm_up"):
+        profile.add("clients", await asyncio.to_thread(
+            clients.warm_up, settings.project_id, settings.region, GEMINI_MODEL_NAME,
+        ))
+        profile.add("symantic", await asyncio.to_thread(symantic.deps.build))
+        profile.add("images", await asyncio.to_thread(images.deps.build))
+        if settings.color_naming == "local":
+            try:
+                with profile.phase("color_namer"):
+                    await asyncio.to_thread(color_namer)
+            except Exception as e:
+                print(f"An error occurred while warming up color_namer: {e}")
+
+
+async def start():
+    if settings.warm_up != "off":
+        await warm_up()
+    # Started whatever the warm-up did and each on its own, without them queued jobs are never
+    # processed and the document caches of other instances are never invalidated.
+    if settings.ingest_workers:
+        try:
+            images.deps.worker.start()
+        except Exception as e:
+            print(f"An error occurred while starting the ingest workers: {e}")
+    if settings.doc_cache_listen:
+        try:
+            images.deps.db.listen()
+        except Exception as e:
+            print(f"An error occurred while listening for document changes: {e}")
+    if settings.dedupe_reuse:
+        try:
+            indexed = await asyncio.to_thread(load_duplicates, images.deps.db, images.deps.duplicates)
+            print(f"Indexed the hashes of {indexed} images")
+        except Exception as e:
+            print(f"An error occurred while indexing the image hashes: {e}")
+    profile.event("started")
+    print(f"Startup: {json.dumps(profile.report())}")
+
+
+async def start_in_background():
+    try:
+        await start()
+    except Exception as e:
+        print(f"An error occurred while starting up: {e}")
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    starting = None
+    if settings.warm_up == "blocking":
+        await start()
+    else:
+        # Requests are served while the clients are created, the first ones wait for the services they use.
+        starting = asyncio.create_task(start_in_background())
+    profile.event("ready")
+    yield
+    if starting is not None and not starting.done():
+        starting.cancel()
+        with suppress(asyncio.CancelledError):
+            await starting
+    # Only the services that have been built need to be shut down.
+    if (db := images.deps.peek("db")) is not None:
+        db.close()
+    if (worker := images.deps.peek("worker")) is not None:
+        await worker.stop()
+    if (variants := images.deps.peek("variants")) is not None:
+        variants.shutdown()
+    if (executor := symantic.deps.peek("executor")) is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+telemetry.configure(settings.telemetry_enabled)
+
+app = FastAPI(lifespan=lifespan)
+if settings.telemetry_enabled:
+    app.add_middleware(telemetry.TelemetryMiddleware, slow_request_seconds=settings.trace_slow_request_seconds)
+app.add_middleware(StartupMiddleware)
 
 app.include_router(images.router, prefix="/images")
 app.include_router(symantic.router, prefix="/symantic")
 
 
+@app.exception_handler(resilience.CircuitOpenError)
+async def upstream_unavailable(_: Request, e: resilience.CircuitOpenError):
+    return JSONResponse(status_code=503, content={"detail": str(e)}, headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+
+@app.exception_handler(resilience.UpstreamTimeoutError)
+async def upstream_timeout(_: Request, e: resilience.UpstreamTimeoutError):
+    return JSONResponse(status_code=504, content={"detail": str(e)})
+
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
+
+
+@app.get("/startup", include_in_schema=False)
+async def startup_profile():
+    return profile.report()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    if not telemetry.enabled():
+        raise HTTPException(status_code=404, detail="Telemetry is disabled")
+    return PlainTextResponse(telemetry.registry.render(), media_type=telemetry.CONTENT_TYPE)
+
+
+profile.mark("import")
@@ -0,0 +1,651 @@
+"""
+In-process stand-ins for the GCP services, with injected latency and errors.
+
+The fakes replace the SDK handles in `services.clients.registry` rather than the services, so
+AIService, DBService, VectorSearchService and the GCS helpers run their own code against them.
+Each upstream sleeps for a log-normal latency around its median, blocking its thread like the
+SDKs do, and fails with the configured probability.
+"""
+from google.api_core import exceptions
+from google.cloud import firestore, vision
+from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
+from google.cloud.firestore_v1.vector import Vector
+from services import clients
+from types import SimpleNamespace
+import base64
+import bisect
+import datetime
+import hashlib
+import io
+import json
+import math
+import random
+import threading
+import time
+import numpy as np
+
+# Median latency in milliseconds per upstream, roughly what the services answer from a GCP region.
+DEFAULT_LATENCY_MS = {
+    "firestore": 15,
+    "gcs": 40,
+    "vision": 250,
+    "gemini": 1200,
+    "embedding": 150,
+    "images_api": 30,
+}
+
+LABELS = ["dog", "cat", "beach", "mountain", "car", "bicycle", "tree", "flower", "building", "person", "food", "sky"]
+LIKELIHOODS = ["VERY_UNLIKELY", "UNLIKELY", "POSSIBLE", "LIKELY"]
+
+
+class Upstream:
+    """
+    Latency and error injection for one upstream. `spread` is the sigma of the log-normal,
+    0.5 puts the p99 at about three times the median.
+    """
+
+    def __init__(self, name: str, median_ms: float, error_rate: float = 0.0, spread: float = 0.5, seed: int = 0):
+        self.name = name
+        self.median_ms = median_ms
+        self.error_rate = error_rate
+        self.spread = spread
+        self.calls = 0
+        self.errors = 0
+        self._rng = random.Random(f"{seed}:{name}")
+        self._lock = threading.Lock()
+
+    def call(self, timeout: float = None):
+        with self._lock:
+            self.calls += 1
+            delay = self.median_ms * math.exp(self._rng.gauss(0, self.spread)) / 1000 if self.median_ms > 0 else 0
+            failed = bool(self.error_rate) and self._rng.random() < self.error_rate
+            self.errors += failed
+        if timeout and delay > timeout:
+            # Like a gRPC deadline, the caller gives up at the timeout.
+            time.sleep(timeout)
+            raise exceptions.DeadlineExceeded(f"{self.name} did not answer within {timeout}s")
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise exceptions.ServiceUnavailable(f"Injected {self.name} error")
+
+
+def _digest(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+def random_vector(key: str, dimension: int) -> list[float]:
+    vector = np.random.default_rng(_digest(key)).normal(size=dimension)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+# Firestore
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _store(value):
+    # Vectors are kept as float32 arrays so a seeded collection stays small, reads turn them back into Vectors.
+    if isinstance(value, Vector):
+        return np.asarray(list(value), dtype=np.float32)
+    if isinstance(value, dict):
+        return {key: _store(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_store(item) for item in value]
+    return value
+
+
+def _load(value):
+    if isinstance(value, np.ndarray):
+        return Vector(value.tolist())
+    if isinstance(value, dict):
+        return {key: _load(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_load(item) for item in value]
+    return value
+
+
+def _merge(target: dict, data: dict):
+    for key, value in data.items():
+        if value is firestore.DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = _store(value)
+
+
+def _get_path(data: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+
+def _project(data: dict, paths) -> dict:
+    if paths is None:
+        return _load(data)
+    result = {}
+    for path in paths:
+        value = _get_path(data, path)
+        if value is None:
+            continue
+        target = result
+        *parents, leaf = path.split(".")
+        for part in parents:
+            target = target.setdefault(part, {})
+        target[leaf] = _load(value)
+    return result
+
+
+class FakeSnapshot:
+    def __init__(self, reference: "FakeDocumentReference", data: dict = None, paths=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = _project(data, paths) if data is not None else None
+
+    def to_dict(self):
+        return _copy(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, collection: "FakeCollection", document_id: str):
+        self._collection = collection
+        self.id = document_id
+
+    def get(self, field_paths=None, retry=None, timeout=None) -> FakeSnapshot:
+        self._collection.upstream.call(timeout)
+        return FakeSnapshot(self, self._collection.documents.get(self.id), field_paths)
+
+    def set(self, document_data: dict, merge: bool = False, retry=None, timeout=None):
+        self._collection.upstream.call(timeout)
+        self._collection.write(self.id, document_data, merge)
+
+    def delete(self, retry=None, timeout=None):
+        self._collection.upstream.call(timeout)
+        self._collection.delete(self.id)
+
+
+class FakeQuery:
+    def __init__(self, collection: "FakeCollection", filters=(), fields=None, limit=None, after=None, orders=()):
+        self._collection = collection
+        self._filters = filters
+        self._fields = fields
+        self._limit = limit
+        self._after = after
+        self._orders = orders
+
+    def _with(self, **changes) -> "FakeQuery":
+        values = {"filters": self._filters, "fields": self._fields, "limit": self._limit, "after": self._after,
+                  "orders": self._orders}
+        values.update(changes)
+        return FakeQuery(self._collection, **values)
+
+    def where(self, filter):
+        return self._with(filters=self._filters + (filter,))
+
+    def select(self, field_paths):
+        return self._with(fields=list(field_paths))
+
+    def limit(self, count: int):
+        return self._with(limit=count)
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING"):
+        return self._with(orders=self._orders + ((field_path, direction),))
+
+    def start_after(self, cursor):
+        # A snapshot in ID order, or the values of the order_by fields, __name__ as an ID or a reference.
+        if isinstance(cursor, FakeSnapshot):
+            return self._with(after=cursor.id)
+        return self._with(after={path: value.id if isinstance(value, FakeDocumentReference) else value
+                                 for path, value in cursor.items()})
+
+    def count(self, alias: str = None):
+        return FakeAggregationQuery(self, alias)
+
+    def _matches(self, data: dict) -> bool:
+        for condition in self._filters:
+            value = _get_path(data, condition.field_path)
+            if condition.op_string == "==" and value != condition.value:
+                return False
+            if condition.op_string == ">=" and (value is None or value < condition.value):
+                return False
+            if condition.op_string == "<" and (value is None or value >= condition.value):
+                return False
+            if condition.op_string == "array_contains" and condition.value not in (value or []):
+                return False
+        return True
+
+    def _ids(self) -> list[str]:
+        # Documents in ID order, as Firestore returns them without an order_by or ordered by __name__.
+        ids = self._collection.ids
+        after = self._after["__name__"] if isinstance(self._after, dict) else self._after
+        start = bisect.bisect_right(ids, after) if after else 0
+        return ids[start:]
+
+    def _ordered(self) -> list[str]:
+        documents = self._collection.documents
+
+        def key(document_id: str) -> tuple:
+            return tuple(document_id if path == "__name__" else _get_path(documents[document_id], path) for path, _ in self._orders)
+
+        ids = [document_id for document_id in self._collection.ids if self._matches(documents[document_id])]
+        # Every order of a listing has the same direction.
+        descending = self._orders[0][1] == "DESCENDING"
+        ids.sort(key=key, reverse=descending)
+        if self._after is not None:
+            after = tuple(self._after[path] for path, _ in self._orders)
+            ids = [document_id for document_id in ids if (key(document_id) < after if descending else key(document_id) > after)]
+        return ids
+
+    def stream(self, retry=None, timeout=None):
+        self._collection.upstream.call(timeout)
+        documents = self._collection.documents
+        count = 0
+        by_id = self._orders in ((), (("__name__", "ASCENDING"),))
+        for document_id in self._ids() if by_id else self._ordered():
+            if self._limit is not None and count >= self._limit:
+                return
+            data = documents.get(document_id)
+            if data is None or not self._matches(data):
+                continue
+            count += 1
+            yield FakeSnapshot(FakeDocumentReference(self._collection, document_id), data, self._fields)
+
+    def find_nearest(self, vector_field: str, query_vector: Vector, distance_measure: DistanceMeasure, limit: int,
+                     distance_result_field: str = None):
+        return FakeVectorQuery(self, vector_field, query_vector, distance_measure, limit, distance_result_field)
+
+    def on_snapshot(self, callback):
+        return SimpleNamespace(unsubscribe=lambda: None)
+
+
+class FakeAggregationQuery:
+    def __init__(self, query: FakeQuery, alias: str):
+        self._query = query
+        self._alias = alias
+
+    def get(self, transaction=None, retry=None, timeout=None):
+        query = self._query
+        query._collection.upstream.call(timeout)
+        count = sum(1 for data in query._collection.documents.values() if query._matches(data))
+        return [[SimpleNamespace(alias=self._alias, value=count)]]
+
+
+class FakeVectorQuery:
+    def __init__(self, query: FakeQuery, field: str, vector: Vector, measure: DistanceMeasure, limit: int, result_field: str):
+        self._query = query
+        self._field = field
+        self._vector = np.asarray(list(vector), dtype=np.float32)
+        self._measure = measure
+        self._limit = limit
+        self._result_field = result_field
+
+    def stream(self, retry=None, timeout=None):
+        query = self._query
+        collection = query._collection
+        collection.upstream.call(timeout)
+        ids, matrix = collection.vectors(self._field)
+        if query._filters:
+            keep = [i for i, document_id in enumerate(ids) if query._matches(collection.documents.get(document_id, {}))]
+            ids, matrix = [ids[i] for i in keep], matrix[keep]
+        if not ids:
+            return
+
+        if self._measure == DistanceMeasure.DOT_PRODUCT:
+            distances = -(matrix @ self._vector)
+        elif self._measure == DistanceMeasure.COSINE:
+            norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(self._vector) or 1)
+            distances = 1 - (matrix @ self._vector) / np.where(norms == 0, 1, norms)
+        else:
+            distances = np.linalg.norm(matrix - self._vector, axis=1)
+        order = np.argsort(distances)[:self._limit]
+
+        fields = [field for field in query._fields or [] if field != self._result_field] or None
+        for i in order:
+            data = collection.documents.get(ids[i])
+            if data is None:
+                continue
+            snapshot = FakeSnapshot(FakeDocumentReference(collection, ids[i]), data, fields)
+            if self._result_field:
+                distance = float(distances[i])
+                snapshot._data[self._result_field] = -distance if self._measure == DistanceMeasure.DOT_PRODUCT else distance
+            yield snapshot
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, name: str, upstream: Upstream):
+        super().__init__(self)
+        self.name = name
+        self.upstream = upstream
+        self.documents: dict[str, dict] = {}
+        self.ids: list[str] = []
+        self._lock = threading.Lock()
+        self._version = 0
+        self._matrices: dict[str, tuple[int, list[str], np.ndarray]] = {}
+
+    def document(self, document_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, document_id)
+
+    def write(self, document_id: str, data: dict, merge: bool = True):
+        with self._lock:
+            current = self.documents.get(document_id)
+            if current is None:
+                bisect.insort(self.ids, document_id)
+            if current is None or not merge:
+                current = {}
+            else:
+                current = _copy(current)
+            _merge(current, data)
+            self.documents[document_id] = current
+            self._version += 1
+
+    def delete(self, document_id: str):
+        with self._lock:
+            if self.documents.pop(document_id, None) is not None:
+                self.ids.remove(document_id)
+                self._version += 1
+
+    def vectors(self, field: str) -> tuple[list[str], np.ndarray]:
+        # The (ids, matrix) of the documents holding `field`, rebuilt after writes.
+        version, ids, matrix = self._matrices.get(field, (None, None, None))
+        if version != self._version:
+            with self._lock:
+                version = self._version
+                rows = [(document_id, data[field]) for document_id, data in self.documents.items()
+                        if isinstance(data.get(field), np.ndarray)]
+            ids = [document_id for document_id, _ in rows]
+            matrix = np.stack([vector for _, vector in rows]) if rows else np.zeros((0, 0), np.float32)
+            self._matrices[field] = (version, ids, matrix)
+        return ids, matrix
+
+
+class FakeBulkWriter:
+    """
+    Writes are buffered and committed by `flush` in batches of 20, the size of a BulkWriter batch.
+    """
+
+    def __init__(self, client: "FakeFirestore"):
+        self._client = client
+        self._pending = []
+        self._attempts: dict[str, int] = {}
+        self._on_result = None
+        self._on_error = None
+
+    def on_write_result(self, callback):
+        self._on_result = callback
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def set(self, reference: FakeDocumentReference, document_data: dict, merge: bool = False):
+        self._pending.append((reference, document_data, merge))
+
+    def flush(self):
+        pending, self._pending = self._pending, []
+        for start in range(0, len(pending), 20):
+            batch = pending[start:start + 20]
+            try:
+                self._client.upstream.call()
+            except exceptions.GoogleAPICallError as e:
+                for item in batch:
+                    reference = item[0]
+                    attempts = self._attempts.get(reference.id, 0)
+                    self._attempts[reference.id] = attempts + 1
+                    failure = SimpleNamespace(operation=SimpleNamespace(reference=reference), code=14, message=str(e),
+                                              attempts=attempts)
+                    if self._on_error and self._on_error(failure, self):
+                        self._pending.append(item)
+                continue
+            for reference, data, merge in batch:
+                reference._collection.write(reference.id, data, merge)
+                if self._on_result:
+                    self._on_result(reference, SimpleNamespace(update_time=datetime.datetime.now(datetime.UTC)), self)
+        if self._pending:
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+
+class FakeFirestore:
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+        self._collections: dict[str, FakeCollection] = {}
+        self._lock = threading.Lock()
+
+    def collection(self, name: str) -> FakeCollection:
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = FakeCollection(name, self.upstream)
+            return self._collections[name]
+
+    def get_all(self, references, field_paths=None, retry=None, timeout=None):
+        self.upstream.call(timeout)
+        for reference in references:
+            yield FakeSnapshot(reference, reference._collection.documents.get(reference.id), field_paths)
+
+    def bulk_writer(self, options=None) -> FakeBulkWriter:
+        return FakeBulkWriter(self)
+
+    def transaction(self, **_):
+        raise NotImplementedError("Transactions are not faked, use the memory or sqlite ingest queue")
+
+
+# GCS
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self._bucket = bucket
+        self.name = name
+
+    @property
+    def _object(self) -> dict:
+        stored = self._bucket.objects.get(self.name)
+        if stored is None:
+            raise exceptions.NotFound(f"No such object: {self._bucket.name}/{self.name}")
+        return stored
+
+    @property
+    def size(self) -> int:
+        return len(self._object["data"])
+
+    @property
+    def md5_hash(self) -> str:
+        return base64.b64encode(hashlib.md5(self._object["data"]).digest()).decode()
+
+    @property
+    def content_type(self) -> str:
+        return self._object["content_type"]
+
+    def upload_from_string(self, data: bytes, content_type: str = None):
+        self._bucket.upstream.call()
+        self._bucket.objects[self.name] = {"data": bytes(data), "content_type": content_type}
+
+    def open(self, mode: str = "rb", content_type: str = None):
+        blob = self
+
+        class Writer(io.BytesIO):
+            def close(self):
+                if not self.closed:
+                    blob.upload_from_string(self.getvalue(), content_type)
+                super().close()
+
+        return Writer()
+
+    def download_as_bytes(self, start: int = None, end: int = None) -> bytes:
+        self._bucket.upstream.call()
+        data = self._object["data"]
+        return data[start or 0:None if end is None else end + 1]
+
+    def download_to_file(self, file_obj):
+        self._bucket.upstream.call()
+        file_obj.write(self._object["data"])
+
+    def delete(self):
+        self._bucket.upstream.call()
+        self._bucket.objects.pop(self.name, None)
+
+
+class FakeBucket:
+    def __init__(self, name: str, upstream: Upstream):
+        self.name = name
+        self.upstream = upstream
+        self.objects: dict[str, dict] = {}
+
+    def blob(self, name: str, chunk_size: int = None) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str):
+        self.upstream.call()
+        return FakeBlob(self, name) if name in self.objects else None
+
+
+class FakeStorage:
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+        self._buckets: dict[str, FakeBucket] = {}
+
+    def bucket(self, name: str) -> FakeBucket:
+        return self._buckets.setdefault(name, FakeBucket(name, self.upstream))
+
+
+# Vision, Gemini and the embedding model
+
+
+def fake_annotation(image_uri: str) -> vision.AnnotateImageResponse:
+    rng = random.Random(image_uri)
+    return vision.AnnotateImageResponse(
+        label_annotations=[vision.EntityAnnotation(description=label, score=rng.uniform(0.5, 1))
+                           for label in rng.sample(LABELS, 5)],
+        image_properties_annotation=vision.ImageProperties(dominant_colors=vision.DominantColorsAnnotation(colors=[
+            vision.ColorInfo(color={"red": rng.randrange(256), "green": rng.randrange(256), "blue": rng.randrange(256)},
+                             score=rng.random(), pixel_fraction=rng.random())
+            for _ in range(10)
+        ])),
+        safe_search_annotation=vision.SafeSearchAnnotation(**{
+            category: vision.Likelihood[rng.choice(LIKELIHOODS)] for category in ("adult", "spoof", "medical", "violence", "racy")
+        }),
+    )
+
+
+class FakeVision:
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+
+    def annotate_image(self, request, retry=None, timeout=None):
+        self.upstream.call(timeout)
+        return fake_annotation(request.image.source.image_uri)
+
+    def batch_annotate_images(self, requests, retry=None, timeout=None):
+        self.upstream.call(timeout)
+        return SimpleNamespace(responses=[fake_annotation(request.image.source.image_uri) for request in requests])
+
+
+class FakeEmbeddingModel:
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+
+    def get_embeddings(self, contextual_text: str = None, image=None, dimension: int = 512):
+        self.upstream.call()
+        image_key = None
+        if image is not None:
+            image_key = image._gcs_uri or hashlib.md5(image._image_bytes).hexdigest()
+        return SimpleNamespace(
+            text_embedding=random_vector(f"text:{contextual_text}", dimension) if contextual_text else None,
+            image_embedding=random_vector(f"image:{image_key}", dimension) if image_key else None,
+        )
+
+
+class FakeGenerativeModel:
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+
+    def generate_content(self, contents, generation_config: dict = None):
+        self.upstream.call()
+        rng = random.Random(str(contents[0]))
+        if (generation_config or {}).get("response_mime_type") == "application/json":
+            text = json.dumps([{"name": rng.choice(["red", "green", "blue"]), "shade": "light", "weight": rng.random()}
+                               for _ in range(3)])
+        else:
+            text = " ".join(rng.choice(LABELS) for _ in range(60))
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))])
+
+
+# App Engine images API
+
+
+class FakeImagesAPI:
+    class Error(Exception):
+        pass
+
+    class AccessDeniedError(Error):
+        pass
+
+    class TransformationError(Error):
+        pass
+
+    class ObjectNotFoundError(Error):
+        pass
+
+    class LargeImageError(Error):
+        pass
+
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+
+    def get_serving_url(self, blob_key, filename: str = None, secure_url: bool = True) -> str:
+        self.upstream.call()
+        return f"https://lh3.googleusercontent.com/{hashlib.md5(filename.encode()).hexdigest()}"
+
+    def delete_serving_url(self, filename: str):
+        self.upstream.call()
+
+
+class FakeGCP:
+    """
+    One fake per upstream, sharing their Upstream settings. `install` puts them in the client
+    registry and in place of the App Engine images API, before the services are constructed.
+    """
+
+    def __init__(self, latency_ms: dict[str, float] = None, error_rates: dict[str, float] = None,
+                 spread: float = 0.5, seed: int = 0):
+        latency_ms = {**DEFAULT_LATENCY_MS, **(latency_ms or {})}
+        error_rates = error_rates or {}
+        self.upstreams = {
+            name: Upstream(name, latency_ms[name], error_rates.get(name, 0.0), spread, seed) for name in DEFAULT_LATENCY_MS
+        }
+        self.firestore = FakeFirestore(self.upstreams["firestore"])
+        self.storage = FakeStorage(self.upstreams["gcs"])
+        self.vision = FakeVision(self.upstreams["vision"])
+        self.embedding_model = FakeEmbeddingModel(self.upstreams["embedding"])
+        self.generative_model = FakeGenerativeModel(self.upstreams["gemini"])
+        self.images_api = FakeImagesAPI(self.upstreams["images_api"])
+
+    def install(self, project_id: str, location: str, model_name: str):
+        from services import images
+
+        clients.registry.put(("vertexai", project_id, location), True)
+        clients.registry.put(("firestore", project_id), self.firestore)
+        clients.registry.put(("storage",), self.storage)
+        clients.registry.put(("vision",), self.vision)
+        clients.registry.put(("embedding", clients.EMBEDDING_MODEL_NAME), self.embedding_model)
+        clients.registry.put(("generative", model_name), self.generative_model)
+        images.images = self.images_api
+        images.ON_APP_ENGINE = True
+
+    def counts(self) -> dict[str, dict[str, int]]:
+        return {name: {"calls": upstream.calls, "errors": upstream.errors} for name, upstream in self.upstreams.items()}
+
+    def reset_counts(self):
+        for upstream in self.upstreams.values():
+            upstream.calls = upstream.errors = 0
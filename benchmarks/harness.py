@@ -0,0 +1,411 @@
+"""
+Load test of the app against in-process fakes of the GCP services, see benchmarks/fakes.py.
+
+Drives POST /images, GET /images unfiltered and per company, GET /symantic and the rehydrate.py
+loop with concurrent clients and reports throughput, latency percentiles and peak memory per
+scenario. Requests go straight into the ASGI app, so the numbers cover the app and its services
+without a server.
+
+    python -m benchmarks.harness --scenarios upload list query search rehydrate --requests 200 --concurrency 16
+    python -m benchmarks.harness --latency-scale 0          # CPU only, every upstream answers at once
+    python -m benchmarks.harness --latency gemini=2000 --error-rate vision=0.05
+    python -m benchmarks.harness --output after.json --baseline before.json
+
+With --baseline, a scenario whose throughput dropped or whose p95 rose by more than
+--tolerance fails the run.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ("upload", "list", "query", "search", "rehydrate")
+SOURCE_COLLECTION = "rehydrate-source"
+TARGET_COLLECTION = "rehydrate-target"
+
+
+def parse_pairs(values: list[str]) -> dict[str, float]:
+    pairs = {}
+    for value in values or []:
+        name, _, number = value.partition("=")
+        pairs[name] = float(number)
+    return pairs
+
+
+def configure_environment(workdir: str, args):
+    # The settings are read from the environment at import, so this runs before the app is imported.
+    os.environ.update({
+        "GCP_PROJECT_ID": "benchmark",
+        "GCP_REGION": "us-central1",
+        "BUCKET_NAME": "benchmark-images",
+        "FIRESTORE_COLLECTION": "image-data",
+        "INGEST_QUEUE": "memory",
+        "VARIANT_CACHE_DIR": os.path.join(workdir, "variants"),
+        "TRACE_SLOW_REQUEST_SECONDS": "0",
+        # The scenarios measure a warm service, not requests waiting for the startup.
+        "WARM_UP": "blocking",
+    })
+    if args.variants is not None:
+        os.environ["IMAGE_VARIANTS"] = args.variants
+    # rehydrate.py maps documents onto companies from this file, relative to the working directory.
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    with open(os.path.join(workdir, "data", "companies_with_albums.json"), "w") as f:
+        for i in range(0, args.documents, 3):
+            f.write(json.dumps({f"doc-{i:06d}": {"company_id": f"company-{i % 7}", "album_id": f"album-{i % 31}"}}) + "\n")
+
+
+def sample_jpeg(size: int, seed: int) -> bytes:
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    # A smooth gradient with noise compresses like a photo rather than like a flat colour.
+    y, x = np.mgrid[0:size, 0:size]
+    base = np.stack([(x + y) * 255 / (2 * size), x * 255 / size, y * 255 / size], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(pixels).save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+def multipart(field: str, filename: str, data: bytes, content_type: str = "image/jpeg") -> tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+async def asgi_request(app, method: str, path: str, query: str = "", body: bytes = b"",
+                       content_type: str = None) -> tuple[int, bytes]:
+    headers = [(b"host", b"benchmark")]
+    if content_type:
+        headers += [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": headers, "client": ("benchmark", 0), "server": ("benchmark", 80),
+    }
+    sent = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    status, chunks = 500, []
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        disconnected.set()
+    return status, b"".join(chunks)
+
+
+def percentiles(latencies: list[float]) -> dict[str, float]:
+    if not latencies:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    values = np.percentile(latencies, [50, 95, 99, 100]) * 1000
+    return {name: round(float(value), 1) for name, value in zip(("p50", "p95", "p99", "max"), values)}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def drive(requests: int, concurrency: int, send) -> tuple[list[float], int, float]:
+    """
+    Run `send(i)` for every i in range(requests) from `concurrency` clients, returning the
+    latencies, the number of failed requests and the wall time.
+    """
+    latencies, failed = [], 0
+    counter = iter(range(requests))
+
+    async def client():
+        nonlocal failed
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                ok = await send(i)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            failed += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, failed, time.perf_counter() - start
+
+
+class Benchmark:
+    def __init__(self, args, fakes, workdir: str):
+        self.args = args
+        self.fakes = fakes
+        self.workdir = workdir
+        self.image_ids: list[str] = []
+
+    def seed(self):
+        """
+        Write enriched documents for the read scenarios and bare ones for rehydrate straight into
+        the fake collections, without latency.
+        """
+        import datetime
+        from routes import images
+        from services.database import EMBEDDING_FIELDS, ImageDocument, Metadata
+
+        now = datetime.datetime.now(datetime.UTC)
+        rng = np.random.default_rng(0)
+        collection = self.fakes.firestore.collection(os.environ["FIRESTORE_COLLECTION"])
+        source = self.fakes.firestore.collection(SOURCE_COLLECTION)
+        # Rehydrate downloads the images it hashes, so the seeded documents get objects too.
+        bucket = self.fakes.storage.bucket("benchmark-images")
+        samples = [sample_jpeg(self.args.image_size, seed) for seed in range(8)]
+        for i in range(self.args.documents):
+            doc = ImageDocument(
+                imageId=f"doc-{i:06d}", imagePath=f"benchmark-images/seed/{i}.jpg", bucket="benchmark-images",
+                imageName=f"{i}.jpg", imageUrl=f"https://example.com/{i}.jpg", published=True, valid=True,
+                timeCreated=now, timeUpdated=now, metadata=Metadata(height=1024, width=1024),
+            )
+            source.write(doc.imageId, images.deps.db._encode(doc))
+            bucket.objects[doc.imagePath] = {"data": samples[i % len(samples)], "content_type": "image/jpeg"}
+
+            doc.imageDescription = f"seeded image {i}"
+            doc.metadata.labels = ["seed"]
+            # Companies and albums of the mapping rehydrate.py reads, for the filtered listings.
+            doc.metadata.companyId, doc.metadata.albumId = f"company-{i % 7}", f"album-{i % 31}"
+            doc.timeCreated = now - datetime.timedelta(seconds=i)
+            for (_, dimension), field in EMBEDDING_FIELDS.items():
+                vector = rng.normal(size=dimension).astype(np.float32)
+                setattr(doc, field, vector / np.linalg.norm(vector))
+            collection.write(doc.imageId, images.deps.db._encode(doc))
+            self.image_ids.append(doc.imageId)
+
+    async def run_upload(self, app) -> tuple[list[float], int, float]:
+        images = [sample_jpeg(self.args.image_size, seed) for seed in range(8)]
+
+        async def send(i: int) -> bool:
+            body, content_type = multipart("file", f"upload-{i}.jpg", images[i % len(images)])
+            status, _ = await asgi_request(app, "POST", "/images", f"image_name=benchmark/{uuid.uuid4().hex}.jpg&mode=sync",
+                                           body, content_type)
+            return status < 400
+
+        return await drive(self.args.requests, self.args.concurrency, send)
+
+    async def run_list(self, app) -> tuple[list[float], int, float]:
+        from services.database import DBService
+
+        rng = random.Random(1)
+
+        async def send(_: int) -> bool:
+            start_at = rng.choice(self.image_ids)
+            query = f"limit={self.args.page_size}&page_token={DBService.encode_page_token(start_at)}"
+            status, _ = await asgi_request(app, "GET", "/images", query)
+            return status < 400
+
+        return await drive(self.args.requests, self.args.concurrency, send)
+
+    async def run_query(self, app) -> tuple[list[float], int, float]:
+        rng = random.Random(3)
+
+        async def send(i: int) -> bool:
+            # A tenant view: the first page of a company and its image count, or its next page.
+            company = f"company-{rng.randrange(7)}"
+            if i % 4 == 0:
+                status, _ = await asgi_request(app, "GET", "/images/count", f"companyId={company}")
+                return status < 400
+            status, body = await asgi_request(app, "GET", "/images", f"companyId={company}&limit={self.args.page_size}&format=ndjson")
+            last = json.loads(body.splitlines()[-1]) if status < 400 and body else {}
+            if "nextPageToken" in last:
+                status, _ = await asgi_request(app, "GET", "/images",
+                                               f"companyId={company}&limit={self.args.page_size}&page_token={last['nextPageToken']}")
+            return status < 400
+
+        return await drive(self.args.requests, self.args.concurrency, send)
+
+    async def run_search(self, app) -> tuple[list[float], int, float]:
+        from benchmarks.fakes import LABELS
+
+        rng = random.Random(2)
+
+        async def send(i: int) -> bool:
+            # Distinct queries, so every search embeds its query rather than hitting the query cache.
+            query = f"{' '.join(rng.sample(LABELS, 3))} {i}".replace(" ", "+")
+            status, _ = await asgi_request(app, "GET", "/symantic", f"query={query}&limit=10")
+            return status < 400
+
+        return await drive(self.args.requests, self.args.concurrency, send)
+
+    async def run_rehydrate(self, _) -> tuple[list[float], int, float]:
+        os.environ.update({
+            "FIRESTORE_COLLECTION": SOURCE_COLLECTION,
+            "TARGET_COLLECTION": TARGET_COLLECTION,
+            "CONCURRENCY": str(self.args.concurrency),
+        })
+        import rehydrate
+
+        checkpoint_dir = tempfile.mkdtemp(dir=self.workdir)
+        rehydrator = rehydrate.Rehydrator(rehydrate.Checkpoint(checkpoint_dir),
+                                          rehydrate.DeadLetter(os.path.join(checkpoint_dir, "dead_letter.jsonl")),
+                                          self.args.concurrency, rehydrate.batch_size, rehydrate.flush_interval)
+        # Per document latency is the enrichment, the loop itself is measured by its throughput.
+        latencies = []
+        enrich_document = rehydrate.enrich_document
+
+        async def timed(doc):
+            start = time.perf_counter()
+            try:
+                return await enrich_document(doc)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        rehydrate.enrich_document = timed
+        start = time.perf_counter()
+        try:
+            stats = await rehydrator.run(rehydrator.fetch_pages(min(self.args.requests, self.args.documents), rehydrate.page_size))
+        finally:
+            rehydrate.enrich_document = enrich_document
+        return latencies, stats["failed"], time.perf_counter() - start
+
+
+async def run(args, fakes, workdir: str) -> list[dict]:
+    from app import app
+    from services import telemetry
+
+    benchmark = Benchmark(args, fakes, workdir)
+    benchmark.seed()
+    log = open(os.path.join(workdir, "app.log"), "w")
+    results = []
+    try:
+        with contextlib.redirect_stdout(log):
+            async with app.router.lifespan_context(app):
+                for scenario in args.scenarios:
+                    fakes.reset_counts()
+                    telemetry.registry.reset()
+                    if args.trace_memory:
+                        tracemalloc.start()
+                    latencies, failed, wall = await getattr(benchmark, f"run_{scenario}")(app)
+                    peak_traced = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+                    if args.trace_memory:
+                        tracemalloc.stop()
+
+                    results.append({
+                        "scenario": scenario,
+                        "requests": len(latencies),
+                        "failed": failed,
+                        "concurrency": args.concurrency,
+                        "seconds": round(wall, 2),
+                        "throughput": round(len(latencies) / wall, 2) if wall else 0.0,
+                        **percentiles(latencies),
+                        "peak_rss_mb": peak_rss_mb(),
+                        **({"peak_traced_mb": round(peak_traced / 1024 / 1024, 1)} if peak_traced is not None else {}),
+                        "upstream_calls": {name: count["calls"] for name, count in fakes.counts().items() if count["calls"]},
+                        "upstream_errors": {name: count["errors"] for name, count in fakes.counts().items() if count["errors"]},
+                        "upstreams": telemetry.summary(),
+                    })
+    finally:
+        log.close()
+    return results
+
+
+def report(results: list[dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    regressions = []
+    print(f"{'scenario':<12}{'requests':>9}{'failed':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}{'rss MB':>8}{'traced MB':>11}")
+    for result in results:
+        print(f"{result['scenario']:<12}{result['requests']:>9}{result['failed']:>8}{result['throughput']:>9.1f}"
+              f"{result['p50']:>9.1f}{result['p95']:>9.1f}{result['p99']:>9.1f}{result['max']:>9.1f}"
+              f"{result['peak_rss_mb']:>8.1f}{result.get('peak_traced_mb', '-'):>11}")
+        print(f"{'':<12}upstream calls {result['upstream_calls']}"
+              + (f", injected errors {result['upstream_errors']}" if result["upstream_errors"] else ""))
+
+        before = baseline.get(result["scenario"])
+        if before:
+            throughput = result["throughput"] / before["throughput"] - 1 if before["throughput"] else 0.0
+            p95 = result["p95"] / before["p95"] - 1 if before["p95"] else 0.0
+            print(f"{'':<12}vs baseline: throughput {throughput:+.1%}, p95 {p95:+.1%}")
+            if throughput < -tolerance or p95 > tolerance:
+                regressions.append(result["scenario"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario, documents for rehydrate")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--documents", type=int, default=2000, help="Documents seeded in the fake Firestore")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--image-size", type=int, default=1024, help="Longest edge of the uploaded JPEGs")
+    parser.add_argument("--variants", help="IMAGE_VARIANTS for the run, none turns them off")
+    parser.add_argument("--latency", nargs="*", metavar="UPSTREAM=MS", help="Median latency per upstream")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplies every latency, 0 turns them off")
+    parser.add_argument("--latency-spread", type=float, default=0.5, help="Sigma of the log-normal latencies")
+    parser.add_argument("--error-rate", nargs="*", metavar="UPSTREAM=RATE", help="Share of failed calls per upstream")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="Report the peak Python allocations, slows the run")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    # The run happens in a scratch directory, paths given on the command line stay relative to where it started.
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    workdir = tempfile.mkdtemp(prefix="image-service-benchmark-")
+    configure_environment(workdir, args)
+    os.chdir(workdir)
+
+    from benchmarks.fakes import DEFAULT_LATENCY_MS, FakeGCP
+    from services.ai import GEMINI_MODEL_NAME
+
+    latency = {**DEFAULT_LATENCY_MS, **parse_pairs(args.latency)}
+    fakes = FakeGCP({name: ms * args.latency_scale for name, ms in latency.items()}, parse_pairs(args.error_rate),
+                    args.latency_spread, args.seed)
+    fakes.install(os.environ["GCP_PROJECT_ID"], os.environ["GCP_REGION"], GEMINI_MODEL_NAME)
+
+    results = asyncio.run(run(args, fakes, workdir))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+    regressions = report(results, baseline, args.tolerance)
+    print(f"App output: {os.path.join(workdir, 'app.log')}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=2)
+    if regressions:
+        print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Recall@k of the compact embedding storage modes against full precision search, on a synthetic corpus.
+
+The corpus is clustered and, like Matryoshka trained embeddings, puts more variance in the first
+dimensions. A correlated lower dimension field stands in for the primary field that finds the
+candidates of a re-ranked search.
+
+    python -m benchmarks.quantization --documents 20000 --k 10
+"""
+from services.ann import recall_at_k
+from services.quantize import dequantize_int8, quantize_int8, truncate
+import argparse
+import numpy as np
+import time
+
+
+def normalise(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def corpus(documents: int, dimension: int, primary_dimension: int, clusters: int, rng) -> tuple[np.ndarray, np.ndarray]:
+    decay = 1 / np.sqrt(1 + np.arange(dimension) / 64)
+    centres = rng.normal(size=(clusters, dimension))
+    vectors = (centres[rng.integers(clusters, size=documents)] + 0.6 * rng.normal(size=(documents, dimension))) * decay
+    # The primary field sees the same content through a different, noisy projection.
+    projection = rng.normal(size=(dimension, primary_dimension)) / np.sqrt(dimension)
+    primary = vectors @ projection + 0.05 * rng.normal(size=(documents, primary_dimension))
+    return normalise(vectors).astype(np.float32), normalise(primary).astype(np.float32)
+
+
+def top_k(queries: np.ndarray, vectors: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ vectors.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+
+
+def mean_recall(expected: np.ndarray, found: np.ndarray, k: int) -> float:
+    return float(np.mean([recall_at_k(list(e), list(f), k) for e, f in zip(expected, found)]))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=1408)
+    parser.add_argument("--primary-dimension", type=int, default=512)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--oversample", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--truncate", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors, primary = corpus(args.documents, args.dimension, args.primary_dimension, args.clusters, rng)
+    picked = rng.choice(args.documents, args.queries, replace=False)
+    queries = normalise(vectors[picked] + 0.02 * rng.normal(size=(args.queries, args.dimension))).astype(np.float32)
+    primary_queries = primary[picked]
+
+    expected, baseline_ms = timed(top_k, queries, vectors, args.k)
+    rows = [("full precision (baseline)", args.dimension * 8, 1.0, baseline_ms)]
+
+    encoded = [quantize_int8(vector) for vector in vectors]
+    int8 = np.stack([dequantize_int8(data, scale) for data, scale in encoded])
+    found, ms = timed(top_k, queries, int8, args.k)
+    rows.append(("int8", args.dimension + 8, mean_recall(expected, found, args.k), ms))
+
+    for dimension in args.truncate:
+        truncated = np.stack([truncate(vector, dimension) for vector in vectors])
+        truncated_queries = np.stack([truncate(query, dimension) for query in queries])
+        found, ms = timed(top_k, truncated_queries, truncated, args.k)
+        rows.append((f"matryoshka {dimension}", dimension * 8, mean_recall(expected, found, args.k), ms))
+
+        quantized = np.stack([dequantize_int8(*quantize_int8(vector)) for vector in truncated])
+        found, ms = timed(top_k, truncated_queries, quantized, args.k)
+        rows.append((f"matryoshka {dimension} + int8", dimension + 8, mean_recall(expected, found, args.k), ms))
+
+    # The search the service runs on a compact field: candidates from the primary field, re-ranked on int8.
+    for oversample in args.oversample:
+        start = time.perf_counter()
+        candidates = top_k(primary_queries, primary, args.k * oversample)
+        found = []
+        for query, candidate_rows in zip(queries, candidates):
+            order = np.argsort(-(int8[candidate_rows] @ query))[:args.k]
+            found.append(candidate_rows[order])
+        ms = (time.perf_counter() - start) * 1000
+        rows.append((f"primary x{oversample} re-ranked on int8", args.dimension + 8, mean_recall(expected, np.stack(found), args.k), ms))
+
+    print(f"{args.documents} documents, {args.queries} queries, recall@{args.k} against float32 search on {args.dimension} dimensions\n")
+    print(f"{'mode':<36}{'bytes/vector':>14}{'recall':>10}{'query ms':>12}")
+    for name, size, recall, ms in rows:
+        print(f"{name:<36}{size:>14}{recall:>10.3f}{ms / args.queries:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from services.database import EMBEDDING_FIELDS
+from services.vector import VectorSearchService
+from services.ann import METRICS
+from services.quantize import EmbeddingCodec
+import os
+from dotenv import load_dotenv
+import argparse
+import time
+
+os.environ["GRPC_VERBOSITY"] = "ERROR"
+os.environ["GRPC_TRACE"] = ""
+
+load_dotenv()
+
+project_id = os.getenv("GCP_PROJECT_ID")
+firestore_collection = os.getenv("FIRESTORE_COLLECTION")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build local ANN indexes from a snapshot of the Firestore collection. "
+                                                 "Part of every deploy, the app only searches indexes younger than ANN_INDEX_MAX_AGE.")
+    parser.add_argument("--field", action="append", choices=list(EMBEDDING_FIELDS.values()),
+                        help="Vector field to index, can be repeated. Defaults to image_embedding_field and text_embedding_field.")
+    parser.add_argument("--metric", default="DOT_PRODUCT", choices=METRICS)
+    parser.add_argument("--nlist", type=int, default=None, help="Number of lists, defaults to the square root of the document count.")
+    parser.add_argument("--nprobe", type=int, default=8, help="Lists searched per query, higher is slower with a better recall.")
+    parser.add_argument("--out", default=os.getenv("ANN_INDEX_DIR", "ann"))
+    parser.add_argument("--check", type=int, default=0, help="Number of sample queries to check the recall against Firestore with.")
+    args = parser.parse_args()
+
+    # Compactly stored fields are indexed from their decoded vectors.
+    codec = EmbeddingCodec(os.getenv("EMBEDDING_STORAGE", "full"), (os.getenv("EMBEDDING_PRIMARY_FIELD", "image_embedding_field"),),
+                           int(os.getenv("EMBEDDING_TRUNCATE_DIMENSION", 256)))
+    db = VectorSearchService(project_id, firestore_collection, codec=codec)
+    for field in args.field or ["image_embedding_field", "text_embedding_field"]:
+        start = time.perf_counter()
+        index = db.build_index(field, args.metric, args.nlist, args.nprobe)
+        print(f"Built {field}: {len(index)} vectors in {index.nlist} lists in {time.perf_counter() - start:.1f}s")
+
+        if args.check:
+            report = db.recall_check([list(vector) for vector in index.sample(args.check)], field)
+            print(f"Recall check {field}: {report}")
+
+    db.save_indexes(args.out)
+    print(f"Saved indexes to {args.out}")
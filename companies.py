@@ -0,0 +1,33 @@
+from services.companies import CompanyStore, build_store, read_json_lines
+import argparse
+import json
+import time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and update the on-disk company/album store rehydrate.py looks images up in.")
+    parser.add_argument("--store", default="data/companies.sqlite", help="Path of the store, set COMPANIES_PATH to it for rehydrate.py.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Build the store from a JSON lines mapping, replacing the previous one.")
+    build.add_argument("source", nargs="?", default="data/companies_with_albums.json")
+    update = commands.add_parser("update", help="Apply a JSON lines file of changes to the store, a null entry deletes an image.")
+    update.add_argument("changes")
+    get = commands.add_parser("get", help="Print the entries of image IDs.")
+    get.add_argument("image_ids", nargs="+")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "build":
+        written = build_store(args.source, args.store)
+        print(f"Built {args.store} with {written} images in {time.perf_counter() - start:.1f}s")
+    elif args.command == "update":
+        store = CompanyStore(args.store)
+        written, deleted = store.update(read_json_lines(args.changes))
+        print(f"Updated {written} and deleted {deleted} images of {args.store} in {time.perf_counter() - start:.1f}s, "
+              f"{len(store)} images in total")
+        store.close()
+    else:
+        store = CompanyStore(args.store, read_only=True)
+        for image_id in args.image_ids:
+            print(json.dumps({image_id: store.get(image_id)}))
+        store.close()
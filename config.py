@@ -10,6 +10,68 @@ class Settings(BaseModel):
     region: str = os.getenv('GCP_REGION')
     firestore_collection: str = os.getenv('FIRESTORE_COLLECTION', 'image-data')
     bucket: str = os.getenv('BUCKET_NAME', 'image-data')
+    ann_index_dir: str = os.getenv('ANN_INDEX_DIR', '')
+    # Seconds after build_index.py ran that searches stop using the local indexes and go to Firestore, 0 never.
+    ann_index_max_age: float = float(os.getenv('ANN_INDEX_MAX_AGE', 86400))
+    color_naming: str = os.getenv('COLOR_NAMING', 'local')
+    enrichment_cache: str = os.getenv('ENRICHMENT_CACHE', '')
+    enrichment_cache_path: str = os.getenv('ENRICHMENT_CACHE_PATH', '.cache/enrichment.sqlite')
+    enrichment_cache_max_mb: int = int(os.getenv('ENRICHMENT_CACHE_MAX_MB', 512))
+    enrichment_cache_collection: str = os.getenv('ENRICHMENT_CACHE_COLLECTION', 'enrichment-cache')
+    ingest_mode: str = os.getenv('INGEST_MODE', 'sync')
+    ingest_queue: str = os.getenv('INGEST_QUEUE', 'memory')
+    ingest_queue_path: str = os.getenv('INGEST_QUEUE_PATH', '.cache/ingest-queue.sqlite')
+    ingest_queue_collection: str = os.getenv('INGEST_QUEUE_COLLECTION', 'ingest-queue')
+    # Seconds every queue keeps done and failed jobs for the status route, and how many at most in memory.
+    ingest_queue_retention: float = float(os.getenv('INGEST_QUEUE_RETENTION', 3600))
+    ingest_queue_max_finished: int = int(os.getenv('INGEST_QUEUE_MAX_FINISHED', 10000))
+    # Workers enriching queued images inside the app, 0 when a separate worker container drains the queue.
+    ingest_workers: int = int(os.getenv('INGEST_WORKERS', 2))
+    ingest_max_attempts: int = int(os.getenv('INGEST_MAX_ATTEMPTS', 3))
+    batch_max_images: int = int(os.getenv('BATCH_MAX_IMAGES', 100))
+    batch_concurrency: int = int(os.getenv('BATCH_CONCURRENCY', 8))
+    # Base URL of the images off App Engine, a CDN in front of the bucket or the public GCS endpoint.
+    serving_url_base: str = os.getenv('SERVING_URL_BASE', 'https://storage.googleapis.com')
+    # name:longest edge:webp|jpeg:quality, comma separated, "none" turns variants off.
+    image_variants: str = os.getenv('IMAGE_VARIANTS', '')
+    # Processes rendering variants, 0 uses one per CPU.
+    variant_workers: int = int(os.getenv('VARIANT_WORKERS', 0))
+    variant_cache_dir: str = os.getenv('VARIANT_CACHE_DIR', '.cache/variants')
+    variant_cache_max_mb: int = int(os.getenv('VARIANT_CACHE_MAX_MB', 1024))
+    # full, int8 or matryoshka, see services.quantize. The primary field stays a Firestore vector.
+    embedding_storage: str = os.getenv('EMBEDDING_STORAGE', 'full')
+    embedding_primary_field: str = os.getenv('EMBEDDING_PRIMARY_FIELD', 'image_embedding_field')
+    embedding_truncate_dimension: int = int(os.getenv('EMBEDDING_TRUNCATE_DIMENSION', 256))
+    # Read-through cache of single documents, 0 turns it off.
+    doc_cache_size: int = int(os.getenv('DOC_CACHE_SIZE', 10000))
+    doc_cache_ttl: float = float(os.getenv('DOC_CACHE_TTL', 60))
+    doc_cache_negative_ttl: float = float(os.getenv('DOC_CACHE_NEGATIVE_TTL', 5))
+    doc_cache_listen: bool = os.getenv('DOC_CACHE_LISTEN', 'false').lower() == 'true'
+    # Upstream call metrics served at /metrics and a trace per request, false leaves the calls untimed.
+    telemetry_enabled: bool = os.getenv('TELEMETRY_ENABLED', 'true').lower() == 'true'
+    # Requests slower than this are logged with the spans of their upstream calls, 0 turns the log off.
+    trace_slow_request_seconds: float = float(os.getenv('TRACE_SLOW_REQUEST_SECONDS', 1))
+    # Seconds an attempt of an upstream call may take, 0 leaves that upstream untimed.
+    vision_timeout: float = float(os.getenv('VISION_TIMEOUT', 30))
+    gemini_timeout: float = float(os.getenv('GEMINI_TIMEOUT', 60))
+    embedding_timeout: float = float(os.getenv('EMBEDDING_TIMEOUT', 20))
+    firestore_timeout: float = float(os.getenv('FIRESTORE_TIMEOUT', 10))
+    upstream_attempts: int = int(os.getenv('UPSTREAM_ATTEMPTS', 3))
+    # An embedding call still running after this many seconds is raced against a second one, 0 turns hedging off.
+    embedding_hedge_after: float = float(os.getenv('EMBEDDING_HEDGE_AFTER', 0))
+    # Consecutive failures opening the circuit of an upstream, and seconds until it is probed again.
+    circuit_failure_threshold: int = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+    circuit_reset_seconds: float = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))
+    # Store images without a description and text embeddings while Gemini is unavailable.
+    partial_enrichment: bool = os.getenv('PARTIAL_ENRICHMENT', 'true').lower() == 'true'
+    # Threads running the Vision, Gemini and embedding calls, a call stuck until its deadline holds one.
+    upstream_workers: int = int(os.getenv('UPSTREAM_WORKERS', 32))
+    # Reuse the enrichment of a stored image whose perceptual hashes are within DEDUPE_RADIUS bits of an upload.
+    dedupe_reuse: bool = os.getenv('DEDUPE_REUSE', 'false').lower() == 'true'
+    dedupe_radius: int = int(os.getenv('DEDUPE_RADIUS', 6))
+    # When the clients and services are created at startup: "background" serves requests while they are built,
+    # "blocking" builds them before the first request and "off" leaves each one to the first request using it.
+    warm_up: str = os.getenv('WARM_UP', 'background')
 
 
 settings = Settings()
@@ -0,0 +1,81 @@
+from services.database import DBService
+from services.phash import DuplicateIndex, ImageHashes, gcs_image_hashes
+from concurrent.futures import ThreadPoolExecutor
+import os
+from dotenv import load_dotenv
+import argparse
+import json
+import time
+
+os.environ["GRPC_VERBOSITY"] = "ERROR"
+os.environ["GRPC_TRACE"] = ""
+
+load_dotenv()
+
+project_id = os.getenv("GCP_PROJECT_ID")
+firestore_collection = os.getenv("FIRESTORE_COLLECTION")
+
+
+def backfill(db: DBService, missing: list[tuple[str, str]], workers: int) -> dict[str, ImageHashes]:
+    """
+    Hash the (image ID, gs:// URI) images stored before hashing and save the hashes on their documents.
+    """
+    def run(item: tuple[str, str]):
+        image_id, image_uri = item
+        try:
+            hashes = gcs_image_hashes(image_uri)
+            db.update_fields(image_id, hashes.model_dump())
+            return image_id, hashes
+        except Exception as e:
+            print(f"An error occurred while hashing {image_uri}: {e}")
+            return image_id, None
+
+    with ThreadPoolExecutor(workers) as executor:
+        return {image_id: hashes for image_id, hashes in executor.map(run, missing) if hashes is not None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the groups of near-duplicate images in the Firestore collection.")
+    parser.add_argument("--radius", type=int, default=int(os.getenv("DEDUPE_RADIUS", 6)),
+                        help="Most bits two images may differ by on both hashes to be duplicates.")
+    parser.add_argument("--backfill", action="store_true", help="Hash the images without hashes first and store the hashes.")
+    parser.add_argument("--workers", type=int, default=16, help="Images hashed at the same time by --backfill.")
+    parser.add_argument("--out", default="dedupe_report.json")
+    args = parser.parse_args()
+
+    db = DBService(project_id, firestore_collection)
+    start = time.perf_counter()
+    batch = db.load_columns([], ["perceptualHash", "differenceHash", "bucket", "imagePath"])
+    columns = batch.columns
+    rows = list(zip(batch.ids, columns["perceptualHash"], columns["differenceHash"]))
+    print(f"Read {len(rows)} documents in {time.perf_counter() - start:.1f}s")
+
+    index = DuplicateIndex(args.radius)
+    index.load(rows)
+    missing = [
+        (image_id, f"gs://{bucket}/{path}")
+        for image_id, (_, perceptual, _), bucket, path in zip(batch.ids, rows, columns["bucket"], columns["imagePath"])
+        if not perceptual
+    ]
+    if args.backfill and missing:
+        start = time.perf_counter()
+        hashed = backfill(db, missing, args.workers)
+        for image_id, hashes in hashed.items():
+            index.add(image_id, hashes)
+        print(f"Hashed {len(hashed)} of {len(missing)} images in {time.perf_counter() - start:.1f}s")
+        missing = [item for item in missing if item[0] not in hashed]
+
+    start = time.perf_counter()
+    groups = index.groups()
+    print(f"Found {len(groups)} groups of near-duplicates, {sum(len(group) for group in groups)} images, "
+          f"in {time.perf_counter() - start:.1f}s. {len(missing)} images have no hashes.")
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "radius": args.radius,
+            "documents": len(rows),
+            "hashed": len(index),
+            "duplicates": sum(len(group) - 1 for group in groups),
+            "groups": groups,
+        }, f, indent=2)
+    print(f"Saved the report to {args.out}")
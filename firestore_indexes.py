@@ -0,0 +1,39 @@
+from services.database import composite_indexes
+import os
+from dotenv import load_dotenv
+import argparse
+import json
+
+load_dotenv()
+
+
+def gcloud_commands(indexes: dict) -> list[str]:
+    commands = []
+    for index in indexes["indexes"]:
+        configs = [
+            f"--field-config=field-path={field['fieldPath']},"
+            + (f"order={field['order'].lower()}" if "order" in field else "array-config=contains")
+            for field in index["fields"]
+        ]
+        commands.append(f"gcloud firestore indexes composite create --collection-group={index['collectionGroup']} "
+                        f"--query-scope=COLLECTION {' '.join(configs)} --async")
+    return commands
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the Firestore composite indexes of the filtered image listings.")
+    parser.add_argument("--collection", default=os.getenv("FIRESTORE_COLLECTION", "image-data"))
+    parser.add_argument("--merge", action="store_true",
+                        help="One index per filter, merged by Firestore for combined filters, instead of one per combination.")
+    parser.add_argument("--out", default="firestore.indexes.json", help="Definitions for firebase deploy --only firestore:indexes.")
+    parser.add_argument("--gcloud", action="store_true", help="Print the gcloud commands creating the indexes instead.")
+    args = parser.parse_args()
+
+    indexes = composite_indexes(args.collection, args.merge)
+    if args.gcloud:
+        print("\n".join(gcloud_commands(indexes)))
+    else:
+        with open(args.out, "w") as f:
+            json.dump(indexes, f, indent=2)
+            f.write("\n")
+        print(f"Saved {len(indexes['indexes'])} indexes of {args.collection} to {args.out}")
@@ -1,9 +1,22 @@
-from services.ai import AIService
-from services.database import DBService
+from services.startup import profile
+from services.ai import AIService, EmptyEmbeddingError
+from services.cache import create_enrichment_cache
+from services.companies import CompanyStore, open_company_mapping
+from services.database import DBService, ImageDocument, EMBEDDING_FIELDS
+from services.phash import gcs_image_hashes
+from services.quantize import EmbeddingCodec
+from services.rate_limit import TokenBucket
+from services.resilience import create_policies
+from services import telemetry
 import os
 from dotenv import load_dotenv
-from google.cloud.firestore_v1.vector import Vector
+import asyncio
+import datetime
 import json
+import shutil
+import sys
+import threading
+import time
 
 os.environ["GRPC_VERBOSITY"] = "ERROR"
 os.environ["GRPC_TRACE"] = ""
@@ -13,16 +26,51 @@ load_dotenv()
 project_id = os.getenv("GCP_PROJECT_ID")
 region = os.getenv("GCP_REGION")
 firestore_collection = os.getenv("FIRESTORE_COLLECTION")
-limit = os.getenv("LIMIT", 500)
+target_collection = os.getenv("TARGET_COLLECTION", "vector-image-data")
+# Total documents to process in this run, 0 processes the whole collection.
+limit = int(os.getenv("LIMIT", 500))
+page_size = int(os.getenv("PAGE_SIZE", 100))
+concurrency = int(os.getenv("CONCURRENCY", 8))
+batch_size = int(os.getenv("BATCH_SIZE", 50))
+flush_interval = float(os.getenv("FLUSH_INTERVAL", 2))
+checkpoint_dir = os.getenv("CHECKPOINT_DIR", "docs")
+# A store built by companies.py (.sqlite) is looked up on disk, a JSON lines file is read into memory.
+companies_path = os.getenv("COMPANIES_PATH", "data/companies_with_albums.json")
 
-ai = AIService(project_id, region)
-db = DBService(project_id, firestore_collection)
-db2 = DBService(project_id, "vector-image-data")
+telemetry.configure(os.getenv("TELEMETRY_ENABLED", "true").lower() == "true")
+
+policies = create_policies(
+    {
+        "vision": float(os.getenv("VISION_TIMEOUT", 30)),
+        "gemini": float(os.getenv("GEMINI_TIMEOUT", 60)),
+        "embedding": float(os.getenv("EMBEDDING_TIMEOUT", 20)),
+        "firestore": float(os.getenv("FIRESTORE_TIMEOUT", 10)),
+    },
+    int(os.getenv("UPSTREAM_ATTEMPTS", 3)),
+    hedge_after={"embedding": float(os.getenv("EMBEDDING_HEDGE_AFTER", 0))},
+    failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5)),
+    reset_timeout=float(os.getenv("CIRCUIT_RESET_SECONDS", 30)),
+)
+
+ai = AIService(project_id, region, create_enrichment_cache(
+    os.getenv("ENRICHMENT_CACHE", ""),
+    project_id=project_id,
+    path=os.getenv("ENRICHMENT_CACHE_PATH"),
+    max_mb=int(os.getenv("ENRICHMENT_CACHE_MAX_MB", 512)),
+    collection=os.getenv("ENRICHMENT_CACHE_COLLECTION"),
+), os.getenv("COLOR_NAMING", "local"), rate_limits={
+    "vision": TokenBucket(float(os.getenv("VISION_QPS", 0))),
+    "gemini": TokenBucket(float(os.getenv("GEMINI_QPS", 0))),
+    "embedding": TokenBucket(float(os.getenv("EMBEDDING_QPS", 0))),
+}, policies=policies, upstream_workers=int(os.getenv("UPSTREAM_WORKERS", 32)))
+codec = EmbeddingCodec(os.getenv("EMBEDDING_STORAGE", "full"), (os.getenv("EMBEDDING_PRIMARY_FIELD", "image_embedding_field"),),
+                      int(os.getenv("EMBEDDING_TRUNCATE_DIMENSION", 256)))
+db = DBService(project_id, firestore_collection, codec=codec, policy=policies["firestore"])
+db2 = DBService(project_id, target_collection, codec=codec, policy=policies["firestore"])
 
 
 def save_last_document_id(last_document_id: str, file_path: str = "docs/last_document"):
-    with open(file_path, 'w') as f:
-        f.write(last_document_id)
+    _write_atomic(file_path, last_document_id)
 
 
 def load_last_document_id(file_path: str = "docs/last_document") -> str:
@@ -32,81 +80,321 @@ def load_last_document_id(file_path: str = "docs/last_document") -> str:
     return None
 
 
-def load_data_from_file(filename):
-    data = {}
-    with open(filename, 'r') as f:
-        for line in f:
-            entry = json.loads(line)
-            data.update(entry)
-    return data
+def _write_atomic(file_path: str, content: str):
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, file_path)
+
 
+_companies_with_albums: CompanyStore | dict = None
+_companies_lock = threading.Lock()
 
-companies_with_albums = load_data_from_file("data/companies_with_albums.json")
+
+def companies_with_albums() -> CompanyStore | dict:
+    """
+    The company and album of every image ID, opened on first use rather than when the module is imported.
+    """
+    global _companies_with_albums
+    if _companies_with_albums is None:
+        with _companies_lock:
+            if _companies_with_albums is None:
+                _companies_with_albums = open_company_mapping(companies_path)
+    return _companies_with_albums
 
 
 def find_image(image_id_query):
-    return companies_with_albums.get(image_id_query, None)
+    return companies_with_albums().get(image_id_query, None)
 
 
-if __name__ == "__main__":
-    last_doc = load_last_document_id()
-    print(f"Last document ID: {last_doc}")
-    docs = db.get_documents(limit=limit, start_at=last_doc)
-    for doc in docs:
-        image_id = doc.imageId
+class Checkpoint:
+    """
+    Tracks committed work per document so a crashed run resumes where it stopped.
+
+    `last_document` is the page cursor, it only moves past a page once every document in it
+    is either committed or dead lettered. Documents committed in later pages are appended to
+    `committed` and skipped on restart.
+    """
+
+    def __init__(self, directory: str):
+        self._cursor_path = os.path.join(directory, "last_document")
+        self._committed_path = os.path.join(directory, "committed")
+        self.cursor = load_last_document_id(self._cursor_path)
+        self.committed = set()
+        if os.path.exists(self._committed_path):
+            with open(self._committed_path, 'r') as f:
+                self.committed = {line.strip() for line in f if line.strip()}
+        # Pages in fetch order as (last document ID, every ID in the page, IDs still in flight).
+        self._pages: list[tuple[str, set[str], set[str]]] = []
+
+    def add_page(self, docs: list[ImageDocument]) -> set[str]:
+        """
+        Track a fetched page and return the IDs in it still to process. They are taken before the
+        cursor advances, which drops the IDs of a page committed whole from `committed`.
+        """
+        image_ids = {doc.imageId for doc in docs}
+        pending = image_ids - self.committed
+        self._pages.append((docs[-1].imageId, image_ids, set(pending)))
+        self._advance()
+        return pending
+
+    def commit(self, image_ids: list[str]):
+        # Documents retried from the dead letter file are not part of any page and need no record.
+        paged = [image_id for image_id in image_ids if any(image_id in page_ids for _, page_ids, _ in self._pages)]
+        self.committed.update(paged)
+        with open(self._committed_path, 'a') as f:
+            f.writelines(f"{image_id}\n" for image_id in paged)
+        self.settle(image_ids)
+
+    def settle(self, image_ids: list[str]):
+        for _, _, pending in self._pages:
+            pending.difference_update(image_ids)
+        self._advance()
+
+    def _advance(self):
+        moved = False
+        while self._pages and not self._pages[0][2]:
+            self.cursor, image_ids, _ = self._pages.pop(0)
+            # Committed IDs are only needed for pages the cursor has not moved past yet.
+            self.committed -= image_ids
+            moved = True
+        if not moved:
+            return
+
+        save_last_document_id(self.cursor, self._cursor_path)
+        _write_atomic(self._committed_path, "".join(f"{image_id}\n" for image_id in self.committed))
 
-        result = find_image(image_id)
-        if result:
-            doc.metadata.companyId = result["company_id"]
-            doc.metadata.albumId = result["album_id"]
 
-        image_path = f"gs://{doc.bucket}/{doc.imagePath}"
+class DeadLetter:
+    """
+    Append-only JSON lines file of documents that failed, retried with `--retry-dead-letter`.
+    """
 
+    def __init__(self, file_path: str):
+        self._path = file_path
+        self._retrying_path = f"{file_path}.retrying"
+
+    def add(self, image_id: str, error: Exception):
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        with open(self._path, 'a') as f:
+            f.write(json.dumps({
+                "imageId": image_id,
+                "error": str(error),
+                "time": datetime.datetime.now(datetime.UTC).isoformat(),
+            }) + "\n")
+
+    def take(self) -> list[str]:
+        """
+        Return the failed IDs for a retry. They are moved aside to `<file>.retrying` until done() is called,
+        IDs that fail again are added back to the file. A retry that did not finish is taken again.
+        """
+        if os.path.exists(self._path):
+            if os.path.exists(self._retrying_path):
+                with open(self._path, 'r') as src, open(self._retrying_path, 'a') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self._path)
+            else:
+                os.replace(self._path, self._retrying_path)
+        if not os.path.exists(self._retrying_path):
+            return []
+        with open(self._retrying_path, 'r') as f:
+            return list(dict.fromkeys(json.loads(line)["imageId"] for line in f if line.strip()))
+
+    def done(self):
+        """
+        Drop the IDs taken for a retry once it has finished.
+        """
+        if os.path.exists(self._retrying_path):
+            os.remove(self._retrying_path)
+
+
+async def enrich_document(doc: ImageDocument) -> ImageDocument:
+    result = find_image(doc.imageId)
+    if result:
+        doc.metadata.companyId = result["company_id"]
+        doc.metadata.albumId = result["album_id"]
+
+    image_path = f"gs://{doc.bucket}/{doc.imagePath}"
+
+    if not doc.perceptualHash:
         try:
-            props = ai.image_properties(image_path=image_path)
-            if not doc.imageDescription:
-                doc.imageDescription = props.description
-            if not doc.metadata.labels:
-                doc.metadata.labels = props.labels
-            if not doc.metadata.color_weights:
-                doc.metadata.color_weights = props.colors
-
-            text = doc.imageDescription + " " + ", ".join(doc.metadata.labels)
-            if not doc.text_embedding_field or not doc.image_embedding_field:
-                text_embedding_512, image_embedding_512 = ai.get_embeddings(image_path, text, 512)
-
-                # Ensure embeddings are not empty
-                if not text_embedding_512 or not text_embedding_512:
-                    print(f"Skipping document {doc.imageId} due to empty embeddings")
-                    continue
+            hashes = await asyncio.to_thread(gcs_image_hashes, image_path)
+            doc.perceptualHash, doc.differenceHash = hashes.perceptualHash, hashes.differenceHash
+        except Exception as e:
+            # Only used to find near-duplicates, the document is still worth enriching without them.
+            print(f"An error occurred while hashing {image_path}: {e}")
+
+    props = await ai.image_properties_async(image_path)
+    if not doc.imageDescription:
+        doc.imageDescription = props.description
+    if not doc.metadata.labels:
+        doc.metadata.labels = props.labels
+    if not doc.metadata.color_weights:
+        doc.metadata.color_weights = props.colors
+
+    text = doc.imageDescription + " " + ", ".join(doc.metadata.labels)
+    # Uploads whose embedding failed stored an empty vector, read back as a 0-length array.
+    missing = [target for target, field in EMBEDDING_FIELDS.items()
+               if getattr(doc, field) is None or getattr(doc, field).size == 0]
+    if missing:
+        # One embedding call per missing dimension, covering both modalities
+        embeddings = await ai.embed_async(image_path, text, missing)
 
-                doc.text_embedding_field = Vector(text_embedding_512)
-                doc.image_embedding_field = Vector(image_embedding_512)
+        # Ensure embeddings are not empty
+        if not embeddings.has(missing):
+            raise EmptyEmbeddingError("empty embeddings")
 
-            if not doc.text_embedding_field_1408 or not doc.image_embedding_field_1408:
-                text_embedding_1408, image_embedding_1408 = ai.get_embeddings(image_path, text, 1408)
+        for field, vector in embeddings.vectors().items():
+            setattr(doc, field, vector)
 
-                if not text_embedding_1408 or not image_embedding_1408:
-                    print(f"Skipping document {doc.imageId} due to empty embeddings")
+    very_likely = "VERY_LIKELY"
+    safe_search_flags = [
+        props.safe_search.adult,
+        props.safe_search.spoof,
+        props.safe_search.medical,
+        props.safe_search.violence,
+        props.safe_search.racy
+    ]
+    doc.valid = all(flag != very_likely for flag in safe_search_flags)
+    return doc
+
+
+class Rehydrator:
+    """
+    Pipelined rehydrate: a page fetcher feeds a bounded pool of enrichment workers,
+    which feed a single writer committing documents in batches.
+    """
+
+    def __init__(self, checkpoint: Checkpoint, dead_letter: DeadLetter, workers: int, batch: int, flush_interval: float):
+        self._checkpoint = checkpoint
+        self._dead_letter = dead_letter
+        self._workers = workers
+        self._batch = batch
+        self._flush_interval = flush_interval
+        self._enrich_queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+        self._write_queue: asyncio.Queue = asyncio.Queue(maxsize=batch * 2)
+        self.stats = {"fetched": 0, "committed": 0, "failed": 0, "skipped": 0}
+
+    async def fetch_pages(self, max_documents: int, size: int):
+        cursor = self._checkpoint.cursor
+        print(f"Last document ID: {cursor}")
+        while not max_documents or self.stats["fetched"] < max_documents:
+            count = min(size, max_documents - self.stats["fetched"]) if max_documents else size
+            docs = await asyncio.to_thread(db.get_documents, limit=count, start_at=cursor)
+            if not docs:
+                break
+
+            self.stats["fetched"] += len(docs)
+            pending = self._checkpoint.add_page(docs)
+            cursor = docs[-1].imageId
+            for doc in docs:
+                if doc.imageId not in pending:
+                    self.stats["skipped"] += 1
                     continue
+                await self._enrich_queue.put(doc)
+
+            if len(docs) < count:
+                break
+
+    async def fetch_ids(self, image_ids: list[str]):
+        for image_id in image_ids:
+            try:
+                doc = await asyncio.to_thread(db.get_document_by_id, image_id)
+                if doc is None:
+                    raise Exception("document not found")
+            except Exception as e:
+                self._fail(image_id, e)
+                continue
+            self.stats["fetched"] += 1
+            await self._enrich_queue.put(doc)
+
+    def _fail(self, image_id: str, error: Exception):
+        print(f"An error occurred while processing document {image_id}: {error}")
+        self.stats["failed"] += 1
+        self._dead_letter.add(image_id, error)
+        self._checkpoint.settle([image_id])
+
+    async def _enrich(self):
+        while (doc := await self._enrich_queue.get()) is not None:
+            try:
+                await self._write_queue.put(await enrich_document(doc))
+            except Exception as e:
+                self._fail(doc.imageId, e)
+
+    async def _write(self):
+        # Flush when the batch is full or `flush_interval` after its first document, whichever is first.
+        docs = []
+        while True:
+            try:
+                doc = await asyncio.wait_for(self._write_queue.get(), self._flush_interval if docs else None)
+            except asyncio.TimeoutError:
+                await self._commit(docs)
+                docs = []
+                continue
+
+            if doc is None:
+                break
+            docs.append(doc)
+            if len(docs) >= self._batch:
+                await self._commit(docs)
+                docs = []
+
+        if docs:
+            await self._commit(docs)
 
-                doc.text_embedding_field_1408 = Vector(text_embedding_1408)
-                doc.image_embedding_field_1408 = Vector(image_embedding_1408)
-
-            very_likely = "VERY_LIKELY"
-            safe_search_flags = [
-                props.safe_search.adult,
-                props.safe_search.spoof,
-                props.safe_search.medical,
-                props.safe_search.violence,
-                props.safe_search.racy
-            ]
-            doc.valid = all(flag != very_likely for flag in safe_search_flags)
-            db2.update_document(doc)
-            print(f"Updated document {doc.imageId}")
+    async def _commit(self, docs: list[ImageDocument]):
+        try:
+            results = await asyncio.to_thread(db2.bulk_write, docs, self._batch)
         except Exception as e:
-            print(f"An error occurred while processing document {doc.imageId}: {e}")
-            continue  # Skip to the next document if an error occurs
+            for doc in docs:
+                self._fail(doc.imageId, e)
+            return
+
+        committed = [result.imageId for result in results if result.success]
+        for result in results:
+            if not result.success:
+                self._fail(result.imageId, Exception(f"write failed after {result.attempts} attempts: {result.error}"))
+        self._checkpoint.commit(committed)
+        self.stats["committed"] += len(committed)
+        print(f"Updated {len(committed)} documents, {self.stats['committed']} so far")
+
+    async def run(self, source):
+        writer = asyncio.create_task(self._write())
+        workers = [asyncio.create_task(self._enrich()) for _ in range(self._workers)]
+
+        await source
+        for _ in workers:
+            await self._enrich_queue.put(None)
+        await asyncio.gather(*workers)
+        await self._write_queue.put(None)
+        await writer
+        return self.stats
+
+
+async def main(args: list[str]):
+    # Read off the event loop, before the workers look up the first image.
+    with profile.phase("companies"):
+        await asyncio.to_thread(companies_with_albums)
+    print(f"Startup: {json.dumps(profile.report())}")
 
-    if docs:
-        save_last_document_id(last_document_id=docs[-1].imageId)
+    checkpoint = Checkpoint(checkpoint_dir)
+    dead_letter = DeadLetter(os.path.join(checkpoint_dir, "dead_letter.jsonl"))
+    rehydrator = Rehydrator(checkpoint, dead_letter, concurrency, batch_size, flush_interval)
+
+    start = time.perf_counter()
+    if "--retry-dead-letter" in args:
+        stats = await rehydrator.run(rehydrator.fetch_ids(dead_letter.take()))
+        dead_letter.done()
+    else:
+        stats = await rehydrator.run(rehydrator.fetch_pages(limit, page_size))
+    print(f"Finished in {time.perf_counter() - start:.1f}s: {stats}")
+    if telemetry.enabled():
+        print(f"Upstream calls: {json.dumps(telemetry.summary(), indent=2)}")
+    print(f"Upstreams: {json.dumps({name: policy.report() for name, policy in policies.items()}, indent=2)}")
+
+
+profile.mark("import")
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -1,24 +1,222 @@
-from fastapi import APIRouter, Response, UploadFile, File, HTTPException
-from services.database import DBService, ImageDocument, Metadata
+from fastapi import APIRouter, Response, UploadFile, File, Form, HTTPException, Query
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from services.database import DBService, DocumentFilter, ImageDocument, Metadata
+from services.dependencies import Dependencies
 from services.ai import AIService
+from services.cache import create_enrichment_cache
 from services.images import ImageService
+from services.ingest import (BatchItemResult, BatchReport, IngestStatus, IngestWorker, apply_duplicate, apply_enrichment,
+                             document_hashes, find_duplicate, load_duplicates)
+from services.lru import DiskLRUCache
+from services.phash import DuplicateIndex, ImageHashes, image_hashes
+from services.queue import WorkQueue, create_queue, DONE, FAILED, QUEUED
+from services.variants import VariantService, parse_variants
+from routes import symantic
 from config import settings
 import utils
-from google.cloud.firestore_v1.vector import Vector
+from typing import Literal, Optional
+import asyncio
 import datetime
+import json
+import time
 
 router = APIRouter()
-db = DBService(settings.project_id, settings.firestore_collection)
-ai = AIService(settings.project_id, settings.region)
-image = ImageService()
+# Built on first use or by the warm up at startup, not when the module is imported.
+deps = Dependencies()
 
 
-@router.get("", response_model=list[ImageDocument], summary="Retrieve all images", description="Get a list of all images stored in the database.")
-async def get_images():
+@deps.provider("db")
+def _db() -> DBService:
+    return DBService(settings.project_id, settings.firestore_collection, settings.doc_cache_size, settings.doc_cache_ttl,
+                     settings.doc_cache_negative_ttl, symantic.deps.codec, symantic.deps.policies["firestore"])
+
+
+@deps.provider("ai")
+def _ai() -> AIService:
+    return AIService(settings.project_id, settings.region, create_enrichment_cache(
+        settings.enrichment_cache,
+        project_id=settings.project_id,
+        path=settings.enrichment_cache_path,
+        max_mb=settings.enrichment_cache_max_mb,
+        collection=settings.enrichment_cache_collection,
+    ), settings.color_naming, policies=symantic.deps.policies, partial=settings.partial_enrichment,
+                     executor=symantic.deps.executor)
+
+
+@deps.provider("image")
+def _image() -> ImageService:
+    return ImageService(settings.serving_url_base)
+
+
+@deps.provider("variants")
+def _variants() -> VariantService:
+    return VariantService(parse_variants(settings.image_variants), settings.variant_workers or None)
+
+
+@deps.provider("variant_cache")
+def _variant_cache() -> DiskLRUCache:
+    return DiskLRUCache(settings.variant_cache_dir, settings.variant_cache_max_mb * 1024 * 1024)
+
+
+@deps.provider("duplicates")
+def _duplicates() -> DuplicateIndex:
+    # Near-duplicates of the stored images, loaded at startup when their enrichment is reused.
+    return DuplicateIndex(settings.dedupe_radius)
+
+
+@deps.provider("queue")
+def _queue() -> WorkQueue:
+    return create_queue(
+        settings.ingest_queue,
+        project_id=settings.project_id,
+        path=settings.ingest_queue_path,
+        collection=settings.ingest_queue_collection,
+        retention_seconds=settings.ingest_queue_retention,
+        max_finished=settings.ingest_queue_max_finished,
+    )
+
+
+def _on_stored(image_id: str, doc: ImageDocument):
+    symantic.deps.db.index_document(image_id, doc)
+    if settings.dedupe_reuse and (hashes := document_hashes(doc)):
+        deps.duplicates.add(image_id, hashes)
+    # A re-uploaded image replaces its variants, drop the copies served from the disk cache.
+    for spec in deps.variants.specs.values():
+        deps.variant_cache.delete(_variant_key(image_id, spec.name, spec.format))
+
+
+def _variant_key(image_id: str, name: str, fmt: str) -> str:
+    return f"{image_id}/{name}.{fmt}"
+
+
+@deps.provider("worker")
+def _worker() -> IngestWorker:
+    return IngestWorker(deps.queue, deps.ai, deps.db, settings.ingest_workers, settings.ingest_max_attempts, on_complete=_on_stored,
+                        variants=deps.variants, duplicates=deps.duplicates if settings.dedupe_reuse else None)
+
+
+async def _hash(file: Optional[UploadFile]) -> Optional[ImageHashes]:
+    # Hashed from the spooled upload, only its 64x64 draft is decoded.
+    if file is None:
+        return None
+    try:
+        return await asyncio.to_thread(image_hashes, file.file)
+    except Exception as e:
+        print(f"An error occurred while hashing an image: {e}")
+        return None
+
+
+async def _find_duplicate(image_id: str, hashes: Optional[ImageHashes]) -> Optional[ImageDocument]:
+    if not settings.dedupe_reuse:
+        return None
+    return await run_in_threadpool(find_duplicate, deps.db, deps.duplicates, image_id, hashes)
+
+
+@router.get("", response_model=list[ImageDocument], summary="Retrieve a page of images", description="Get a page of the images stored in the database, optionally filtered.")
+async def get_images(
+    response: Response,
+    limit: int = Query(1000, ge=1, le=1000),
+    page_token: str = None,
+    include_vectors: bool = False,
+    format: Literal["json", "ndjson"] = "json",
+    companyId: Optional[str] = None,
+    albumId: Optional[str] = None,
+    valid: Optional[bool] = None,
+    published: Optional[bool] = None,
+    label: Optional[str] = None,
+    createdAfter: Optional[datetime.datetime] = None,
+    createdBefore: Optional[datetime.datetime] = None,
+):
+    """
+    Retrieve a page of images.
+    - **limit**: The maximum number of images to return.
+    - **page_token**: The token of the page to return, taken from a previous page with the same filters.
+    - **include_vectors**: Include the embedding vectors, they are left out by default.
+    - **format**: `json` returns a list with the next page token in the `X-Next-Page-Token` header.
+      `ndjson` streams one image per line, followed by a `{"nextPageToken": ...}` line when there are more images.
+    - **companyId**, **albumId**, **valid**, **published**: Only return images matching these values.
+    - **label**: Only return images with this label.
+    - **createdAfter**, **createdBefore**: Only return images created from `createdAfter` and before `createdBefore`.
+    - Filtered images are returned newest first, unfiltered images in the order of their IDs.
+    """
+    filters = DocumentFilter(companyId=companyId, albumId=albumId, valid=valid, published=published, label=label,
+                             createdAfter=createdAfter, createdBefore=createdBefore)
+    try:
+        cursor = deps.db.decode_page_token(page_token) if page_token else None
+        documents = deps.db.query_documents(filters, limit, cursor, include_vectors)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if format == "ndjson":
+        return StreamingResponse(_stream_images(documents, limit), media_type="application/x-ndjson")
+
+    page = await run_in_threadpool(list, documents)
+    if len(page) == limit:
+        document_id, doc = page[-1]
+        response.headers["X-Next-Page-Token"] = deps.db.encode_page_token(document_id, doc.timeCreated)
+    return [doc for _, doc in page]
+
+
+async def _stream_images(documents, limit: int):
+    count, last = 0, None
+    async for document_id, doc in iterate_in_threadpool(documents):
+        count, last = count + 1, (document_id, doc.timeCreated)
+        yield doc.model_dump_json() + "\n"
+
+    if count == limit:
+        yield json.dumps({"nextPageToken": deps.db.encode_page_token(*last)}) + "\n"
+
+
+@router.get("/count", summary="Count images", description="Count the images matching the filters without reading them.")
+async def count_images(
+    companyId: Optional[str] = None,
+    albumId: Optional[str] = None,
+    valid: Optional[bool] = None,
+    published: Optional[bool] = None,
+    label: Optional[str] = None,
+    createdAfter: Optional[datetime.datetime] = None,
+    createdBefore: Optional[datetime.datetime] = None,
+):
+    """
+    Count images.
+    - The filters are the same as for retrieving a page of images, no filter counts every image.
+    """
+    filters = DocumentFilter(companyId=companyId, albumId=albumId, valid=valid, published=published, label=label,
+                             createdAfter=createdAfter, createdBefore=createdBefore)
+    return {"count": await run_in_threadpool(deps.db.count_documents, filters)}
+
+
+@router.get("/ingest/stats", summary="Ingestion queue statistics", description="Get the depth of the ingestion queue and the enrichment latency.")
+async def get_ingest_stats():
+    """
+    Ingestion queue statistics.
+    - **queue**: Jobs per status and the retries of the jobs in the queue.
+    - **workers**: Completed, retried and failed jobs with latency percentiles in seconds, for the workers of this instance.
+    """
+    return {"queue": await run_in_threadpool(deps.queue.stats), "workers": deps.worker.stats()}
+
+
+@router.get("/cache/stats", summary="Document cache statistics", description="Get the hit and miss counts of the document cache.")
+async def get_cache_stats():
+    """
+    Document cache statistics for this instance.
+    - **size**: The number of cached documents, including cached misses.
+    - **hits**, **misses**: Reads served from the cache and reads that went to Firestore.
     """
-    Retrieve all images.
+    return deps.db.cache_stats()
+
+
+@router.get("/upstreams/stats", summary="Upstream call statistics", description="Get the retries, timeouts and circuit state of every upstream.")
+async def get_upstream_stats():
+    """
+    Upstream call statistics for this instance, per upstream.
+    - **calls**, **retries**, **hedges**, **timeouts**: Calls made, extra attempts after a retryable error, hedged attempts and attempts that timed out.
+    - **rejected**: Calls failed fast while the circuit was open.
+    - **failed**: Calls that failed after their last attempt.
+    - **state**: The circuit state, `closed`, `open` or `half_open`.
     """
-    return db.get_documents()
+    return {name: policy.report() for name, policy in symantic.deps.policies.items()}
 
 
 @router.get("/{image_id}", response_model=ImageDocument, summary="Retrieve a single image by ID", description="Get details of an image using its ID.")
@@ -27,71 +225,242 @@ async def get_image(image_id: str):
     Retrieve a single image by ID.
     - **image_id**: The ID of the image to retrieve.
     """
-    doc = db.get_document_by_id(image_id)
+    doc = await run_in_threadpool(deps.db.get_document_by_id, image_id)
     if not doc:
         raise HTTPException(status_code=404, detail="Image not found")
     return doc
 
 
+@router.get("/{image_id}/status", response_model=IngestStatus, summary="Ingestion status of an image", description="Get the enrichment status of an image ingested asynchronously.")
+async def get_image_status(image_id: str):
+    """
+    Ingestion status of an image.
+    - **image_id**: The ID returned when the image was uploaded.
+    """
+    job = await run_in_threadpool(deps.queue.get, image_id)
+    doc = await run_in_threadpool(deps.db.get_document_by_id, image_id)
+    if not job and not doc:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if not job:
+        # Ingested synchronously, or the job finished and was purged from the queue after INGEST_QUEUE_RETENTION
+        # seconds. Images stored before the status was kept on the document are done once they have labels.
+        status = doc.ingestStatus or (DONE if doc.metadata.labels else FAILED)
+        return IngestStatus(imageId=image_id, status=status, error=doc.ingestError, valid=doc.valid)
+    return IngestStatus(
+        imageId=image_id,
+        status=job.status,
+        attempts=job.attempts,
+        error=job.error,
+        valid=doc.valid if doc else None,
+        enqueuedAt=job.enqueuedAt,
+        startedAt=job.startedAt,
+        finishedAt=job.finishedAt,
+    )
+
+
+@router.get("/{image_id}/variants/{name}", response_class=FileResponse, summary="Retrieve a resized variant of an image", description="Get a resized variant of an image, served from a local disk cache.")
+async def get_image_variant(image_id: str, name: str):
+    """
+    Retrieve a resized variant of an image.
+    - **image_id**: The ID of the image.
+    - **name**: The name of the variant, one of the configured `IMAGE_VARIANTS` such as `thumb`, `small`, `medium` or `large`.
+    Variants missing on images stored before they were configured are generated on the first request.
+    """
+    spec = deps.variants.specs.get(name)
+    if spec is None:
+        raise HTTPException(status_code=404, detail="Variant not found")
+
+    key = _variant_key(image_id, name, spec.format)
+    path = deps.variant_cache.get(key)
+    if path is None:
+        doc = await run_in_threadpool(deps.db.get_document_by_id, image_id)
+        if not doc:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        variant = next((item for item in doc.variants or [] if item.name == name and item.format == spec.format), None)
+        if variant is None:
+            image_path = doc.imagePath if doc.imagePath.startswith(f"{doc.bucket}/") else f"{doc.bucket}/{doc.imagePath}"
+            variant = (await deps.variants.generate(image_path, names=[name]))[0]
+            doc.variants = [item for item in doc.variants or [] if item.name != name] + [variant]
+            try:
+                await run_in_threadpool(deps.db.update_document, doc)
+            except Exception as e:
+                # The variant is stored either way, it is only generated again on a later request.
+                print(f"Could not record variant {name} of {image_id}: {e}")
+
+        data = await run_in_threadpool(deps.variants.download, variant.path)
+        path = await run_in_threadpool(deps.variant_cache.set, key, data)
+
+    return FileResponse(path, media_type=spec.content_type, headers={"Cache-Control": "public, max-age=86400"})
+
+
 @router.post("", status_code=201, summary="Process and store an image", description="Upload, process, and store an image.")
-async def process_images(file: UploadFile = File(...), image_name: str = None) -> Response:
+async def process_images(file: UploadFile = File(...), image_name: str = None, mode: Literal["sync", "async"] = None) -> Response:
     """
     Process and store an image.
     - **file**: The image file to upload.
     - **image_name**: The name of the image. If not provided, the filename of the uploaded file will be used.
+    - **mode**: `sync` enriches the image before responding with 201. `async` stores the image with `valid` set to false,
+      queues the enrichment and responds with 202 and the image ID, poll `/images/{image_id}/status` for the outcome.
+      Defaults to the `INGEST_MODE` setting.
+
+    With `DEDUPE_REUSE` on, an image within `DEDUPE_RADIUS` bits of an enriched image reuses its properties and
+    embeddings instead of being enriched, the response names that image in the `X-Duplicate-Of` header.
     """
     if image_name is None:
         image_name = file.filename
 
-    image_path = await utils.save_to_gcs(file, image_name)
+    upload = await utils.save_to_gcs(file, image_name)
+    image_path = upload.path
     prefix_image_path = f"gs://{image_path}"
-    props = ai.image_properties(prefix_image_path)
-    height, width = utils.get_image_dimensions(file)
-    serving_url = image.get_serving_url(image_path)
-    text_embeddings_512 = ai.get_embeddings(prefix_image_path, props.description, 512)
-    image_embeddings_512 = ai.get_embeddings(prefix_image_path, props.description, 512)
-    text_embeddings_1408 = ai.get_embeddings(prefix_image_path, props.description, 1408)
-    image_embeddings_1408 = ai.get_embeddings(prefix_image_path, props.description, 1408)
-
-    very_likely = "VERY_LIKELY"
-    safe_search_flags = [
-        props.safe_search.adult,
-        props.safe_search.spoof,
-        props.safe_search.medical,
-        props.safe_search.violence,
-        props.safe_search.racy
-    ]
-
-    doc = ImageDocument(
-        imageId=db.encode_image_id(image_name),
-        imagePath=image_path,
+    hashes = await _hash(file)
+
+    if (mode or settings.ingest_mode) == "async":
+        serving_url = await asyncio.to_thread(deps.image.get_serving_url, image_path)
+        doc = _new_document(image_name, upload, serving_url, hashes)
+        doc.ingestStatus = QUEUED
+        try:
+            await run_in_threadpool(deps.db.add_document, doc)
+            job = await run_in_threadpool(deps.queue.enqueue, doc.imageId, {"imageUri": prefix_image_path, "digest": upload.digest})
+        except Exception as e:
+            return Response(status_code=500, content=f"An error occurred: {e}")
+        return JSONResponse(
+            status_code=202,
+            content={"imageId": doc.imageId, "status": job.status},
+            headers={"Location": f"/images/{doc.imageId}/status"},
+        )
+
+    source = await _find_duplicate(deps.db.encode_image_id(image_name), hashes)
+    enrichment, serving_url, generated = await asyncio.gather(
+        deps.ai.enrich(prefix_image_path, digest=upload.digest) if source is None else asyncio.sleep(0),
+        asyncio.to_thread(deps.image.get_serving_url, image_path),
+        deps.variants.generate_or_none(image_path, file.file),
+    )
+    doc = _new_document(image_name, upload, serving_url, hashes)
+    doc = apply_enrichment(doc, enrichment) if source is None else apply_duplicate(doc, source)
+    doc.variants = generated
+
+    try:
+        await run_in_threadpool(deps.db.add_document, doc)
+    except Exception as e:
+        return Response(status_code=500, content=f"An error occurred: {e}")
+    _on_stored(doc.imageId, doc)
+
+    if source is not None:
+        return Response(status_code=201, headers={"X-Duplicate-Of": source.imageId})
+    server_timing = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in enrichment.timings.items())
+    return Response(status_code=201, headers={"Server-Timing": server_timing})
+
+
+@router.post("/batch", response_model=BatchReport, summary="Process and store many images", description="Upload or import, process, and store a batch of images.")
+async def process_batch(
+    response: Response,
+    files: Optional[list[UploadFile]] = File(None),
+    uris: Optional[list[str]] = Form(None),
+    companyId: Optional[str] = Form(None),
+    albumId: Optional[str] = Form(None),
+):
+    """
+    Process and store a batch of images, the report has one result per image in the order they were given.
+    - **files**: Image files to upload, named after their filename.
+    - **uris**: `gs://` URIs of images already stored in the bucket, named after their object name.
+    - **companyId**, **albumId**: Set on the metadata of every image in the batch.
+    """
+    sources = [(file.filename, file) for file in files or []] + [(uri, None) for uri in uris or []]
+    if not sources:
+        raise HTTPException(status_code=400, detail="No files or uris given")
+    if len(sources) > settings.batch_max_images:
+        raise HTTPException(status_code=400, detail=f"A batch takes at most {settings.batch_max_images} images")
+
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(settings.batch_concurrency)
+
+    async def store(source: str, file: Optional[UploadFile]) -> tuple[ImageDocument, utils.UploadResult]:
+        async with semaphore:
+            if file is not None:
+                image_name = source
+                upload = await utils.save_to_gcs(file, image_name)
+            else:
+                upload = await utils.describe_gcs_object(source)
+                image_name = upload.path.partition("/")[2]
+            serving_url, generated = await asyncio.gather(
+                asyncio.to_thread(deps.image.get_serving_url, upload.path),
+                deps.variants.generate_or_none(upload.path, file.file if file is not None else None),
+            )
+        doc = _new_document(image_name, upload, serving_url, await _hash(file))
+        doc.variants = generated
+        doc.metadata.companyId = companyId
+        doc.metadata.albumId = albumId
+        return doc, upload
+
+    stored = await asyncio.gather(*(store(source, file) for source, file in sources), return_exceptions=True)
+
+    results = [BatchItemResult(source=source, success=False) for source, _ in sources]
+    staged, seen = [], set()
+    for i, item in enumerate(stored):
+        if isinstance(item, Exception):
+            results[i].error = str(item)
+        elif item[0].imageId in seen:
+            results[i].imageId, results[i].error = item[0].imageId, "Duplicate image in the batch"
+        else:
+            seen.add(item[0].imageId)
+            results[i].imageId = item[0].imageId
+            staged.append((i, *item))
+
+    # Only the near-duplicates of images stored before the batch are reused, not those of each other.
+    found = await asyncio.gather(*(_find_duplicate(doc.imageId, document_hashes(doc)) for _, doc, _ in staged))
+    docs = [(i, apply_duplicate(doc, source)) for (i, doc, _), source in zip(staged, found) if source is not None]
+    staged = [item for item, source in zip(staged, found) if source is None]
+
+    enrichments = await deps.ai.enrich_batch([(f"gs://{upload.path}", upload.digest) for _, _, upload in staged],
+                                        concurrency=settings.batch_concurrency)
+    for (i, doc, _), enrichment in zip(staged, enrichments):
+        if isinstance(enrichment, Exception):
+            results[i].error = str(enrichment)
+        else:
+            docs.append((i, apply_enrichment(doc, enrichment)))
+
+    if docs:
+        try:
+            writes = await run_in_threadpool(deps.db.bulk_write, [doc for _, doc in docs])
+        except Exception as e:
+            writes = [None] * len(docs)
+            for i, _ in docs:
+                results[i].error = f"An error occurred: {e}"
+        for (i, doc), write in zip(docs, writes):
+            if write is None:
+                continue
+            results[i].success, results[i].error = write.success, write.error
+            if write.success:
+                results[i].valid = doc.valid
+                _on_stored(doc.imageId, doc)
+
+    succeeded = sum(result.success for result in results)
+    response.headers["Server-Timing"] = f"total;dur={(time.perf_counter() - start) * 1000:.1f}"
+    return BatchReport(succeeded=succeeded, failed=len(results) - succeeded, results=results)
+
+
+def _new_document(image_name: str, upload: utils.UploadResult, serving_url: str,
+                  hashes: ImageHashes = None) -> ImageDocument:
+    # Skeleton document of a stored image, it stays invalid until it has been enriched.
+    return ImageDocument(
+        imageId=deps.db.encode_image_id(image_name),
+        imagePath=upload.path,
         bucket=settings.bucket,
-        imageName=image_path.split("/")[-1],
-        imageDescription=props.description,
+        imageName=upload.path.split("/")[-1],
         imageUrl=serving_url,
+        perceptualHash=hashes.perceptualHash if hashes else None,
+        differenceHash=hashes.differenceHash if hashes else None,
         published=False,
+        valid=False,
         timeCreated=datetime.datetime.now(datetime.UTC),
         timeUpdated=datetime.datetime.now(datetime.UTC),
-        text_embedding_field=Vector(text_embeddings_512),
-        image_embedding_field=Vector(image_embeddings_512),
-        text_embedding_field_1480=Vector(text_embeddings_1408),
-        image_embedding_field_1480=Vector(image_embeddings_1408),
-        valid=all(flag != very_likely for flag in safe_search_flags),
         metadata=Metadata(
-            height=height,
-            width=width,
-            labels=props.labels,
-            color_weights=props.colors,
+            height=upload.height,
+            width=upload.width,
         )
     )
 
-    try:
-        db.add_document(doc)
-    except Exception as e:
-        return Response(status_code=500, content=f"An error occurred: {e}")
-
-    return Response(status_code=201)
-
 
 @router.delete("/{image_id}", status_code=204, summary="Delete an image by ID", description="Delete an image and its associated data using its ID.")
 async def delete_image(image_id: str):
@@ -99,9 +468,14 @@ async def delete_image(image_id: str):
     Delete an image by ID.
     - **image_id**: The ID of the image to delete.
     """
-    doc = db.get_document_by_id(image_id)
+    doc = await run_in_threadpool(deps.db.get_document_by_id, image_id)
     if not doc:
         raise HTTPException(status_code=404, detail="Image not found")
-    image.delete_serving_url(doc.imagePath)
-    db.delete_document(image_id)
+    await asyncio.to_thread(deps.image.delete_serving_url, doc.imagePath)
+    await run_in_threadpool(deps.db.delete_document, image_id)
+    symantic.deps.db.unindex_document(image_id)
+    deps.duplicates.remove(image_id)
+    await run_in_threadpool(deps.variants.delete, doc.variants)
+    for variant in doc.variants or []:
+        deps.variant_cache.delete(_variant_key(image_id, variant.name, variant.format))
     return Response(status_code=204)
@@ -1,13 +1,130 @@
-from fastapi import APIRouter, Request, Response
-from services.vector import VectorSearchService
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Query
+from starlette.concurrency import run_in_threadpool
+from services.ai import AIService
+from services.database import EMBEDDING_FIELDS
+from services.dependencies import Dependencies
+from services.quantize import EmbeddingCodec
+from services.resilience import Policy, create_policies
+from services.vector import VectorSearchService, SearchResult
 from config import settings
+from typing import Literal, Optional
 
 router = APIRouter()
-db = VectorSearchService(settings.project_id, settings.firestore_collection)
+# Built on first use or by the warm up at startup, not when the module is imported.
+deps = Dependencies()
 
 
-@router.get("")
-async def get_images(req: Request) -> Response:
-    docs = db.get_documents(limit=1)
-    print(docs)
-    return db.find_nearest(limit=5)
+@deps.provider("codec")
+def _codec() -> EmbeddingCodec:
+    return EmbeddingCodec(settings.embedding_storage, (settings.embedding_primary_field,), settings.embedding_truncate_dimension)
+
+
+@deps.provider("policies")
+def _policies() -> dict[str, Policy]:
+    # Shared with the image routes, so every call to an upstream goes through the same circuit breaker.
+    return create_policies(
+        {
+            "vision": settings.vision_timeout,
+            "gemini": settings.gemini_timeout,
+            "embedding": settings.embedding_timeout,
+            "firestore": settings.firestore_timeout,
+        },
+        settings.upstream_attempts,
+        hedge_after={"embedding": settings.embedding_hedge_after},
+        failure_threshold=settings.circuit_failure_threshold,
+        reset_timeout=settings.circuit_reset_seconds,
+    )
+
+
+@deps.provider("db")
+def _db() -> VectorSearchService:
+    return VectorSearchService(settings.project_id, settings.firestore_collection, settings.ann_index_dir, deps.codec,
+                               deps.policies["firestore"], settings.ann_index_max_age)
+
+
+@deps.provider("executor")
+def _executor() -> ThreadPoolExecutor:
+    # Threads of the Vision, Gemini and embedding calls, shared by the AI services of both routers.
+    return ThreadPoolExecutor(settings.upstream_workers, thread_name_prefix="upstream")
+
+
+@deps.provider("ai")
+def _ai() -> AIService:
+    return AIService(settings.project_id, settings.region, policies=deps.policies, executor=deps.executor)
+
+
+async def _search(text: Optional[str], image_bytes: Optional[bytes], dimension: int, modality: str, distance: str,
+                  limit: int, filters: dict) -> list[SearchResult]:
+    if (modality, dimension) not in EMBEDDING_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unsupported dimension {dimension}, use 512 or 1408")
+
+    from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
+    vector_field = EMBEDDING_FIELDS[(modality, dimension)]
+    primary_dimension = next(dim for (_, dim), field in EMBEDDING_FIELDS.items() if field == deps.codec.primary_fields[0])
+    try:
+        vector = await deps.ai.embed_query(text=text, image_bytes=image_bytes, dimension=dimension)
+        # Compactly stored fields are re-ranked from the candidates of the primary field.
+        primary_vector = None
+        if deps.db.compacts(vector_field):
+            primary_vector = await deps.ai.embed_query(text=text, image_bytes=image_bytes, dimension=primary_dimension)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return await run_in_threadpool(
+        deps.db.find_nearest,
+        vector,
+        limit=limit,
+        vector_field=vector_field,
+        distance_measure=DistanceMeasure[distance],
+        filters=filters,
+        primary_vector=primary_vector,
+    )
+
+
+@router.get("", response_model=list[SearchResult], summary="Search images by text", description="Find the images closest to a text query.")
+async def search_text(
+    query: str,
+    dimension: int = 512,
+    modality: Literal["text", "image"] = "image",
+    distance: Literal["DOT_PRODUCT", "COSINE", "EUCLIDEAN"] = "DOT_PRODUCT",
+    limit: int = Query(5, ge=1, le=1000),
+    valid: Optional[bool] = None,
+    published: Optional[bool] = None,
+    companyId: Optional[str] = None,
+    albumId: Optional[str] = None,
+):
+    """
+    Search images by text.
+    - **query**: The text to search for.
+    - **dimension**: The embedding dimension to search, 512 or 1408.
+    - **modality**: Search the image embeddings or the text embeddings of the stored images.
+    - **distance**: The distance measure, must match the vector index of the searched field.
+    - **valid**, **published**, **companyId**, **albumId**: Only search images matching these values.
+    """
+    filters = {"valid": valid, "published": published, "companyId": companyId, "albumId": albumId}
+    return await _search(query, None, dimension, modality, distance, limit, filters)
+
+
+@router.post("", response_model=list[SearchResult], summary="Search images by text or image", description="Find the images closest to a text query or an uploaded image.")
+async def search(
+    query: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    dimension: int = 512,
+    modality: Literal["text", "image"] = "image",
+    distance: Literal["DOT_PRODUCT", "COSINE", "EUCLIDEAN"] = "DOT_PRODUCT",
+    limit: int = Query(5, ge=1, le=1000),
+    valid: Optional[bool] = None,
+    published: Optional[bool] = None,
+    companyId: Optional[str] = None,
+    albumId: Optional[str] = None,
+):
+    """
+    Search images by text or image.
+    - **query**: The text to search for.
+    - **file**: An image to search for, instead of a text query.
+    - The other parameters are the same as for the text search.
+    """
+    image_bytes = await file.read() if file else None
+    filters = {"valid": valid, "published": published, "companyId": companyId, "albumId": albumId}
+    return await _search(query, image_bytes, dimension, modality, distance, limit, filters)
@@ -1,10 +1,22 @@
-from google.cloud import vision
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
-from vertexai.vision_models import Image, MultiModalEmbeddingModel
-from services.database import ColorWeight
+from services import clients, resilience, telemetry
+from services.cache import EnrichmentCache, content_digest, gcs_content_digest, text_digest
+from services.colors import COLOR_NAMING_VERSION, name_colors
+from services.lru import LRUCache
+from services.rate_limit import TokenBucket
+from services.database import ColorWeight, EMBEDDING_FIELDS
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
 import json
+import time
 from pydantic import BaseModel
+from typing import TYPE_CHECKING, Optional
+
+# Vision, vertexai and Firestore are imported on first use, they take seconds to import.
+if TYPE_CHECKING:
+    from google.cloud import vision
+    from google.cloud.firestore_v1.vector import Vector
 
 
 class SafeSearch(BaseModel):
@@ -19,35 +31,307 @@ class ImageProperties(BaseModel):
     labels: list[str]
     colors: list[ColorWeight]
     safe_search: SafeSearch
-    description: str = None
+    description: Optional[str] = None
+    timings: dict[str, float] = {}
+
+
+class EmbeddingBundle(BaseModel):
+    """
+    Embeddings keyed by the ImageDocument vector field they belong to, empty when not computed.
+    """
+    text_embedding_field: list[float] = []
+    image_embedding_field: list[float] = []
+    text_embedding_field_1408: list[float] = []
+    image_embedding_field_1408: list[float] = []
+
+    def get(self, modality: str, dimension: int) -> list[float]:
+        return getattr(self, EMBEDDING_FIELDS[(modality, dimension)])
+
+    def has(self, targets) -> bool:
+        return all(self.get(modality, dimension) for modality, dimension in targets)
+
+    def merge(self, other: "EmbeddingBundle") -> "EmbeddingBundle":
+        return EmbeddingBundle(**{field: getattr(other, field) or getattr(self, field) for field in EMBEDDING_FIELDS.values()})
+
+    def vectors(self) -> dict[str, "Vector"]:
+        from google.cloud.firestore_v1.vector import Vector
+        return {field: Vector(values) for field in EMBEDDING_FIELDS.values() if (values := getattr(self, field))}
+
+
+class EmptyEmbeddingError(Exception):
+    pass
+
+
+class Enrichment(BaseModel):
+    properties: ImageProperties
+    embeddings: EmbeddingBundle
+    timings: dict[str, float] = {}
+    # Stages left out because their upstream was unavailable, "description", "colors" or "text_embedding".
+    skipped: list[str] = []
+
+
+GEMINI_MODEL_NAME = "gemini-1.5-flash-001"
+
+# Bump these when the matching prompt changes so cached enrichments are recomputed.
+DESCRIPTION_PROMPT_VERSION = "1"
+COLORS_PROMPT_VERSION = "1"
+
+ALL_EMBEDDINGS = tuple(EMBEDDING_FIELDS)
+
+LIKELIHOOD_NAME = (
+    "UNKNOWN",
+    "VERY_UNLIKELY",
+    "UNLIKELY",
+    "POSSIBLE",
+    "LIKELY",
+    "VERY_LIKELY",
+)
+
+# Most images a single Vision batch_annotate_images request accepts.
+VISION_BATCH_SIZE = 16
+
+
+@functools.cache
+def vision_features() -> list["vision.Feature"]:
+    from google.cloud import vision
+    return [
+        vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION),
+        vision.Feature(type_=vision.Feature.Type.IMAGE_PROPERTIES),
+        vision.Feature(type_=vision.Feature.Type.SAFE_SEARCH_DETECTION),
+    ]
+
+
+def _sdk_options(timeout: float = None) -> dict:
+    # The policy retries, so the SDK's own retry is turned off rather than nested inside it.
+    return {"retry": None, "timeout": timeout} if timeout else {}
 
 
 class AIService:
-    def __init__(self, project_id: str, location: str):
-        vertexai.init(project=project_id, location=location)
-        self._model_name = "gemini-1.5-flash-001"
+    def __init__(self, project_id: str, location: str, cache: EnrichmentCache = None, color_naming: str = "local",
+                 rate_limits: dict[str, TokenBucket] = None, query_cache_size: int = 4096,
+                 policies: dict[str, resilience.Policy] = None, partial: bool = False, upstream_workers: int = 32,
+                 executor: ThreadPoolExecutor = None):
+        if color_naming not in ("local", "gemini"):
+            raise ValueError(f"Unknown color naming {color_naming}")
 
-    @staticmethod
-    def get_embeddings(image_uri: str, text: str, dimension: int = 512) -> tuple[list[float], list[float]]:
+        clients.init_vertexai(project_id, location)
+        self._model_name = GEMINI_MODEL_NAME
+        self._cache = cache
+        self._color_naming = color_naming
+        colors_version = COLOR_NAMING_VERSION if color_naming == "local" else f"gemini-{COLORS_PROMPT_VERSION}"
+        self._properties_version = f"{GEMINI_MODEL_NAME}/description-{DESCRIPTION_PROMPT_VERSION}/colors-{colors_version}"
+        # Optional per upstream limits, keyed by "vision", "gemini" and "embedding".
+        self._rate_limits = rate_limits or {}
+        self._query_cache = LRUCache(maxsize=query_cache_size)
+        # Optional resilience.Policy per upstream, calls to an upstream without one are made once and untimed.
+        self._policies = policies or {}
+        # Store what could be computed when Gemini is unavailable, instead of failing the enrichment.
+        self._partial = partial
+        # Upstream calls get their own threads, so calls stuck until their deadline cannot take
+        # the threads of the loop's default executor from hashing, queue and database work.
+        # Services of the same process share `executor` when given one.
+        self._executor = executor or ThreadPoolExecutor(upstream_workers, thread_name_prefix="upstream")
+
+    def resilience_stats(self) -> dict[str, dict]:
+        return {name: policy.report() for name, policy in self._policies.items()}
+
+    def _timeout(self, upstream: str) -> Optional[float]:
+        policy = self._policies.get(upstream)
+        return policy.timeout if policy is not None else None
+
+    async def _call(self, timings: dict[str, float], stage: str, upstream: str, func, *args):
+        """
+        Run a blocking SDK call on the upstream threads under the policy of `upstream` and record
+        its wall time, retries included, under `stage`. The policy gives up on an attempt after its
+        timeout, calls whose SDK takes a deadline are also given it, see _annotate.
+        """
+        limiter = self._rate_limits.get(upstream)
+        policy = self._policies.get(upstream)
+
+        async def attempt():
+            # Every attempt gets its own span, so retried and hedged calls show up in the metrics.
+            with telemetry.span(upstream, stage) as call:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self._executor, contextvars.copy_context().run, func, *args)
+                call.payload(response=result)
+                return result
+
+        start = time.perf_counter()
         try:
-            model = MultiModalEmbeddingModel.from_pretrained("multimodalembedding")
-            image = Image.load_from_file(image_uri)
+            if policy is not None:
+                return await policy.run_async(attempt, limiter.acquire if limiter is not None else None)
+            if limiter is not None:
+                await limiter.acquire()
+            return await attempt()
+        finally:
+            timings[stage] = time.perf_counter() - start
 
-            embeddings = model.get_embeddings(
-                contextual_text=text,
-                image=image,
-                dimension=dimension,
-            )
+    async def _degradable(self, skipped: list[str], stage: str, call):
+        """
+        Await `call`, or return None and add `stage` to `skipped` when partial enrichment is on
+        and its upstream is unavailable.
+        """
+        try:
+            return await call
+        except Exception as e:
+            if not self._partial or not resilience.is_unavailable(e):
+                raise
+            print(f"Skipping {stage}, its upstream is unavailable: {e!r}")
+            skipped.append(stage)
+            return None
 
-            return embeddings.text_embedding, embeddings.image_embedding
+    async def _cache_get(self, key: str) -> Optional[dict]:
+        if self._cache is None:
+            return None
+        try:
+            with telemetry.span("enrichment_cache", "get") as call:
+                value = await asyncio.to_thread(self._cache.get, key)
+                call.payload(response=value)
+                return value
         except Exception as e:
-            print(f"An error occurred while getting embeddings: {e}")
-            return [], []
+            print(f"An error occurred while reading the enrichment cache: {e}")
+            return None
 
-    def _get_image_description(self, image_path: str, labels: list[str], emphasis: str = None) -> str:
-        model = GenerativeModel(
-            self._model_name,
+    async def _cache_set(self, key: str, value: dict):
+        if self._cache is None:
+            return
+        try:
+            with telemetry.span("enrichment_cache", "set") as call:
+                call.payload(request=value)
+                await asyncio.to_thread(self._cache.set, key, value)
+        except Exception as e:
+            print(f"An error occurred while writing the enrichment cache: {e}")
+
+    async def image_digest(self, image_uri: str, digest: str = None) -> Optional[str]:
+        """
+        Content digest used to key the enrichment cache, only looked up when a cache is configured.
+        """
+        if digest or self._cache is None or not image_uri:
+            return digest
+        try:
+            with telemetry.span("gcs", "digest"):
+                return await asyncio.to_thread(gcs_content_digest, image_uri)
+        except Exception as e:
+            print(f"An error occurred while getting the digest of {image_uri}: {e}")
+            return None
+
+    @staticmethod
+    def get_embeddings(image_uri: str | None, text: str | None, dimension: int = 512) -> tuple[list[float], list[float]]:
+        """
+        Either `image_uri` or `text` may be None to only embed the other modality,
+        the missing modality is returned as an empty list.
+        """
+        from vertexai.vision_models import Image
+        model = clients.embedding_model()
+        image = Image.load_from_file(image_uri) if image_uri else None
+
+        embeddings = model.get_embeddings(
+            contextual_text=text,
+            image=image,
+            dimension=dimension,
+        )
+
+        return embeddings.text_embedding or [], embeddings.image_embedding or []
+
+    @staticmethod
+    def _get_query_embedding(text: str | None, image_bytes: bytes | None, dimension: int) -> list[float]:
+        from vertexai.vision_models import Image
+        model = clients.embedding_model()
+        embeddings = model.get_embeddings(
+            contextual_text=text,
+            image=Image(image_bytes=image_bytes) if image_bytes else None,
+            dimension=dimension,
         )
+        return (embeddings.image_embedding if image_bytes else embeddings.text_embedding) or []
+
+    async def embed_query(self, text: str = None, image_bytes: bytes = None, dimension: int = 512) -> list[float]:
+        """
+        Embed a search query, either a text or an image. Query embeddings are kept in an
+        in-process LRU cache so repeated searches skip the model call.
+        """
+        if bool(text) == bool(image_bytes):
+            raise ValueError("Exactly one of text or image must be given")
+
+        key = (dimension, "text", text_digest(text)) if text else (dimension, "image", content_digest(image_bytes))
+        vector = self._query_cache.get(key)
+        if vector is None:
+            vector = await self._call({}, "query_embedding", "embedding", self._get_query_embedding, text, image_bytes, dimension)
+            if not vector:
+                raise EmptyEmbeddingError("The embedding model returned an empty query embedding")
+            self._query_cache.set(key, vector)
+        return vector
+
+    def embed(self, image_uri: str | None, text: str | None, targets=ALL_EMBEDDINGS) -> EmbeddingBundle:
+        return asyncio.run(self.embed_async(image_uri, text, targets))
+
+    async def embed_async(self, image_uri: str | None, text: str | None, targets=ALL_EMBEDDINGS,
+                          timings: dict[str, float] = None, stage: str = "embedding",
+                          image_digest: str = None) -> EmbeddingBundle:
+        """
+        Compute the requested (modality, dimension) targets in as few model calls as possible.
+
+        Targets already in the enrichment cache are served from it. The model embeds the image
+        and the text independently in one call but only at one dimension, so the remaining targets
+        are grouped per dimension and every modality requested at that dimension shares a single
+        call. The calls for different dimensions run concurrently.
+        """
+        timings = {} if timings is None else timings
+        wanted = []
+        for modality, dimension in targets:
+            if (modality, dimension) not in EMBEDDING_FIELDS:
+                raise ValueError(f"Unsupported embedding {modality} at dimension {dimension}")
+            if (modality == "image" and image_uri) or (modality == "text" and text):
+                wanted.append((modality, dimension))
+
+        keys = {}
+        if self._cache is not None:
+            if any(modality == "image" for modality, _ in wanted):
+                image_digest = await self.image_digest(image_uri, image_digest)
+            digests = {"image": image_digest, "text": text_digest(text) if text else None}
+            keys = {
+                (modality, dimension): f"embedding:{clients.EMBEDDING_MODEL_NAME}:{modality}:{dimension}:{digests[modality]}"
+                for modality, dimension in wanted if digests[modality]
+            }
+
+        cached = {}
+        if keys:
+            values = await asyncio.gather(*(self._cache_get(key) for key in keys.values()))
+            cached = {
+                EMBEDDING_FIELDS[target]: value["values"]
+                for target, value in zip(keys, values) if value and value.get("values")
+            }
+
+        plan: dict[int, set[str]] = {}
+        for modality, dimension in wanted:
+            if EMBEDDING_FIELDS[(modality, dimension)] not in cached:
+                plan.setdefault(dimension, set()).add(modality)
+
+        async def run(dimension: int, modalities: set[str]) -> dict[str, list[float]]:
+            text_embedding, image_embedding = await self._call(
+                timings, f"{stage}_{dimension}", "embedding", self.get_embeddings,
+                image_uri if "image" in modalities else None,
+                text if "text" in modalities else None,
+                dimension,
+            )
+            computed = {"text": text_embedding, "image": image_embedding}
+            for modality in modalities:
+                if not computed[modality]:
+                    raise EmptyEmbeddingError(f"The embedding model returned an empty {modality} embedding at dimension {dimension}")
+            return {EMBEDDING_FIELDS[(modality, dimension)]: computed[modality] for modality in modalities}
+
+        results = await asyncio.gather(*(run(dimension, modalities) for dimension, modalities in plan.items()))
+        computed = {field: values for result in results for field, values in result.items()}
+
+        writes = [
+            self._cache_set(key, {"values": computed[EMBEDDING_FIELDS[target]]})
+            for target, key in keys.items() if computed.get(EMBEDDING_FIELDS[target])
+        ]
+        await asyncio.gather(*writes)
+
+        return EmbeddingBundle(**cached, **computed)
+
+    def _get_image_description(self, image_path: str, labels: list[str], emphasis: str = None) -> str:
+        model = clients.generative_model(self._model_name)
 
         generation_config = {
             "max_output_tokens": 8192,
@@ -55,6 +339,7 @@ class AIService:
             "top_p": 0.95,
         }
 
+        from vertexai.generative_models import Part
         image = Part.from_uri(
             mime_type="image/jpeg",
             uri=image_path,
@@ -75,9 +360,7 @@ class AIService:
         return responses.candidates[0].content.parts[0].text
 
     def _get_colors(self, colors: str) -> list[ColorWeight]:
-        model = GenerativeModel(
-            self._model_name,
-        )
+        model = clients.generative_model(self._model_name)
 
         generation_config = {
             "max_output_tokens": 8192,
@@ -103,51 +386,191 @@ class AIService:
 
         return [ColorWeight(**item) for item in data]
 
-    def image_properties(self, image_path: str) -> ImageProperties:
-        client = vision.ImageAnnotatorClient()
-        image = vision.Image()
-        image.source.image_uri = image_path
-
-        labels_response = client.label_detection(image=image)
-        labels = labels_response.label_annotations
+    @staticmethod
+    def _annotate(image_path: str, timeout: float = None) -> "vision.AnnotateImageResponse":
+        from google.cloud import vision
+        client = clients.vision_client()
+        request = vision.AnnotateImageRequest(
+            image=vision.Image(source=vision.ImageSource(image_uri=image_path)),
+            features=vision_features(),
+        )
+        response = client.annotate_image(request, **_sdk_options(timeout))
+        if response.error.message:
+            raise Exception(f"Vision annotation failed for {image_path}: {response.error.message}")
+        return response
 
-        properties_response = client.image_properties(image=image)
-        props = properties_response.image_properties_annotation
+    @staticmethod
+    def _annotate_batch(image_paths: list[str], timeout: float = None) -> "list[vision.AnnotateImageResponse | Exception]":
+        """
+        Annotate up to VISION_BATCH_SIZE images in one request, a failed image gets an exception in its place.
+        """
+        from google.cloud import vision
+        client = clients.vision_client()
+        requests = [
+            vision.AnnotateImageRequest(image=vision.Image(source=vision.ImageSource(image_uri=path)), features=vision_features())
+            for path in image_paths
+        ]
+        responses = client.batch_annotate_images(requests=requests, **_sdk_options(timeout)).responses
+        return [
+            Exception(f"Vision annotation failed for {path}: {response.error.message}") if response.error.message else response
+            for path, response in zip(image_paths, responses)
+        ]
 
+    @staticmethod
+    def _format_colors(response: "vision.AnnotateImageResponse") -> str:
         colors = ""
 
-        for color in props.dominant_colors.colors:
+        for color in response.image_properties_annotation.dominant_colors.colors:
             colors += f"score: {color.score}\n"
             colors += f"\tr: {color.color.red}\n"
             colors += f"\tg: {color.color.green}\n"
             colors += f"\tb: {color.color.blue}\n"
 
-        colors_list = self._get_colors(colors)
+        return colors
 
-        response = client.safe_search_detection(image=image)
+    @staticmethod
+    def _local_colors(response: "vision.AnnotateImageResponse") -> list[ColorWeight]:
+        dominant = response.image_properties_annotation.dominant_colors.colors
+        return name_colors(
+            [(color.color.red, color.color.green, color.color.blue) for color in dominant],
+            [color.score for color in dominant],
+        )
+
+    async def _colors(self, timings: dict[str, float], response: "vision.AnnotateImageResponse") -> list[ColorWeight]:
+        # Gemini is called under its policy in both cases, so the fallback is retried and gated by its circuit too.
+        if self._color_naming == "local":
+            try:
+                return await self._call(timings, "colors", "local", self._local_colors, response)
+            except Exception as e:
+                print(f"An error occurred while naming colors locally, falling back to Gemini: {e}")
+        return await self._call(timings, "colors", "gemini", self._get_colors, self._format_colors(response))
+
+    @staticmethod
+    def _safe_search(response: "vision.AnnotateImageResponse") -> SafeSearch:
         safe = response.safe_search_annotation
-        likelihood_name = (
-            "UNKNOWN",
-            "VERY_UNLIKELY",
-            "UNLIKELY",
-            "POSSIBLE",
-            "LIKELY",
-            "VERY_LIKELY",
+        return SafeSearch(
+            adult=LIKELIHOOD_NAME[safe.adult],
+            spoof=LIKELIHOOD_NAME[safe.spoof],
+            medical=LIKELIHOOD_NAME[safe.medical],
+            violence=LIKELIHOOD_NAME[safe.violence],
+            racy=LIKELIHOOD_NAME[safe.racy],
         )
 
-        description = self._get_image_description(image_path, labels)
+    def _properties_key(self, digest: str) -> str:
+        return f"properties:{self._properties_version}:{digest}"
 
-        image_props = ImageProperties(
-            labels=[label.description for label in labels],
-            colors=colors_list,
+    async def _properties_plan(self, image_path: str, timings: dict[str, float], digest: str = None,
+                               annotation: "vision.AnnotateImageResponse" = None, skipped: list[str] = None) -> ImageProperties:
+        digest = await self.image_digest(image_path, digest)
+        key = self._properties_key(digest)
+        if digest:
+            cached = await self._cache_get(key)
+            if cached:
+                return ImageProperties(**cached, timings=timings)
+
+        # One batched Vision request, then the colour and description Gemini calls which both depend on it.
+        response = annotation or await self._call(timings, "vision", "vision", self._annotate, image_path, self._timeout("vision"))
+        labels = [label.description for label in response.label_annotations]
+
+        skipped = [] if skipped is None else skipped
+        colors, description = await asyncio.gather(
+            self._degradable(skipped, "colors", self._colors(timings, response)),
+            self._degradable(skipped, "description", self._call(
+                timings, "description", "gemini", self._get_image_description, image_path, labels)),
+        )
+
+        props = ImageProperties(
+            labels=labels,
+            colors=colors or [],
             description=description,
-            safe_search=SafeSearch(
-                adult=likelihood_name[safe.adult],
-                spoof=likelihood_name[safe.spoof],
-                medical=likelihood_name[safe.medical],
-                violence=likelihood_name[safe.violence],
-                racy=likelihood_name[safe.racy],
-            ),
+            safe_search=self._safe_search(response),
+            timings=timings,
+        )
+
+        # Partial properties are not cached, so the next enrichment of the image completes them.
+        if digest and not skipped:
+            await self._cache_set(key, props.model_dump(exclude={"timings"}))
+
+        return props
+
+    async def image_properties_async(self, image_path: str, digest: str = None) -> ImageProperties:
+        return await self._properties_plan(image_path, {}, digest)
+
+    def image_properties(self, image_path: str) -> ImageProperties:
+        return asyncio.run(self.image_properties_async(image_path))
+
+    async def enrich(self, image_path: str, targets=ALL_EMBEDDINGS, digest: str = None,
+                     annotation: "vision.AnnotateImageResponse" = None) -> Enrichment:
+        """
+        Run the full enrichment for an image with independent calls running concurrently.
+
+        The image embeddings only depend on the image, so they run alongside Vision and the
+        Gemini calls. The text embeddings embed the generated description and run last,
+        so the total latency is vision -> description -> text embedding rather than the sum of every call.
+        A Vision `annotation` already fetched for the image skips the Vision call.
+
+        With partial enrichment on, an unavailable Gemini leaves the description, and so the text
+        embeddings, out of the enrichment and lists them in `skipped`.
+        """
+        timings = {}
+        skipped = []
+        start = time.perf_counter()
+        digest = await self.image_digest(image_path, digest)
+
+        image_targets = [target for target in targets if target[0] == "image"]
+        text_targets = [target for target in targets if target[0] == "text"]
+        image_task = asyncio.create_task(self.embed_async(image_path, None, image_targets, timings, "image_embedding", digest))
+
+        try:
+            props = await self._properties_plan(image_path, timings, digest, annotation, skipped)
+            if text_targets and not props.description:
+                skipped.append("text_embedding")
+            text_embeddings = await self.embed_async(None, props.description, text_targets, timings, "text_embedding")
+            image_embeddings = await image_task
+        except BaseException:
+            image_task.cancel()
+            raise
+
+        timings["total"] = time.perf_counter() - start
+
+        return Enrichment(
+            properties=props,
+            embeddings=image_embeddings.merge(text_embeddings),
+            timings=timings,
+            skipped=skipped,
         )
 
-        return image_props
+    async def enrich_batch(self, images: list[tuple[str, Optional[str]]], targets=ALL_EMBEDDINGS,
+                           concurrency: int = 8) -> list[Enrichment | Exception]:
+        """
+        Enrich many (image path, digest) pairs, returning an enrichment or the exception it failed with for each.
+
+        Images without cached properties are annotated with batched Vision requests of up to
+        VISION_BATCH_SIZE images, then up to `concurrency` enrichments run at the same time.
+        """
+        digests = await asyncio.gather(*(self.image_digest(path, digest) for path, digest in images))
+        cached = await asyncio.gather(*(self._cache_get(self._properties_key(digest)) if digest else asyncio.sleep(0)
+                                        for digest in digests))
+        pending = list(dict.fromkeys(path for (path, _), hit in zip(images, cached) if not hit))
+
+        async def annotate(paths: list[str]) -> list:
+            try:
+                return await self._call({}, "vision", "vision", self._annotate_batch, paths, self._timeout("vision"))
+            except Exception as e:
+                return [e] * len(paths)
+
+        chunks = [pending[i:i + VISION_BATCH_SIZE] for i in range(0, len(pending), VISION_BATCH_SIZE)]
+        annotations = {}
+        for paths, responses in zip(chunks, await asyncio.gather(*(annotate(chunk) for chunk in chunks))):
+            annotations.update(zip(paths, responses))
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(path: str, digest: Optional[str]) -> Enrichment:
+            annotation = annotations.get(path)
+            if isinstance(annotation, Exception):
+                raise annotation
+            async with semaphore:
+                return await self.enrich(path, targets, digest, annotation)
+
+        return await asyncio.gather(*(run(path, digest) for (path, _), digest in zip(images, digests)), return_exceptions=True)
@@ -0,0 +1,234 @@
+from typing import Optional
+import json
+import numpy as np
+import os
+import threading
+import time
+
+METRICS = ("DOT_PRODUCT", "COSINE", "EUCLIDEAN")
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbour search.
+
+    The vectors are clustered with k-means into `nlist` lists, a search only scores the
+    vectors of the `nprobe` lists whose centroids are closest to the query. Raising `nprobe`
+    trades latency for recall, `nprobe == nlist` is an exact search.
+
+    Distances follow Firestore: the dot product for DOT_PRODUCT (higher is closer), the cosine
+    distance for COSINE and the euclidean distance for EUCLIDEAN (lower is closer).
+
+    The built lists can be memory-mapped from disk. Vectors added afterwards are kept in memory
+    until the index is saved again, removed vectors are tombstoned. They only cover the writes of
+    this process, `built_at` is the time of the snapshot the index was built from.
+    """
+
+    def __init__(self, dimension: int, metric: str = "DOT_PRODUCT", nprobe: int = 8):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}")
+        self.dimension = dimension
+        self.metric = metric
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._ids: list[str] = []
+        self._rows: dict[str, int] = {}
+        self._centroids = np.zeros((0, dimension), dtype=np.float32)
+        # Built vectors grouped by list: the vectors of list c are rows offsets[c]:offsets[c + 1].
+        self._vectors = np.zeros((0, dimension), dtype=np.float32)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        # Vectors added after the build, per list, as row numbers into _extra.
+        self._extra: list[np.ndarray] = []
+        self._extra_lists: dict[int, list[int]] = {}
+        self._deleted: set[int] = set()
+        self.built_at = time.time()
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def nlist(self) -> int:
+        return len(self._centroids)
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        if self.metric == "COSINE":
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        return vectors
+
+    def build(self, ids: list[str], vectors, nlist: int = None, iterations: int = 10, sample_size: int = 50_000, seed: int = 0):
+        vectors = self._prepare(vectors)
+        if len(ids) != len(vectors):
+            raise ValueError("ids and vectors must have the same length")
+
+        nlist = nlist or max(1, int(np.sqrt(len(vectors))))
+        nlist = min(nlist, max(1, len(vectors)))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)] if len(vectors) else vectors
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy() if len(sample) else np.zeros((0, self.dimension), np.float32)
+
+        for _ in range(iterations):
+            assignment = self._nearest_centroids(sample, centroids, 1)[:, 0]
+            for c in range(nlist):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+
+        assignment = self._nearest_centroids(vectors, centroids, 1)[:, 0] if len(vectors) else np.zeros(0, np.int64)
+        order = np.argsort(assignment, kind="stable")
+
+        with self._lock:
+            self._centroids = centroids
+            self._vectors = vectors[order]
+            self._offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))]).astype(np.int64)
+            self._ids = [ids[i] for i in order]
+            self._rows = {image_id: row for row, image_id in enumerate(self._ids)}
+            self._extra, self._extra_lists, self._deleted = [], {}, set()
+            self.built_at = time.time()
+
+    @staticmethod
+    def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, count: int) -> np.ndarray:
+        # Squared euclidean distance without the |v|^2 term, which does not change the ranking.
+        scores = (centroids ** 2).sum(axis=1)[None, :] - 2 * vectors @ centroids.T
+        count = min(count, centroids.shape[0])
+        nearest = np.argpartition(scores, count - 1, axis=1)[:, :count]
+        return np.take_along_axis(nearest, np.argsort(np.take_along_axis(scores, nearest, axis=1), axis=1), axis=1)
+
+    def add(self, image_id: str, vector):
+        vector = self._prepare(vector)[0]
+        with self._lock:
+            self.remove(image_id)
+            row = len(self._ids)
+            self._ids.append(image_id)
+            self._rows[image_id] = row
+            self._extra.append(vector)
+            cluster = int(self._nearest_centroids(vector[None, :], self._centroids, 1)[0, 0]) if self.nlist else 0
+            self._extra_lists.setdefault(cluster, []).append(row)
+
+    def remove(self, image_id: str):
+        with self._lock:
+            row = self._rows.pop(image_id, None)
+            if row is not None:
+                self._deleted.add(row)
+
+    def _vector(self, row: int) -> np.ndarray:
+        base = len(self._vectors)
+        return self._vectors[row] if row < base else self._extra[row - base]
+
+    def sample(self, count: int, seed: int = 0) -> list[np.ndarray]:
+        """
+        Return up to `count` random indexed vectors, used as queries for recall checks.
+        """
+        with self._lock:
+            rows = list(self._rows.values())
+            rng = np.random.default_rng(seed)
+            return [np.array(self._vector(row)) for row in rng.choice(rows, min(count, len(rows)), replace=False)]
+
+    def search(self, vector, k: int = 5, nprobe: int = None) -> list[tuple[str, float]]:
+        """
+        Return up to `k` (id, distance) pairs ordered from closest to furthest.
+        """
+        query = self._prepare(vector)[0]
+        nprobe = nprobe or self.nprobe
+
+        with self._lock:
+            if not self._rows:
+                return []
+            base = len(self._vectors)
+            if self.nlist:
+                clusters = self._nearest_centroids(query[None, :], self._centroids, nprobe)[0]
+                rows = [np.arange(self._offsets[c], self._offsets[c + 1]) for c in clusters]
+                rows += [np.asarray(self._extra_lists.get(int(c), []), dtype=np.int64) for c in clusters]
+                rows = np.concatenate(rows)
+            else:
+                # Nothing was built, every vector was added afterwards.
+                rows = np.arange(len(self._ids))
+            if self._deleted:
+                rows = rows[~np.isin(rows, list(self._deleted))]
+            if not len(rows):
+                return []
+
+            base_rows, extra_rows = rows[rows < base], rows[rows >= base]
+            candidates = self._vectors[base_rows]
+            if len(extra_rows):
+                candidates = np.concatenate([candidates, np.stack([self._extra[row - base] for row in extra_rows])])
+            rows = np.concatenate([base_rows, extra_rows])
+            ids = self._ids
+
+        distances = distances_to(self.metric, query, candidates)
+        order = -distances if self.metric == "DOT_PRODUCT" else distances
+        k = min(k, len(rows))
+        top = np.argpartition(order, k - 1)[:k]
+        top = top[np.argsort(order[top])]
+        return [(ids[rows[i]], float(distances[i])) for i in top]
+
+    def save(self, path: str):
+        """
+        Write the index to a directory, folding added and removed vectors into the built lists.
+        """
+        with self._lock:
+            live = sorted(self._rows.items(), key=lambda item: item[1])
+            ids = [image_id for image_id, _ in live]
+            vectors = np.stack([self._vector(row) for _, row in live]) if live else np.zeros((0, self.dimension), np.float32)
+            centroids = self._centroids
+
+        assignment = self._nearest_centroids(vectors, centroids, 1)[:, 0] if len(vectors) and len(centroids) else np.zeros(len(vectors), np.int64)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(centroids)))]).astype(np.int64)
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), vectors[order])
+        np.save(os.path.join(path, "centroids.npy"), centroids)
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        with open(os.path.join(path, "ids.json"), "w") as f:
+            json.dump([ids[i] for i in order], f)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"dimension": self.dimension, "metric": self.metric, "nprobe": self.nprobe, "builtAt": self.built_at}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "IVFIndex":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        index = cls(meta["dimension"], meta["metric"], meta["nprobe"])
+        mode = "r" if mmap else None
+        index._vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode=mode)
+        index._centroids = np.load(os.path.join(path, "centroids.npy"))
+        index._offsets = np.load(os.path.join(path, "offsets.npy"))
+        with open(os.path.join(path, "ids.json")) as f:
+            index._ids = json.load(f)
+        index._rows = {image_id: row for row, image_id in enumerate(index._ids)}
+        # Indexes saved before the build time was kept are as old as their files.
+        index.built_at = meta.get("builtAt") or os.path.getmtime(os.path.join(path, "meta.json"))
+        return index
+
+
+def distances_to(metric: str, query: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    """
+    Distances of `vectors` to `query` as Firestore reports them, COSINE expects both to be normalised.
+    """
+    if metric == "DOT_PRODUCT":
+        return vectors @ query
+    if metric == "COSINE":
+        return 1 - vectors @ query
+    return np.linalg.norm(vectors - query, axis=1)
+
+
+def load_indexes(directory: str, mmap: bool = True) -> dict[str, IVFIndex]:
+    """
+    Load every index saved under `directory`, keyed by the name of its sub directory which is the vector field.
+    """
+    indexes = {}
+    if not directory or not os.path.isdir(directory):
+        return indexes
+    for name in sorted(os.listdir(directory)):
+        if os.path.exists(os.path.join(directory, name, "meta.json")):
+            indexes[name] = IVFIndex.load(os.path.join(directory, name), mmap=mmap)
+    return indexes
+
+
+def recall_at_k(expected: list[str], found: list[str], k: Optional[int] = None) -> float:
+    expected = expected[:k] if k else expected
+    if not expected:
+        return 1.0
+    return len(set(expected) & set(found[:k] if k else found)) / len(expected)
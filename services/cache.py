@@ -0,0 +1,144 @@
+from services import clients
+from abc import ABC, abstractmethod
+from typing import Optional
+import base64
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def content_digest(data: bytes) -> str:
+    """
+    Hex MD5 of the image bytes, the same digest GCS stores for a non-composite object.
+    """
+    return hashlib.md5(data).hexdigest()
+
+
+def gcs_content_digest(image_uri: str) -> str:
+    """
+    Content digest of a gs:// object, read from the object metadata so the image is not downloaded.
+    Composite objects have no MD5 in their metadata and fall back to hashing the bytes.
+    """
+    bucket_name, _, name = image_uri.removeprefix("gs://").partition("/")
+    blob = clients.storage_client().bucket(bucket_name).get_blob(name)
+    if blob is None:
+        raise FileNotFoundError(f"Object {image_uri} does not exist")
+    if blob.md5_hash:
+        return base64.b64decode(blob.md5_hash).hex()
+    return content_digest(blob.download_as_bytes())
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EnrichmentCache(ABC):
+    """
+    Key/value store for enrichment results. Keys are built by the caller from a content
+    digest plus the model and prompt versions, so changing either simply misses the cache.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: dict):
+        ...
+
+
+class SQLiteEnrichmentCache(EnrichmentCache):
+    """
+    Local on-disk cache bounded by the total size of the stored values, evicting the least recently used entries.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: dict):
+        data = json.dumps(value).encode()
+        if len(data) > self._max_bytes:
+            return
+
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            self._size += len(data) - (previous[0] if previous else 0)
+            self._evict()
+
+    def _evict(self):
+        while self._size > self._max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                self._size = 0
+                return
+            for key, size in rows:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._size -= size
+                if self._size <= self._max_bytes:
+                    return
+
+
+class FirestoreEnrichmentCache(EnrichmentCache):
+    """
+    Cache shared by every instance and job, stored in its own Firestore collection.
+    Document IDs are a hash of the key since keys contain characters Firestore does not allow in IDs.
+    """
+
+    def __init__(self, project_id: str, collection: str):
+        if not collection:
+            raise ValueError("Collection name must be set")
+        self._client = clients.firestore_client(project_id)
+        self._collection = collection
+
+    def _doc_ref(self, key: str):
+        return self._client.collection(self._collection).document(hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key: str) -> Optional[dict]:
+        doc = self._doc_ref(key).get()
+        if not doc.exists:
+            return None
+        return json.loads(doc.get("value"))
+
+    def set(self, key: str, value: dict):
+        self._doc_ref(key).set({
+            "key": key,
+            "value": json.dumps(value),
+            "timeCreated": datetime.datetime.now(datetime.UTC),
+        })
+
+
+def create_enrichment_cache(backend: str, project_id: str = None, path: str = None, max_mb: int = 512,
+                            collection: str = None) -> Optional[EnrichmentCache]:
+    if not backend:
+        return None
+    if backend == "sqlite":
+        return SQLiteEnrichmentCache(path or ".cache/enrichment.sqlite", max_bytes=max_mb * 1024 * 1024)
+    if backend == "firestore":
+        return FirestoreEnrichmentCache(project_id, collection or "enrichment-cache")
+    raise ValueError(f"Unknown enrichment cache backend {backend}")
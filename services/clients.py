@@ -0,0 +1,147 @@
+from typing import TYPE_CHECKING
+import threading
+import time
+
+# The SDKs are imported by the factories below, importing vertexai alone takes seconds and most
+# processes only need some of the clients, or none before their first request.
+if TYPE_CHECKING:
+    from google.cloud import firestore, storage, vision
+    from vertexai.generative_models import GenerativeModel
+    from vertexai.vision_models import MultiModalEmbeddingModel
+
+EMBEDDING_MODEL_NAME = "multimodalembedding"
+
+
+class ClientRegistry:
+    """
+    Process wide registry of SDK clients and model handles.
+
+    Handles are created lazily on first use and then shared by every request, so the gRPC
+    channels and resolved models are reused. Creation is guarded by a lock per key, a slow
+    model resolution does not block callers that need a different handle.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks: dict[tuple, threading.Lock] = {}
+        self._handles: dict[tuple, object] = {}
+
+    def get(self, key: tuple, factory):
+        handle = self._handles.get(key)
+        if handle is not None:
+            return handle
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            handle = self._handles.get(key)
+            if handle is None:
+                handle = factory()
+                self._handles[key] = handle
+        return handle
+
+    def put(self, key: tuple, handle):
+        """
+        Use `handle` for `key` from now on, for instance a fake client in a benchmark.
+        """
+        with self._lock:
+            self._handles[key] = handle
+
+    def clear(self):
+        with self._lock:
+            self._handles.clear()
+            self._key_locks.clear()
+
+
+registry = ClientRegistry()
+
+
+def _init_vertexai(project_id: str, location: str) -> bool:
+    import vertexai
+    vertexai.init(project=project_id, location=location)
+    return True
+
+
+def _vision_client() -> "vision.ImageAnnotatorClient":
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient()
+
+
+def _storage_client() -> "storage.Client":
+    from google.cloud import storage
+    return storage.Client()
+
+
+def _firestore_client(project_id: str) -> "firestore.Client":
+    from google.cloud import firestore
+    return firestore.Client(project=project_id)
+
+
+def _embedding_model() -> "MultiModalEmbeddingModel":
+    from vertexai.vision_models import MultiModalEmbeddingModel
+    return MultiModalEmbeddingModel.from_pretrained(EMBEDDING_MODEL_NAME)
+
+
+def _generative_model(model_name: str) -> "GenerativeModel":
+    from vertexai.generative_models import GenerativeModel
+    return GenerativeModel(model_name)
+
+
+def init_vertexai(project_id: str, location: str):
+    registry.get(("vertexai", project_id, location), lambda: _init_vertexai(project_id, location))
+
+
+def vision_client() -> "vision.ImageAnnotatorClient":
+    return registry.get(("vision",), _vision_client)
+
+
+def storage_client() -> "storage.Client":
+    return registry.get(("storage",), _storage_client)
+
+
+def firestore_client(project_id: str) -> "firestore.Client":
+    return registry.get(("firestore", project_id), lambda: _firestore_client(project_id))
+
+
+def embedding_model() -> "MultiModalEmbeddingModel":
+    return registry.get(("embedding", EMBEDDING_MODEL_NAME), _embedding_model)
+
+
+def generative_model(model_name: str) -> "GenerativeModel":
+    return registry.get(("generative", model_name), lambda: _generative_model(model_name))
+
+
+def import_sdks():
+    """
+    Import the SDK modules the upstream calls use, the factories only import those of the handles they create.
+    """
+    import vertexai.generative_models
+    import vertexai.vision_models
+    from google.cloud import firestore, storage, vision
+
+
+def warm_up(project_id: str, location: str, model_name: str) -> dict[str, float]:
+    """
+    Create every shared handle ahead of the first request and return how long each one took.
+    """
+    timings = {}
+    steps = {
+        "imports": import_sdks,
+        "vertexai": lambda: init_vertexai(project_id, location),
+        "firestore": lambda: firestore_client(project_id),
+        "storage": storage_client,
+        "vision": vision_client,
+        "embedding_model": embedding_model,
+        "generative_model": lambda: generative_model(model_name),
+    }
+
+    for name, step in steps.items():
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            print(f"An error occurred while warming up {name}: {e}")
+        timings[name] = time.perf_counter() - start
+
+    return timings
@@ -0,0 +1,119 @@
+from services.database import ColorWeight
+import numpy as np
+import threading
+import webcolors
+
+# Bump when the palette or the shade thresholds change so cached colours are recomputed.
+COLOR_NAMING_VERSION = "local-1"
+
+# Single word colour names and the CSS3 colours that anchor them.
+PALETTE = {
+    "red": ["red", "darkred", "firebrick", "crimson", "indianred", "lightcoral", "salmon", "maroon"],
+    "orange": ["orange", "darkorange", "coral", "tomato", "orangered", "lightsalmon"],
+    "yellow": ["yellow", "gold", "khaki", "darkkhaki", "lightyellow", "lemonchiffon", "palegoldenrod"],
+    "green": ["green", "darkgreen", "lime", "limegreen", "forestgreen", "seagreen", "mediumseagreen", "lightgreen",
+              "palegreen", "yellowgreen", "olivedrab", "olive", "darkolivegreen", "darkseagreen", "springgreen"],
+    "teal": ["teal", "darkcyan", "lightseagreen", "cadetblue"],
+    "cyan": ["cyan", "aquamarine", "turquoise", "mediumturquoise", "darkturquoise", "paleturquoise", "lightcyan"],
+    "blue": ["blue", "navy", "darkblue", "mediumblue", "midnightblue", "royalblue", "steelblue", "dodgerblue",
+             "deepskyblue", "skyblue", "lightskyblue", "lightblue", "powderblue", "cornflowerblue", "lightsteelblue"],
+    "purple": ["purple", "indigo", "darkviolet", "blueviolet", "mediumpurple", "slateblue",
+               "darkslateblue", "darkorchid", "mediumorchid"],
+    "violet": ["violet", "orchid", "plum", "thistle", "lavender"],
+    "magenta": ["magenta", "darkmagenta", "mediumvioletred"],
+    "pink": ["pink", "lightpink", "hotpink", "deeppink", "palevioletred", "mistyrose"],
+    "brown": ["brown", "saddlebrown", "sienna", "chocolate", "peru", "rosybrown", "sandybrown", "tan", "burlywood"],
+    "beige": ["beige", "wheat", "bisque", "navajowhite", "antiquewhite", "linen", "blanchedalmond", "papayawhip", "cornsilk"],
+    "white": ["white", "snow", "ivory", "ghostwhite", "whitesmoke", "floralwhite", "seashell", "mintcream", "azure", "aliceblue"],
+    "gray": ["gray", "darkgray", "dimgray", "lightgray", "silver", "gainsboro", "slategray", "lightslategray", "darkslategray"],
+    "black": ["black"],
+}
+
+# Upper CIELAB lightness bound of each shade bucket.
+SHADES = (("dark", 35.0), ("medium", 70.0), ("light", 100.0))
+
+_SRGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """
+    Convert an (N, 3) array of 0-255 sRGB values to CIELAB under a D65 white point.
+    """
+    srgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ _SRGB_TO_XYZ.T / _D65_WHITE
+
+    delta = 6 / 29
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3 * delta ** 2) + 4 / 29)
+    return np.stack([
+        116 * f[:, 1] - 16,
+        500 * (f[:, 0] - f[:, 1]),
+        200 * (f[:, 1] - f[:, 2]),
+    ], axis=1)
+
+
+class ColorNamer:
+    """
+    Nearest named colour lookup over the palette in CIELAB space, where euclidean
+    distance roughly follows perceived colour difference.
+    """
+
+    def __init__(self, palette: dict[str, list[str]] = None):
+        # scipy is only imported with the first namer, it takes about a second to import.
+        from scipy.spatial import cKDTree
+        palette = palette or PALETTE
+        names, anchors = [], []
+        for name, css_names in palette.items():
+            for css_name in css_names:
+                names.append(name)
+                anchors.append(tuple(webcolors.name_to_rgb(css_name)))
+
+        self._names = np.array(names)
+        self._tree = cKDTree(rgb_to_lab(np.array(anchors)))
+        self._shade_bounds = np.array([bound for _, bound in SHADES])
+        self._shade_names = np.array([shade for shade, _ in SHADES])
+
+    def name(self, rgb, weights) -> list[ColorWeight]:
+        """
+        Name every colour in one vectorised pass and merge colours that end up with the same name and shade.
+        Results are ordered by descending weight.
+        """
+        rgb = np.asarray(rgb, dtype=np.float64).reshape(-1, 3)
+        if not len(rgb):
+            return []
+
+        lab = rgb_to_lab(rgb)
+        _, index = self._tree.query(lab)
+        names = self._names[index]
+        shades = self._shade_names[np.minimum(np.searchsorted(self._shade_bounds, lab[:, 0]), len(self._shade_names) - 1)]
+
+        merged: dict[tuple[str, str], float] = {}
+        for name, shade, weight in zip(names, shades, np.asarray(weights, dtype=np.float64)):
+            merged[(str(name), str(shade))] = merged.get((str(name), str(shade)), 0.0) + float(weight)
+
+        return [
+            ColorWeight(name=name, shade=shade, weight=weight)
+            for (name, shade), weight in sorted(merged.items(), key=lambda item: item[1], reverse=True)
+        ]
+
+
+_namer: ColorNamer = None
+_namer_lock = threading.Lock()
+
+
+def color_namer() -> ColorNamer:
+    global _namer
+    if _namer is None:
+        with _namer_lock:
+            if _namer is None:
+                _namer = ColorNamer()
+    return _namer
+
+
+def name_colors(rgb, weights) -> list[ColorWeight]:
+    return color_namer().name(rgb, weights)
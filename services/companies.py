@@ -0,0 +1,129 @@
+from typing import Iterable, Iterator, Optional
+import json
+import os
+import sqlite3
+import threading
+
+# Files with these suffixes are opened as a CompanyStore, anything else is read as JSON lines.
+STORE_SUFFIXES = (".sqlite", ".db")
+
+
+def read_json_lines(path: str) -> Iterator[tuple[str, Optional[dict]]]:
+    """
+    (image ID, {"company_id", "album_id"}) of every entry of a companies_with_albums JSON lines file, a line
+    holds one or more image IDs. A null entry marks an image ID to delete in an update.
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield from json.loads(line).items()
+
+
+class CompanyStore:
+    """
+    Image ID to company and album lookups on disk, so a rehydrate worker starts without parsing the whole
+    mapping and the workers on a machine share its pages through the OS cache.
+
+    The table is clustered on the image ID (WITHOUT ROWID), a lookup is one B-tree search, and readers
+    memory-map the file. Updates are applied in place, in transactions, so the open readers see each
+    batch of an update whole.
+    """
+
+    def __init__(self, path: str, read_only: bool = False, mmap_mb: int = 256):
+        self.path = path
+        self._lock = threading.Lock()
+        if read_only:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No company store at {path}, build it with companies.py build")
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, isolation_level=None)
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS companies (image_id TEXT PRIMARY KEY, company_id TEXT NOT NULL, album_id TEXT NOT NULL)"
+                " WITHOUT ROWID"
+            )
+        self._conn.execute(f"PRAGMA mmap_size={mmap_mb * 1024 * 1024}")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM companies").fetchone()[0]
+
+    def get(self, image_id: str, default=None) -> Optional[dict]:
+        """
+        {"company_id", "album_id"} of `image_id`, the same entry as in the JSON mapping.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT company_id, album_id FROM companies WHERE image_id = ?", (image_id,)).fetchone()
+        if row is None:
+            return default
+        return {"company_id": row[0], "album_id": row[1]}
+
+    def update(self, entries: Iterable[tuple[str, Optional[dict]]], batch_size: int = 10000) -> tuple[int, int]:
+        """
+        Insert or replace the (image ID, entry) pairs and delete the image IDs whose entry is None.
+        Returns how many were written and deleted, each batch is committed on its own.
+        """
+        written = deleted = 0
+        upserts, deletes = [], []
+
+        def flush():
+            with self._lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO companies (image_id, company_id, album_id) VALUES (?, ?, ?)", upserts,
+                    )
+                    self._conn.executemany("DELETE FROM companies WHERE image_id = ?", deletes)
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            upserts.clear()
+            deletes.clear()
+
+        for image_id, entry in entries:
+            if entry is None:
+                deletes.append((image_id,))
+                deleted += 1
+            else:
+                upserts.append((image_id, entry["company_id"], entry["album_id"]))
+                written += 1
+            if len(upserts) + len(deletes) >= batch_size:
+                flush()
+        if upserts or deletes:
+            flush()
+        return written, deleted
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def build_store(source: str, path: str) -> int:
+    """
+    Build the store at `path` from a JSON lines mapping. It is written next to `path` and then moved in
+    place, the workers that have the previous store open keep reading it until they reopen it.
+    """
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    store = CompanyStore(tmp_path)
+    try:
+        written, _ = store.update((image_id, entry) for image_id, entry in read_json_lines(source) if entry is not None)
+    finally:
+        store.close()
+    os.replace(tmp_path, path)
+    return written
+
+
+def open_company_mapping(path: str) -> CompanyStore | dict:
+    """
+    The company mapping at `path`, a CompanyStore for a built store, else the JSON lines read into a dict.
+    Both are looked up with get(image_id).
+    """
+    if path.endswith(STORE_SUFFIXES):
+        return CompanyStore(path, read_only=True)
+    return dict(read_json_lines(path))
@@ -1,9 +1,63 @@
-from google.cloud import firestore
-from google.cloud.firestore_v1.vector import Vector
-from pydantic import BaseModel
-from typing import Optional
-from datetime import datetime
+from services import clients, resilience, telemetry
+from services.lru import LRUCache
+from pydantic import AfterValidator, BaseModel, BeforeValidator, PlainSerializer, WithJsonSchema
+from typing import TYPE_CHECKING, Annotated, Any, Iterator, Optional
+from datetime import datetime, UTC
+import base64
 import hashlib
+import json
+import numpy as np
+import threading
+
+# Firestore is imported on first use like the other SDKs, see clients.py.
+if TYPE_CHECKING:
+    from google.cloud.firestore_v1.bulk_writer import BulkWriteFailure
+
+# gRPC status codes worth retrying a write for: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, UNAVAILABLE.
+RETRYABLE_WRITE_CODES = {4, 8, 10, 14}
+
+
+# Maps an embedding (modality, dimension) onto the ImageDocument field that stores it.
+EMBEDDING_FIELDS = {
+    ("text", 512): "text_embedding_field",
+    ("image", 512): "image_embedding_field",
+    ("text", 1408): "text_embedding_field_1408",
+    ("image", 1408): "image_embedding_field_1408",
+}
+
+
+def _as_float32(value) -> Optional[np.ndarray]:
+    if value is None or isinstance(value, np.ndarray) and value.dtype == np.float32:
+        return value
+    if isinstance(value, np.ndarray):
+        return value.astype(np.float32)
+    return np.fromiter(value, dtype=np.float32, count=len(value))
+
+
+def _serialize_embedding(value: np.ndarray, info) -> Any:
+    # Firestore stores Vector values, JSON gets a plain list.
+    values = value.tolist()
+    if info.mode_is_json():
+        return values
+    from google.cloud.firestore_v1.vector import Vector
+    return Vector(values)
+
+
+# An embedding held as a contiguous float32 array, 4 bytes a dimension instead of a boxed float.
+Embedding = Annotated[
+    Optional[np.ndarray],
+    BeforeValidator(_as_float32),
+    PlainSerializer(_serialize_embedding, return_type=Any, when_used="unless-none"),
+    WithJsonSchema({"anyOf": [{"type": "array", "items": {"type": "number"}}, {"type": "null"}]}),
+]
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Firestore compares instants, a time without a zone is taken as UTC like the SDK does.
+    return value.replace(tzinfo=UTC) if value is not None and value.tzinfo is None else value
+
+
+UTCDatetime = Annotated[Optional[datetime], AfterValidator(_as_utc)]
 
 
 class ColorWeight(BaseModel):
@@ -21,6 +75,15 @@ class Metadata(BaseModel):
     albumId: Optional[str] = None
 
 
+class ImageVariant(BaseModel):
+    name: str
+    path: str
+    format: str
+    width: int
+    height: int
+    size: int
+
+
 class ImageDocument(BaseModel):
     bucket: str
     imageId: str
@@ -29,27 +92,195 @@ class ImageDocument(BaseModel):
     imagePath: str
     imageDescription: Optional[str] = None
     metadata: Metadata
+    variants: Optional[list[ImageVariant]] = None
+    # services.phash hashes of the image, hex encoded, for near-duplicate lookups.
+    perceptualHash: Optional[str] = None
+    differenceHash: Optional[str] = None
     published: Optional[bool] = False
     valid: Optional[bool] = False
+    # services.queue status of the enrichment and the error it failed with, None on images stored before it was kept.
+    ingestStatus: Optional[str] = None
+    ingestError: Optional[str] = None
     timeCreated: datetime
     timeUpdated: datetime
-    text_embedding_field: Optional[Vector] = None
-    image_embedding_field: Optional[Vector] = None
-    text_embedding_field_1408: Optional[Vector] = None
-    image_embedding_field_1408: Optional[Vector] = None
+    text_embedding_field: Embedding = None
+    image_embedding_field: Embedding = None
+    text_embedding_field_1408: Embedding = None
+    image_embedding_field_1408: Embedding = None
 
     class Config:
         arbitrary_types_allowed = True
+        # Assigned embeddings are converted to float32 arrays too.
+        validate_assignment = True
+
+
+# Top level fields read when a listing leaves the embedding vectors out.
+DOCUMENT_FIELDS = [field for field in ImageDocument.model_fields if field not in EMBEDDING_FIELDS.values()]
+
+# Fields a listing or a search can be filtered on by equality, mapped to their path in the document.
+FILTER_FIELDS = {
+    "valid": "valid",
+    "published": "published",
+    "companyId": "metadata.companyId",
+    "albumId": "metadata.albumId",
+}
+# A listing filtered on a label matches the documents whose labels contain it.
+LABELS_FIELD = "metadata.labels"
+# Filtered listings are ordered on this field, newest first, and may be limited to a range of it.
+TIME_FIELD = "timeCreated"
+
+
+class DocumentFilter(BaseModel):
+    """
+    Filters of a listing, a field left None is not filtered on.
+    """
+    companyId: Optional[str] = None
+    albumId: Optional[str] = None
+    valid: Optional[bool] = None
+    published: Optional[bool] = None
+    label: Optional[str] = None
+    # Range of timeCreated, createdAfter is inclusive and createdBefore exclusive.
+    createdAfter: UTCDatetime = None
+    createdBefore: UTCDatetime = None
+
+    def is_empty(self) -> bool:
+        return all(value is None for value in self.model_dump().values())
+
+
+class PageCursor(BaseModel):
+    after: str
+    # Sort key of the `after` document in a filtered listing.
+    timeCreated: UTCDatetime = None
+
+
+def composite_indexes(collection: str, merge: bool = False) -> dict:
+    """
+    Firestore composite index definitions, in the firestore.indexes.json format, serving every filtered
+    listing of `collection` from a single index scan. With `merge`, only one index per filter is defined
+    and Firestore merges them for the listings combining filters, which scans more index entries.
+    """
+    filters = [{"fieldPath": path, "order": "ASCENDING"} for path in FILTER_FIELDS.values()]
+    filters.append({"fieldPath": LABELS_FIELD, "arrayConfig": "CONTAINS"})
+    if merge:
+        combinations = [[field] for field in filters]
+    else:
+        combinations = [
+            [field for bit, field in enumerate(filters) if mask >> bit & 1]
+            for mask in range(1, 1 << len(filters))
+        ]
+
+    return {
+        "indexes": [
+            {
+                "collectionGroup": collection,
+                "queryScope": "COLLECTION",
+                "fields": fields + [{"fieldPath": TIME_FIELD, "order": "DESCENDING"}],
+            }
+            for fields in sorted(combinations, key=len)
+        ],
+        "fieldOverrides": [],
+    }
+
+
+class DocumentColumns:
+    """
+    Struct-of-arrays batch of documents for analytics and index building. `vectors` holds one
+    (rows, dimension) float32 matrix per vector field and `columns` one array per scalar field,
+    every row aligned with `ids`. Rows of documents missing a vector are zero and False in `present`.
+    """
+
+    def __init__(self, ids: list[str], vectors: dict[str, np.ndarray], present: dict[str, np.ndarray],
+                 columns: dict[str, np.ndarray]):
+        self.ids = ids
+        self.vectors = vectors
+        self.present = present
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class BulkWriteResult(BaseModel):
+    imageId: str
+    success: bool
+    attempts: int = 0
+    updateTime: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+# Cached in place of a document that does not exist.
+_NOT_FOUND = object()
 
 
 class DBService:
-    def __init__(self, project_id, collection):
-        self._client = firestore.Client(project=project_id)
+    def __init__(self, project_id, collection, cache_size: int = 0, cache_ttl: float = 60, negative_ttl: float = 5,
+                 codec=None, policy: resilience.Policy = None):
+        self._client = clients.firestore_client(project_id)
         self._collection = collection
+        # Optional services.quantize.EmbeddingCodec storing some embeddings compactly.
+        self._codec = codec
 
         if not self._collection:
             raise ValueError("Collection name must be set")
 
+        # Read-through cache of get_document_by_id, off when cache_size is 0.
+        self._cache = LRUCache(cache_size, cache_ttl) if cache_size else None
+        self._negative_ttl = negative_ttl
+        self._watch = None
+        # Optional deadline, retries and circuit breaker for single document reads and writes.
+        # Streams are only failed fast while the circuit is open, a deadline would cover the whole stream.
+        self._policy = policy
+
+    def _run(self, func):
+        return self._policy.run(func) if self._policy is not None else func()
+
+    def _options(self) -> dict:
+        # The policy retries, so the SDK's own retry is turned off rather than nested inside it.
+        return {"retry": None, "timeout": self._policy.timeout} if self._policy is not None else {}
+
+    def _check(self):
+        if self._policy is not None:
+            self._policy.check()
+
+    def _encode(self, data: ImageDocument) -> dict:
+        return self._codec.encode(data) if self._codec else data.model_dump()
+
+    def _document(self, data: dict) -> ImageDocument:
+        return ImageDocument(**(self._codec.decode(data) if self._codec else data))
+
+    def _invalidate(self, document_id: str):
+        if self._cache is not None:
+            self._cache.delete(document_id)
+
+    def cache_stats(self) -> dict[str, int]:
+        if self._cache is None:
+            return {"size": 0, "hits": 0, "misses": 0}
+        return self._cache.stats()
+
+    def listen(self):
+        """
+        Keep the cache coherent with writes from other instances by listening for document changes.
+
+        Only documents with a timeUpdated after the listener started are watched, so the listener
+        does not read the whole collection. Writes that leave timeUpdated alone are picked up when
+        their cache entry expires.
+        """
+        if self._cache is None or self._watch is not None:
+            return
+
+        def on_snapshot(_, changes, __):
+            for change in changes:
+                self._cache.delete(change.document.id)
+
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        query = self._client.collection(self._collection).where(filter=FieldFilter("timeUpdated", ">=", datetime.now(UTC)))
+        self._watch = query.on_snapshot(on_snapshot)
+
+    def close(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
     @staticmethod
     def encode_image_id(image_path: str) -> str:
         # Generate MD5 hash
@@ -58,52 +289,321 @@ class DBService:
         hex_dig = hash_object.hexdigest()
         return hex_dig
 
-    def get_documents(self, limit: int = 1000, start_at: str = None) -> list[ImageDocument]:
-        docs = []
-        query = self._client.collection(self._collection).limit(limit)
+    @staticmethod
+    def encode_page_token(document_id: str, time_created: datetime = None) -> str:
+        data = {"after": document_id}
+        if time_created is not None:
+            data["timeCreated"] = time_created.isoformat()
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_page_token(token: str) -> PageCursor:
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+            cursor = PageCursor(after=str(data["after"]), timeCreated=data.get("timeCreated"))
+        except Exception:
+            raise ValueError("Invalid page token")
+        # A document ID is one path segment.
+        if not cursor.after or "/" in cursor.after:
+            raise ValueError("Invalid page token")
+        return cursor
+
+    def _page_query(self, limit: int, start_at: str = None, include_vectors: bool = True):
+        collection = self._client.collection(self._collection)
+        query = collection.order_by("__name__").limit(limit)
+        if not include_vectors:
+            query = query.select(DOCUMENT_FIELDS)
 
         if start_at:
-            last_doc_ref = self._client.collection(self._collection).document(start_at)
-            last_doc = last_doc_ref.get()
-            if last_doc.exists:
-                query = query.start_after(last_doc)
-            else:
-                print(f"Document with ID {start_at} does not exist.")
+            # The cursor is the ID itself, so the page after a deleted document still follows it
+            # and the document is not read first.
+            query = query.start_after({"__name__": collection.document(start_at)})
+
+        return query
+
+    def stream_documents(self, limit: int = 1000, start_at: str = None,
+                         include_vectors: bool = True) -> Iterator[tuple[str, ImageDocument]]:
+        """
+        Yield (document ID, document) pairs one at a time as Firestore streams them.
+        """
+        query = self._page_query(limit, start_at, include_vectors)
+        self._check()
+        for doc in telemetry.stream("firestore", "stream", query.stream()):
+            yield doc.id, self._document(doc.to_dict())
+
+    def get_documents(self, limit: int = 1000, start_at: str = None, include_vectors: bool = True) -> list[ImageDocument]:
+        return [doc for _, doc in self.stream_documents(limit, start_at, include_vectors)]
+
+    def _filtered_query(self, filters: DocumentFilter):
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        query = self._client.collection(self._collection)
+        for name, path in FILTER_FIELDS.items():
+            if (value := getattr(filters, name)) is not None:
+                query = query.where(filter=FieldFilter(path, "==", value))
+        if filters.label is not None:
+            query = query.where(filter=FieldFilter(LABELS_FIELD, "array_contains", filters.label))
+        if filters.createdAfter is not None:
+            query = query.where(filter=FieldFilter(TIME_FIELD, ">=", filters.createdAfter))
+        if filters.createdBefore is not None:
+            query = query.where(filter=FieldFilter(TIME_FIELD, "<", filters.createdBefore))
+        return query
+
+    def query_documents(self, filters: DocumentFilter, limit: int = 1000, cursor: PageCursor = None,
+                        include_vectors: bool = True) -> Iterator[tuple[str, ImageDocument]]:
+        """
+        Yield the (document ID, document) pairs matching `filters`, newest first, after `cursor`.
+
+        The filters and the order are applied by Firestore from a composite index (see composite_indexes),
+        so only the returned documents are read. Without filters this is stream_documents.
+        Raises ValueError for a cursor that is not from a filtered listing.
+        """
+        if filters.is_empty():
+            return self.stream_documents(limit, cursor.after if cursor else None, include_vectors)
+
+        from google.cloud.firestore_v1.base_query import BaseQuery
+        query = (self._filtered_query(filters)
+                 .order_by(TIME_FIELD, direction=BaseQuery.DESCENDING)
+                 .order_by("__name__", direction=BaseQuery.DESCENDING)
+                 .limit(limit))
+        if not include_vectors:
+            query = query.select(DOCUMENT_FIELDS)
+        if cursor is not None:
+            if cursor.timeCreated is None:
+                raise ValueError("The page token is not from a filtered listing")
+            # The cursor carries the sort key of the last document, the next page is found without reading it.
+            query = query.start_after({TIME_FIELD: cursor.timeCreated, "__name__": cursor.after})
+        return self._stream_query(query)
+
+    def _stream_query(self, query) -> Iterator[tuple[str, ImageDocument]]:
+        self._check()
+        for doc in telemetry.stream("firestore", "query", query.stream()):
+            yield doc.id, self._document(doc.to_dict())
+
+    def count_documents(self, filters: DocumentFilter = None) -> int:
+        """
+        Number of documents matching `filters`, from a Firestore count() aggregation. It reads index entries,
+        billed as one document read per 1000 of them, instead of the documents.
+        """
+        query = self._filtered_query(filters or DocumentFilter()).count(alias="count")
+
+        def count():
+            with telemetry.span("firestore", "count"):
+                return query.get(**self._options())
+
+        return int(self._run(count)[0][0].value)
+
+    def load_columns(self, vector_fields: list[str], fields: list[str] = (), limit: int = None,
+                     chunk_rows: int = 4096) -> DocumentColumns:
+        """
+        Read `vector_fields` and the scalar `fields` (dotted paths such as metadata.companyId) of the
+        collection into a DocumentColumns batch, without building a model per document. Vectors are
+        written straight into preallocated float32 chunks of `chunk_rows` rows.
+        """
+        dimensions = {field: dimension for (_, dimension), field in EMBEDDING_FIELDS.items()}
+        for field in vector_fields:
+            if field not in dimensions:
+                raise ValueError(f"Unknown vector field {field}")
+            if self._codec:
+                dimensions[field] = self._codec.dimension(field)
+
+        paths = [path for field in vector_fields for path in (self._codec.field_paths(field) if self._codec else [field])]
+        query = self._client.collection(self._collection).select(paths + list(fields))
+        if limit:
+            query = query.limit(limit)
+
+        ids, values = [], {field: [] for field in fields}
+        chunks = {field: [] for field in vector_fields}
+        present = {field: [] for field in vector_fields}
+        current = {field: np.zeros((chunk_rows, dimensions[field]), np.float32) for field in vector_fields}
+        row = 0
 
-        for doc in query.stream():
-            docs.append(ImageDocument(**doc.to_dict()))
+        self._check()
+        for doc in telemetry.stream("firestore", "stream", query.stream()):
+            if row == chunk_rows:
+                for field in vector_fields:
+                    chunks[field].append(current[field])
+                    current[field] = np.zeros((chunk_rows, dimensions[field]), np.float32)
+                row = 0
 
-        return docs
+            data = doc.to_dict()
+            ids.append(doc.id)
+            for field in vector_fields:
+                vector = self._codec.decode_field(data, field) if self._codec else data.get(field)
+                present[field].append(vector is not None)
+                if vector is not None:
+                    current[field][row] = list(vector)
+            for field in fields:
+                value = data
+                for part in field.split("."):
+                    value = value.get(part) if isinstance(value, dict) else None
+                values[field].append(value)
+            row += 1
+
+        vectors = {field: np.concatenate(chunks[field] + [current[field][:row]]) for field in vector_fields}
+        columns = {
+            field: np.asarray(items, dtype=bool if items and all(isinstance(item, bool) for item in items) else object)
+            for field, items in values.items()
+        }
+        return DocumentColumns(ids, vectors, {field: np.asarray(flags, dtype=bool) for field, flags in present.items()}, columns)
+
+    def get_document_by_id(self, document_id: str) -> Optional[ImageDocument]:
+        if self._cache is not None:
+            cached = self._cache.get(document_id)
+            if cached is _NOT_FOUND:
+                return None
+            if cached is not None:
+                return self._copy(cached)
 
-    def get_document_by_id(self, document_id: str) -> ImageDocument:
         doc_ref = self._client.collection(self._collection).document(document_id)
-        doc = doc_ref.get()
-        return ImageDocument(**doc.to_dict())
+
+        def get():
+            with telemetry.span("firestore", "get") as call:
+                doc = doc_ref.get(**self._options())
+                raw = doc.to_dict() if doc.exists else None
+                call.payload(response=raw)
+                return raw
+
+        raw = self._run(get)
+        if raw is None:
+            if self._cache is not None:
+                self._cache.set(document_id, _NOT_FOUND, self._negative_ttl)
+            return None
+
+        data = self._document(raw)
+        if self._cache is not None:
+            self._cache.set(document_id, self._copy(data))
+        return data
+
+    @staticmethod
+    def _copy(data: ImageDocument) -> ImageDocument:
+        # Callers update the documents they read, so they get their own copy. The vectors are
+        # shared: they are only ever replaced, never updated in place, and would dominate the copy.
+        return data.model_copy(update={
+            "metadata": data.metadata.model_copy(deep=True),
+            "variants": [variant.model_copy() for variant in data.variants] if data.variants else data.variants,
+        })
+
+    def _set(self, doc_ref, document_data: dict):
+        def write():
+            with telemetry.span("firestore", "set") as call:
+                call.payload(request=document_data)
+                doc_ref.set(
+                    document_data=document_data,
+                    merge=True,
+                    **self._options(),
+                )
+
+        self._run(write)
 
     def add_document(self, data: ImageDocument):
-        image_id = self.encode_image_id(data.imagePath)
-        doc_ref = self._client.collection(self._collection).document(image_id)
+        """
+        Raises when the write fails after the retries of the policy, so the caller does not report
+        a document that was never stored.
+        """
+        doc_ref = self._client.collection(self._collection).document(data.imageId)
         try:
-            doc_ref.set(
-                document_data=data.model_dump(),
-                merge=True,
-            )
+            self._set(doc_ref, self._encode(data))
         except Exception as e:
             print(f"Error inserting document {data.imageId}: {e}")
-        return
+            raise
+        finally:
+            # Dropped after the write, so a concurrent read cannot cache the previous version.
+            self._invalidate(data.imageId)
 
     def update_document(self, data: ImageDocument):
+        """
+        Raises when the write fails, like add_document.
+        """
+        # Bumped so the change listeners of other instances see the update.
+        data.timeUpdated = datetime.now(UTC)
         doc_ref = self._client.collection(self._collection).document(data.imageId)
         try:
-            doc_ref.set(
-                document_data=data.model_dump(),
-                merge=True,
-            )
+            self._set(doc_ref, self._encode(data))
         except Exception as e:
-            print(f"Error inserting document {data.imageId}: {e}")
-        return
+            print(f"Error updating document {data.imageId}: {e}")
+            raise
+        finally:
+            self._invalidate(data.imageId)
+
+    def update_fields(self, document_id: str, fields: dict):
+        """
+        Merge `fields` into an existing document, leaving the others, embeddings included, untouched.
+        timeUpdated is bumped like every other write so the listeners of the other instances see it.
+        """
+        doc_ref = self._client.collection(self._collection).document(document_id)
+        self._set(doc_ref, {**fields, "timeUpdated": datetime.now(UTC)})
+        self._invalidate(document_id)
+
+    def bulk_write(self, data: list[ImageDocument], batch_size: int = 500, max_attempts: int = 5,
+                   max_ops_per_second: int = 500) -> list["BulkWriteResult"]:
+        """
+        Merge documents into the collection with a Firestore BulkWriter and report the outcome of every document.
+
+        The writer is flushed every `batch_size` documents to bound memory. Writes failing with a
+        retryable status, such as contention on the document, are retried with exponential backoff
+        up to `max_attempts` times. Results are returned in the order of `data`.
+        """
+        lock = threading.Lock()
+        results: dict[str, BulkWriteResult] = {}
+        attempts: dict[str, int] = {}
+
+        def on_write_result(reference, result, _):
+            with lock:
+                results[reference.id] = BulkWriteResult(
+                    imageId=reference.id,
+                    success=True,
+                    attempts=attempts.get(reference.id, 0) + 1,
+                    updateTime=result.update_time,
+                )
+
+        def on_write_error(failure: "BulkWriteFailure", _) -> bool:
+            image_id = failure.operation.reference.id
+            retry = failure.code in RETRYABLE_WRITE_CODES and failure.attempts + 1 < max_attempts
+            with lock:
+                attempts[image_id] = failure.attempts + 1
+                if not retry:
+                    results[image_id] = BulkWriteResult(
+                        imageId=image_id,
+                        success=False,
+                        attempts=failure.attempts + 1,
+                        error=f"{failure.code}: {failure.message}",
+                    )
+            return retry
+
+        from google.cloud.firestore_v1.bulk_writer import BulkRetry, BulkWriterOptions
+        writer = self._client.bulk_writer(BulkWriterOptions(
+            initial_ops_per_second=min(500, max_ops_per_second),
+            max_ops_per_second=max_ops_per_second,
+            retry=BulkRetry.exponential,
+        ))
+        writer.on_write_result(on_write_result)
+        writer.on_write_error(on_write_error)
+
+        self._check()
+        collection = self._client.collection(self._collection)
+        with telemetry.span("firestore", "bulk_write"):
+            try:
+                for count, doc in enumerate(data, start=1):
+                    writer.set(collection.document(doc.imageId), self._encode(doc), merge=True)
+                    if count % batch_size == 0:
+                        writer.flush()
+            finally:
+                writer.close()
+                for doc in data:
+                    self._invalidate(doc.imageId)
+
+        return [
+            results.get(doc.imageId) or BulkWriteResult(imageId=doc.imageId, success=False, error="No write result")
+            for doc in data
+        ]
 
     def delete_document(self, document_id: str):
         doc_ref = self._client.collection(self._collection).document(document_id)
-        doc_ref.delete()
+
+        def delete():
+            with telemetry.span("firestore", "delete"):
+                doc_ref.delete(**self._options())
+
+        self._run(delete)
+        self._invalidate(document_id)
         return
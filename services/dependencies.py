@@ -0,0 +1,82 @@
+from typing import Callable, Optional
+import threading
+import time
+
+
+class Dependencies:
+    """
+    Services shared by the requests of a router, each created by its provider on first use instead of when
+    the router module is imported. `deps.db` builds the "db" service once and then returns it. Like the
+    client registry, creation is guarded by a lock per name, so a slow provider only blocks the callers
+    waiting on the same service.
+    """
+
+    def __init__(self):
+        self._providers: dict[str, Callable[[], object]] = {}
+        self._built: dict[str, object] = {}
+        self._timings: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._name_locks: dict[str, threading.Lock] = {}
+
+    def provider(self, name: str):
+        """
+        Register the decorated function as the provider of `name`.
+        """
+        def register(factory: Callable[[], object]):
+            self._providers[name] = factory
+            return factory
+        return register
+
+    def __getattr__(self, name: str):
+        # Only called when `name` is not a regular attribute.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.get(name)
+
+    def get(self, name: str):
+        service = self._built.get(name)
+        if service is not None:
+            return service
+        if name not in self._providers:
+            raise AttributeError(f"No provider for {name}")
+
+        with self._lock:
+            name_lock = self._name_locks.setdefault(name, threading.Lock())
+
+        with name_lock:
+            service = self._built.get(name)
+            if service is None:
+                start = time.perf_counter()
+                service = self._providers[name]()
+                self._timings[name] = time.perf_counter() - start
+                self._built[name] = service
+        return service
+
+    def peek(self, name: str) -> Optional[object]:
+        """
+        The service if it has been built, for instance to close it at shutdown without building it.
+        """
+        return self._built.get(name)
+
+    def put(self, name: str, service):
+        """
+        Use `service` for `name` from now on, for instance a fake in a benchmark.
+        """
+        with self._lock:
+            self._built[name] = service
+
+    def build(self) -> dict[str, float]:
+        """
+        Build every registered service ahead of the first request and return how long each one took,
+        including the services built before. Like clients.warm_up, a failing provider is logged and left
+        to be built again on first use, the other services are still built.
+        """
+        for name in self._providers:
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"An error occurred while building {name}: {e}")
+        return self.timings()
+
+    def timings(self) -> dict[str, float]:
+        return dict(self._timings)
@@ -1,14 +1,27 @@
-from google.appengine.api import images
+from services import telemetry
+import os
+
+try:
+    from google.appengine.api import images
+except ImportError:
+    images = None
+
+# The legacy images API only answers inside App Engine, elsewhere images are served from their public URL.
+ON_APP_ENGINE = images is not None and os.getenv("GAE_ENV", "").startswith("standard")
 
 
 class ImageService:
-    def __init__(self):
+    def __init__(self, base_url: str = "https://storage.googleapis.com"):
         self._gs_prefix = "/gs/"
+        self._base_url = base_url.rstrip("/")
         pass
 
     def get_serving_url(self, image_path: str):
+        if not ON_APP_ENGINE:
+            return f"{self._base_url}/{image_path}"
         try:
-            serving_image = images.get_serving_url(None, filename=self._gs_prefix + image_path, secure_url=True)
+            with telemetry.span("images_api", "get_serving_url"):
+                serving_image = images.get_serving_url(None, filename=self._gs_prefix + image_path, secure_url=True)
             return serving_image
         except images.AccessDeniedError as e:
             raise Exception(f"Access denied to image, Ensure the GAE service account has access to the object in Google Cloud Storage. {e}")
@@ -20,8 +33,11 @@ class ImageService:
             raise Exception(f"Image too large. {e}")
 
     def delete_serving_url(self, image_path: str):
+        if not ON_APP_ENGINE:
+            return
         try:
-            images.delete_serving_url(self._gs_prefix + image_path)
+            with telemetry.span("images_api", "delete_serving_url"):
+                images.delete_serving_url(self._gs_prefix + image_path)
         except images.AccessDeniedError as e:
             raise Exception(f"Access denied to image, Ensure the GAE service account has access to the object in Google Cloud Storage. {e}")
         except images.ObjectNotFoundError as e:
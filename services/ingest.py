@@ -0,0 +1,254 @@
+from services.ai import AIService, EmptyEmbeddingError, Enrichment, SafeSearch, ALL_EMBEDDINGS
+from services.database import DBService, ImageDocument, EMBEDDING_FIELDS
+from services.phash import DuplicateIndex, ImageHashes
+from services.queue import WorkQueue, Job, DONE, FAILED
+from services.variants import VariantService
+from pydantic import BaseModel
+from typing import Callable, Optional
+import asyncio
+import collections
+import datetime
+import random
+import time
+
+
+class IngestStatus(BaseModel):
+    imageId: str
+    status: str
+    attempts: int = 0
+    error: Optional[str] = None
+    valid: Optional[bool] = None
+    enqueuedAt: Optional[datetime.datetime] = None
+    startedAt: Optional[datetime.datetime] = None
+    finishedAt: Optional[datetime.datetime] = None
+
+
+class BatchItemResult(BaseModel):
+    source: str
+    imageId: Optional[str] = None
+    success: bool
+    valid: Optional[bool] = None
+    error: Optional[str] = None
+
+
+class BatchReport(BaseModel):
+    succeeded: int
+    failed: int
+    results: list[BatchItemResult]
+
+
+def is_valid(safe_search: SafeSearch) -> bool:
+    very_likely = "VERY_LIKELY"
+    safe_search_flags = [
+        safe_search.adult,
+        safe_search.spoof,
+        safe_search.medical,
+        safe_search.violence,
+        safe_search.racy
+    ]
+    return all(flag != very_likely for flag in safe_search_flags)
+
+
+def apply_enrichment(doc: ImageDocument, enrichment: Enrichment) -> ImageDocument:
+    """
+    Fill a document with the properties and embeddings of its enrichment.
+    """
+    props = enrichment.properties
+    # A partial enrichment keeps what an earlier enrichment stored for the skipped stages.
+    doc.imageDescription = props.description or doc.imageDescription
+    doc.metadata.labels = props.labels
+    doc.metadata.color_weights = props.colors or doc.metadata.color_weights
+    for field, vector in enrichment.embeddings.vectors().items():
+        setattr(doc, field, vector)
+    doc.valid = is_valid(props.safe_search)
+    doc.ingestStatus, doc.ingestError = DONE, None
+    doc.timeUpdated = datetime.datetime.now(datetime.UTC)
+    return doc
+
+
+def is_enriched(doc: ImageDocument) -> bool:
+    return bool(doc.imageDescription and doc.metadata.labels) and all(
+        getattr(doc, field) is not None and getattr(doc, field).size > 0 for field in EMBEDDING_FIELDS.values()
+    )
+
+
+def document_hashes(doc: ImageDocument) -> Optional[ImageHashes]:
+    if not (doc.perceptualHash and doc.differenceHash):
+        return None
+    return ImageHashes(perceptualHash=doc.perceptualHash, differenceHash=doc.differenceHash)
+
+
+def load_duplicates(db: DBService, duplicates: DuplicateIndex) -> int:
+    """
+    Index the hashes of the images stored in the collection of `db`, returning how many were hashed.
+    """
+    batch = db.load_columns([], ["perceptualHash", "differenceHash"])
+    return duplicates.load(zip(batch.ids, batch.columns["perceptualHash"], batch.columns["differenceHash"]))
+
+
+def find_duplicate(db: DBService, duplicates: DuplicateIndex, image_id: str,
+                   hashes: Optional[ImageHashes]) -> Optional[ImageDocument]:
+    """
+    The closest enriched near-duplicate of an image, other than the image itself, or None.
+    """
+    if hashes is None:
+        return None
+    for match_id, _ in duplicates.find(hashes, exclude=image_id):
+        source = db.get_document_by_id(match_id)
+        if source is not None and is_enriched(source):
+            return source
+    return None
+
+
+def apply_duplicate(doc: ImageDocument, source: ImageDocument) -> ImageDocument:
+    """
+    Fill a document with the enrichment of a near-duplicate instead of enriching it again.
+    """
+    doc.imageDescription = source.imageDescription
+    doc.metadata.labels = source.metadata.labels
+    doc.metadata.color_weights = source.metadata.color_weights
+    for field in EMBEDDING_FIELDS.values():
+        setattr(doc, field, getattr(source, field))
+    doc.valid = source.valid
+    doc.ingestStatus, doc.ingestError = DONE, None
+    doc.timeUpdated = datetime.datetime.now(datetime.UTC)
+    return doc
+
+
+class IngestWorker:
+    """
+    Pool of coroutines completing the enrichment of images ingested asynchronously.
+
+    Every coroutine leases a job from the queue, enriches the image and merges the result into
+    its skeleton document. A failed job is queued again with an exponential backoff until it
+    has been attempted `max_attempts` times, then it is marked failed and the document stays invalid.
+    """
+
+    def __init__(self, queue: WorkQueue, ai: AIService, db: DBService, concurrency: int = 2, max_attempts: int = 3,
+                 lease_seconds: float = 300, poll_interval: float = 1.0, retry_delay: float = 5.0,
+                 on_complete: Callable[[str, ImageDocument], None] = None, variants: VariantService = None,
+                 duplicates: DuplicateIndex = None):
+        self._queue = queue
+        self._ai = ai
+        self._db = db
+        self._concurrency = concurrency
+        self._max_attempts = max_attempts
+        self._lease_seconds = lease_seconds
+        self._poll_interval = poll_interval
+        self._retry_delay = retry_delay
+        self._on_complete = on_complete
+        self._variants = variants
+        # Reuse the enrichment of a near-duplicate found in this index instead of enriching again.
+        self._duplicates = duplicates
+        self._stop = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._counts = {"completed": 0, "retried": 0, "failed": 0}
+        # Seconds of the latest jobs, enough for stable percentiles without growing forever.
+        self._latency = collections.deque(maxlen=1000)
+        self._wait = collections.deque(maxlen=1000)
+
+    def start(self):
+        self._stop.clear()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self._concurrency)]
+
+    async def stop(self):
+        self._stop.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def run(self):
+        """
+        Run the pool until it is stopped, for a dedicated worker process.
+        """
+        self.start()
+        await asyncio.gather(*self._tasks)
+
+    async def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = await asyncio.to_thread(self._queue.lease, self._lease_seconds)
+            except Exception as e:
+                print(f"Error leasing an ingest job: {e}")
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._stop.wait(), self._poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._process(job)
+
+    async def _process(self, job: Job):
+        start = time.perf_counter()
+        self._wait.append((job.startedAt - job.enqueuedAt).total_seconds())
+        try:
+            doc = await asyncio.to_thread(self._db.get_document_by_id, job.id)
+            if doc is None:
+                # Deleted before it was enriched, nothing left to do.
+                await asyncio.to_thread(self._queue.complete, job.id, job.attempts)
+                return
+
+            source = None
+            if self._duplicates is not None:
+                source = await asyncio.to_thread(find_duplicate, self._db, self._duplicates, job.id, document_hashes(doc))
+
+            enrichment, variants = await asyncio.gather(
+                self._ai.enrich(job.payload["imageUri"], digest=job.payload.get("digest")) if source is None else asyncio.sleep(0),
+                self._variants.generate_or_none(doc.imagePath) if self._variants else asyncio.sleep(0),
+            )
+            if source is not None:
+                doc = apply_duplicate(doc, source)
+            else:
+                if enrichment.skipped and job.attempts < self._max_attempts:
+                    # Retried while attempts remain, the last attempt stores the partial enrichment.
+                    raise Exception(f"partial enrichment, skipped {', '.join(enrichment.skipped)}")
+                targets = [target for target in ALL_EMBEDDINGS if f"{target[0]}_embedding" not in enrichment.skipped]
+                if not enrichment.embeddings.has(targets):
+                    raise EmptyEmbeddingError("empty embeddings")
+                doc = apply_enrichment(doc, enrichment)
+            doc.variants = variants or doc.variants
+            await asyncio.to_thread(self._db.update_document, doc)
+            if self._on_complete:
+                self._on_complete(job.id, doc)
+            if await asyncio.to_thread(self._queue.complete, job.id, job.attempts):
+                self._counts["completed"] += 1
+            else:
+                print(f"Lease of {job.id} expired before attempt {job.attempts} completed")
+        except Exception as e:
+            retry_in = None
+            if job.attempts < self._max_attempts:
+                retry_in = self._retry_delay * 2 ** (job.attempts - 1) * random.uniform(0.5, 1.5)
+                self._counts["retried"] += 1
+            else:
+                self._counts["failed"] += 1
+            print(f"Ingest of {job.id} failed on attempt {job.attempts}: {e}")
+            if await asyncio.to_thread(self._queue.fail, job.id, job.attempts, str(e), retry_in) and retry_in is None:
+                await self._store_failure(job.id, str(e))
+        finally:
+            self._latency.append(time.perf_counter() - start)
+
+    async def _store_failure(self, image_id: str, error: str):
+        # Kept on the document, the status route reads it once the job has been purged from the queue.
+        try:
+            await asyncio.to_thread(self._db.update_fields, image_id, {"ingestStatus": FAILED, "ingestError": error})
+        except Exception as e:
+            print(f"Error storing the failed ingest of {image_id}: {e}")
+
+    @staticmethod
+    def _percentile(values, q: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            **self._counts,
+            "latency_p50": self._percentile(self._latency, 0.5),
+            "latency_p95": self._percentile(self._latency, 0.95),
+            "queue_wait_p50": self._percentile(self._wait, 0.5),
+            "queue_wait_p95": self._percentile(self._wait, 0.95),
+        }
@@ -0,0 +1,245 @@
+from services import clients, telemetry
+from PIL import Image, ImageOps
+from pydantic import BaseModel
+from typing import BinaryIO, Iterable, Optional
+import io
+import numpy as np
+import threading
+
+# Both hashes are 64 bits, stored on ImageDocument as 16 hex digits.
+HASH_SIZE = 8
+# pHash keeps the lowest 8x8 frequencies of a 32x32 DCT.
+DCT_SIZE = 32
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    # Orthonormal DCT-II, the 2D transform of X is C @ X @ C.T.
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def _to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.astype(np.uint8).ravel()).tobytes(), "big")
+
+
+def to_hex(value: int) -> str:
+    return f"{value:016x}"
+
+
+def from_hex(value: str) -> int:
+    return int(value, 16)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _grayscale(image: Image.Image, size: tuple[int, int]) -> np.ndarray:
+    return np.asarray(image.resize(size, Image.Resampling.LANCZOS), dtype=np.float32)
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    Difference hash: one bit per pair of horizontally adjacent pixels of a 9x8 thumbnail, set when the brightness increases.
+    """
+    pixels = _grayscale(image, (HASH_SIZE + 1, HASH_SIZE))
+    return _to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: Image.Image) -> int:
+    """
+    Perceptual hash: one bit per low frequency of the DCT of a 32x32 thumbnail, set when it is above the median.
+    """
+    coefficients = _DCT @ _grayscale(image, (DCT_SIZE, DCT_SIZE)) @ _DCT.T
+    low = coefficients[:HASH_SIZE, :HASH_SIZE]
+    # The DC term only carries the average brightness and is left out of the median.
+    return _to_int(low > np.median(low.ravel()[1:]))
+
+
+class ImageHashes(BaseModel):
+    perceptualHash: str
+    differenceHash: str
+
+
+def image_hashes(data: bytes | BinaryIO) -> ImageHashes:
+    """
+    pHash and dHash of an encoded image, its bytes or a file object read from the start. JPEGs are decoded
+    at a reduced scale, the hashes only need a 32x32 thumbnail.
+    """
+    if isinstance(data, bytes):
+        data = io.BytesIO(data)
+    else:
+        data.seek(0)
+    with Image.open(data) as original:
+        original.draft("L", (DCT_SIZE * 2, DCT_SIZE * 2))
+        image = ImageOps.exif_transpose(original).convert("L")
+    return ImageHashes(perceptualHash=to_hex(phash(image)), differenceHash=to_hex(dhash(image)))
+
+
+def gcs_image_hashes(image_uri: str) -> ImageHashes:
+    """
+    Hashes of a gs:// object, for images hashed after they were stored.
+    """
+    bucket_name, _, name = image_uri.removeprefix("gs://").partition("/")
+    with telemetry.span("gcs", "download") as call:
+        data = clients.storage_client().bucket(bucket_name).blob(name).download_as_bytes()
+        call.payload(response_bytes=len(data))
+    return image_hashes(data)
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of 64 bit hashes under the Hamming distance. Every node holds the IDs sharing
+    its hash and its children keyed by their distance to it, so a search within `radius` of a query at
+    distance d from a node only descends into the children keyed d - radius to d + radius.
+    """
+
+    def __init__(self):
+        # A node is [hash, ids, children].
+        self._root: Optional[list] = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value: int, item: str):
+        if self._root is None:
+            self._root = [value, [item], {}]
+            self._size += 1
+            return
+
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                self._size += 1
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                self._size += 1
+                return
+            node = child
+
+    def remove(self, value: int, item: str):
+        # Emptied nodes stay in the tree to route searches to their children.
+        node = self._root
+        while node is not None:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                if item in node[1]:
+                    node[1].remove(item)
+                    self._size -= 1
+                return
+            node = node[2].get(distance)
+
+    def search(self, value: int, radius: int) -> list[tuple[str, int]]:
+        """
+        Every (item, distance) within `radius` of `value`, closest first.
+        """
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((item, distance) for item in node[1])
+            for key, child in node[2].items():
+                if distance - radius <= key <= distance + radius:
+                    stack.append(child)
+        return sorted(found, key=lambda match: match[1])
+
+
+class DuplicateIndex:
+    """
+    Near-duplicate lookup over the stored images. Candidates are found on the pHash within `radius`
+    bits in a BK-tree, then confirmed on the dHash within the same radius, which rejects most of the
+    unrelated images whose pHash happens to be close.
+    """
+
+    def __init__(self, radius: int = 6):
+        self.radius = radius
+        self._tree = BKTree()
+        self._hashes: dict[str, tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, image_id: str, hashes: ImageHashes):
+        values = (from_hex(hashes.perceptualHash), from_hex(hashes.differenceHash))
+        with self._lock:
+            previous = self._hashes.get(image_id)
+            if previous == values:
+                return
+            if previous is not None:
+                self._tree.remove(previous[0], image_id)
+            self._hashes[image_id] = values
+            self._tree.add(values[0], image_id)
+
+    def remove(self, image_id: str):
+        with self._lock:
+            previous = self._hashes.pop(image_id, None)
+            if previous is not None:
+                self._tree.remove(previous[0], image_id)
+
+    def load(self, items: Iterable[tuple[str, Optional[str], Optional[str]]]) -> int:
+        """
+        Add (image ID, pHash, dHash) rows, skipping images that have not been hashed yet.
+        """
+        count = 0
+        for image_id, perceptual, difference in items:
+            if perceptual and difference:
+                self.add(image_id, ImageHashes(perceptualHash=perceptual, differenceHash=difference))
+                count += 1
+        return count
+
+    def find(self, hashes: ImageHashes, radius: int = None, exclude: str = None) -> list[tuple[str, int]]:
+        """
+        (image ID, pHash distance) of the images within `radius` of `hashes` on both hashes, closest first.
+        """
+        radius = self.radius if radius is None else radius
+        perceptual, difference = from_hex(hashes.perceptualHash), from_hex(hashes.differenceHash)
+        with self._lock:
+            candidates = self._tree.search(perceptual, radius)
+            return [
+                (image_id, distance) for image_id, distance in candidates
+                if image_id != exclude and hamming(self._hashes[image_id][1], difference) <= radius
+            ]
+
+    def groups(self, radius: int = None) -> list[list[str]]:
+        """
+        Clusters of near-duplicate images, every image in a group is linked to another by a match
+        within `radius`. Largest groups first, images without a duplicate are left out.
+        """
+        radius = self.radius if radius is None else radius
+        parent: dict[str, str] = {}
+
+        def root(image_id: str) -> str:
+            while parent.get(image_id, image_id) != image_id:
+                parent[image_id] = parent.get(parent[image_id], parent[image_id])
+                image_id = parent[image_id]
+            return image_id
+
+        with self._lock:
+            items = list(self._hashes.items())
+        for image_id, (perceptual, difference) in items:
+            hashes = ImageHashes(perceptualHash=to_hex(perceptual), differenceHash=to_hex(difference))
+            for match, _ in self.find(hashes, radius, exclude=image_id):
+                a, b = root(image_id), root(match)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+        clusters: dict[str, list[str]] = {}
+        for image_id in parent:
+            clusters.setdefault(root(image_id), []).append(image_id)
+        for key, members in clusters.items():
+            if key not in members:
+                members.append(key)
+        return sorted((sorted(members) for members in clusters.values()), key=lambda members: (-len(members), members[0]))
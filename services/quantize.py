@@ -0,0 +1,123 @@
+from services.database import ImageDocument, EMBEDDING_FIELDS
+from typing import Optional
+import numpy as np
+
+# Top level map holding the compactly stored embeddings, keyed by vector field.
+COMPACT_FIELD = "compactEmbeddings"
+
+# full stores every embedding as a Firestore vector. int8 stores all but the primary fields as
+# int8 with a scale. matryoshka also truncates the 1408 dimension embeddings to their first dimensions.
+STORAGE_MODES = ("full", "int8", "matryoshka")
+
+
+def quantize_int8(vector) -> tuple[bytes, float]:
+    """
+    Symmetric scalar quantization: every value becomes round(value / scale) with scale = max|value| / 127.
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    peak = float(np.abs(vector).max()) if len(vector) else 0.0
+    scale = peak / 127 if peak else 1.0
+    return np.clip(np.rint(vector / scale), -127, 127).astype(np.int8).tobytes(), scale
+
+
+def dequantize_int8(data: bytes, scale: float) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.int8).astype(np.float32) * np.float32(scale)
+
+
+def truncate(vector, dimension: int) -> np.ndarray:
+    """
+    Matryoshka truncation: keep the first `dimension` values, normalised back to unit length.
+    """
+    prefix = np.asarray(vector, dtype=np.float32)[:dimension]
+    norm = np.linalg.norm(prefix)
+    return prefix / norm if norm else prefix
+
+
+class EmbeddingCodec:
+    """
+    Maps the embeddings of a document onto their stored form and back.
+
+    The primary fields stay Firestore vectors so `find_nearest` can run on them. The other fields
+    are stored under COMPACT_FIELD as int8 bytes with their scale, about an eighth of the size of a
+    vector, and searched by re-ranking the candidates of a primary field locally. Compact entries
+    are decoded whatever the current mode, so the mode can change without rewriting the collection.
+    """
+
+    def __init__(self, mode: str = "full", primary_fields: tuple[str, ...] = ("image_embedding_field",),
+                 truncate_dimension: int = 256):
+        if mode not in STORAGE_MODES:
+            raise ValueError(f"Unknown embedding storage mode {mode}")
+        for field in primary_fields:
+            if field not in EMBEDDING_FIELDS.values():
+                raise ValueError(f"Unknown vector field {field}")
+        self.mode = mode
+        self.primary_fields = tuple(primary_fields)
+        self.truncate_dimension = truncate_dimension
+        self._dimensions = {field: dimension for (_, dimension), field in EMBEDDING_FIELDS.items()}
+
+    def compacts(self, field: str) -> bool:
+        return self.mode != "full" and field not in self.primary_fields
+
+    def _truncates(self, field: str) -> bool:
+        return self.compacts(field) and self.mode == "matryoshka" and self._dimensions[field] == 1408
+
+    def dimension(self, field: str) -> int:
+        """
+        Dimension of the decoded vectors of `field`.
+        """
+        return self.truncate_dimension if self._truncates(field) else self._dimensions[field]
+
+    def prepare(self, field: str, vector) -> np.ndarray:
+        """
+        Bring a full precision vector, a query or a vector stored before the mode changed, to the decoded form of `field`.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        if self._truncates(field) and len(vector) > self.truncate_dimension:
+            return truncate(vector, self.truncate_dimension)
+        return vector
+
+    def encode(self, doc: ImageDocument) -> dict:
+        """
+        Dump a document for a Firestore write, replacing its compacted fields.
+        """
+        from google.cloud.firestore_v1 import DELETE_FIELD
+        data = doc.model_dump()
+        compact = {}
+        for field in EMBEDDING_FIELDS.values():
+            vector = getattr(doc, field)
+            if vector is None or not self.compacts(field):
+                continue
+            payload, scale = quantize_int8(self.prepare(field, vector))
+            compact[field] = {"codec": self.mode, "data": payload, "scale": scale, "dimension": self.dimension(field)}
+            # The documents are merged, so a vector stored before the mode changed has to be deleted.
+            data[field] = DELETE_FIELD
+        if compact:
+            data[COMPACT_FIELD] = compact
+        return data
+
+    @staticmethod
+    def decode(data: dict) -> dict:
+        """
+        Restore the compacted fields of a document read from Firestore.
+        """
+        for field, entry in (data.pop(COMPACT_FIELD, None) or {}).items():
+            if data.get(field) is None and entry:
+                data[field] = dequantize_int8(entry["data"], entry["scale"])
+        return data
+
+    @staticmethod
+    def field_paths(field: str) -> list[str]:
+        """
+        Field mask reading `field` whether it is stored as a vector or compactly.
+        """
+        return [field, f"{COMPACT_FIELD}.{field}"]
+
+    def decode_field(self, data: dict, field: str) -> Optional[np.ndarray]:
+        """
+        The decoded vector of `field` from a document read with a field mask, or None.
+        """
+        vector = data.get(field)
+        if vector is None:
+            entry = (data.get(COMPACT_FIELD) or {}).get(field)
+            vector = dequantize_int8(entry["data"], entry["scale"]) if entry else None
+        return None if vector is None else self.prepare(field, vector)
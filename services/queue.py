@@ -0,0 +1,415 @@
+from services import clients
+from abc import ABC, abstractmethod
+from pydantic import BaseModel
+from collections import OrderedDict
+from typing import Optional
+import datetime
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Seconds between two purges of the finished jobs of the SQLite and Firestore queues.
+PURGE_INTERVAL = 60
+
+
+class Job(BaseModel):
+    id: str
+    payload: dict = {}
+    status: str = QUEUED
+    attempts: int = 0
+    error: Optional[str] = None
+    enqueuedAt: datetime.datetime
+    startedAt: Optional[datetime.datetime] = None
+    finishedAt: Optional[datetime.datetime] = None
+    # A queued job is not handed out before this time, a running job is handed out again after it.
+    # A finished job has its finishedAt here, so its purge uses the same index as the lease.
+    availableAt: datetime.datetime
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC)
+
+
+class WorkQueue(ABC):
+    """
+    At least once work queue. A leased job is handed out again if the worker does not complete
+    or fail it before its lease expires, so handlers must be idempotent. Job IDs are unique,
+    enqueueing an existing ID replaces the job. Finished jobs are purged `retention_seconds`
+    after they finished.
+
+    complete and fail take the `attempt` of the lease (Job.attempts of the leased job). They only
+    apply while that lease is current and return False otherwise, when the lease expired and the job
+    was leased again or finished by another worker.
+    """
+
+    @abstractmethod
+    def enqueue(self, job_id: str, payload: dict) -> Job:
+        ...
+
+    @abstractmethod
+    def lease(self, lease_seconds: float = 300) -> Optional[Job]:
+        ...
+
+    @abstractmethod
+    def complete(self, job_id: str, attempt: int) -> bool:
+        ...
+
+    @abstractmethod
+    def fail(self, job_id: str, attempt: int, error: str, retry_in: Optional[float] = None) -> bool:
+        """
+        Record a failed attempt, the job is queued again after `retry_in` seconds or marked failed when it is None.
+        """
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Job]:
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict[str, int]:
+        ...
+
+
+def _holds(job: Optional[Job], attempt: int) -> bool:
+    return job is not None and job.status == RUNNING and job.attempts == attempt
+
+
+def _finish(job: Job, error: Optional[str], retry_in: Optional[float]) -> Job:
+    job.error = error
+    if error is None or retry_in is None:
+        job.status = DONE if error is None else FAILED
+        job.finishedAt = job.availableAt = _now()
+    else:
+        job.status = QUEUED
+        job.availableAt = _now() + datetime.timedelta(seconds=retry_in)
+    return job
+
+
+class InMemoryQueue(WorkQueue):
+    """
+    Queue held in the process, for tests and single instance deployments running their own workers.
+
+    Queued and leased jobs are kept in a heap on availableAt, so a lease does not scan the finished jobs.
+    An entry is stale once its job is leased, finished or enqueued again, and dropped when it reaches
+    the top. Done and failed jobs are purged `retention_seconds` after they finished, and the oldest
+    first when there are more than `max_finished` of them.
+    """
+
+    def __init__(self, retention_seconds: float = 3600, max_finished: int = 10000):
+        self._lock = threading.Lock()
+        self._jobs: dict[str, Job] = {}
+        self._ready: list[tuple[datetime.datetime, int, str]] = []
+        # Sequence number of the live heap entry of each queued or running job.
+        self._entries: dict[str, int] = {}
+        self._sequence = itertools.count()
+        # Finished job IDs in the order they finished.
+        self._finished: OrderedDict[str, datetime.datetime] = OrderedDict()
+        self._retention = datetime.timedelta(seconds=retention_seconds)
+        self._max_finished = max_finished
+
+    def _push(self, job: Job):
+        sequence = next(self._sequence)
+        self._entries[job.id] = sequence
+        heapq.heappush(self._ready, (job.availableAt, sequence, job.id))
+
+    def _purge(self, now: datetime.datetime):
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if len(self._finished) <= self._max_finished and finished_at > now - self._retention:
+                break
+            del self._finished[job_id]
+            del self._jobs[job_id]
+
+    def enqueue(self, job_id: str, payload: dict) -> Job:
+        now = _now()
+        job = Job(id=job_id, payload=payload, enqueuedAt=now, availableAt=now)
+        with self._lock:
+            self._jobs[job_id] = job
+            self._finished.pop(job_id, None)
+            self._push(job)
+            self._purge(now)
+        return job.model_copy()
+
+    def lease(self, lease_seconds: float = 300) -> Optional[Job]:
+        now = _now()
+        with self._lock:
+            while self._ready:
+                available_at, sequence, job_id = self._ready[0]
+                if self._entries.get(job_id) != sequence:
+                    heapq.heappop(self._ready)
+                    continue
+                if available_at > now:
+                    return None
+                heapq.heappop(self._ready)
+                job = self._jobs[job_id]
+                job.status = RUNNING
+                job.attempts += 1
+                job.startedAt = now
+                job.availableAt = now + datetime.timedelta(seconds=lease_seconds)
+                # Handed out again when the lease expires before the job is completed or failed.
+                self._push(job)
+                return job.model_copy()
+            return None
+
+    def complete(self, job_id: str, attempt: int) -> bool:
+        return self.fail(job_id, attempt, None)
+
+    def fail(self, job_id: str, attempt: int, error: Optional[str], retry_in: Optional[float] = None) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not _holds(job, attempt):
+                return False
+            _finish(job, error, retry_in)
+            if job.status == QUEUED:
+                self._push(job)
+            else:
+                del self._entries[job_id]
+                self._finished[job_id] = job.finishedAt
+                self._purge(job.finishedAt)
+            return True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job else None
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return _count(jobs)
+
+
+def _count(jobs) -> dict[str, int]:
+    counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0, "retries": 0}
+    for job in jobs:
+        counts[job.status] += 1
+        counts["retries"] += max(0, job.attempts - 1)
+    return counts
+
+
+class SQLiteQueue(WorkQueue):
+    """
+    Queue in a local SQLite file, shared by every process on the host.
+    """
+
+    def __init__(self, path: str, retention_seconds: float = 3600):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, available_at TEXT NOT NULL, data TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at)")
+        self._retention = datetime.timedelta(seconds=retention_seconds)
+        self._purged = 0.0
+
+    def _save(self, job: Job):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO jobs (id, status, available_at, data) VALUES (?, ?, ?, ?)",
+            (job.id, job.status, job.availableAt.isoformat(), job.model_dump_json()),
+        )
+
+    def _load(self, job_id: str) -> Optional[Job]:
+        row = self._conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job.model_validate_json(row[0]) if row else None
+
+    def enqueue(self, job_id: str, payload: dict) -> Job:
+        now = _now()
+        job = Job(id=job_id, payload=payload, enqueuedAt=now, availableAt=now)
+        with self._lock:
+            self._save(job)
+        return job
+
+    def lease(self, lease_seconds: float = 300) -> Optional[Job]:
+        now = _now()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT data FROM jobs WHERE status IN (?, ?) AND available_at <= ? ORDER BY available_at LIMIT 1",
+                    (QUEUED, RUNNING, now.isoformat()),
+                ).fetchone()
+                job = None
+                if row:
+                    job = Job.model_validate_json(row[0])
+                    job.status = RUNNING
+                    job.attempts += 1
+                    job.startedAt = now
+                    job.availableAt = now + datetime.timedelta(seconds=lease_seconds)
+                    self._save(job)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job
+
+    def complete(self, job_id: str, attempt: int) -> bool:
+        return self.fail(job_id, attempt, None)
+
+    def fail(self, job_id: str, attempt: int, error: Optional[str], retry_in: Optional[float] = None) -> bool:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                job = self._load(job_id)
+                held = _holds(job, attempt)
+                if held:
+                    self._save(_finish(job, error, retry_in))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if held and job.status != QUEUED:
+                self._purge()
+        return held
+
+    def _purge(self):
+        if time.monotonic() - self._purged < PURGE_INTERVAL:
+            return
+        self._purged = time.monotonic()
+        cutoff = (_now() - self._retention).isoformat()
+        self._conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND available_at < ?", (DONE, FAILED, cutoff))
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._load(job_id)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            retries = self._conn.execute("SELECT COALESCE(SUM(MAX(json_extract(data, '$.attempts') - 1, 0)), 0) FROM jobs").fetchone()[0]
+        return {QUEUED: counts.get(QUEUED, 0), RUNNING: counts.get(RUNNING, 0), DONE: counts.get(DONE, 0),
+                FAILED: counts.get(FAILED, 0), "retries": retries}
+
+
+class FirestoreQueue(WorkQueue):
+    """
+    Queue in a Firestore collection, shared by the app instances and the job container.
+    Leasing and finishing run in transactions so a job is handed to one worker at a time, both
+    the lease and the purge of finished jobs need a composite index on (status, availableAt).
+    """
+
+    def __init__(self, project_id: str, collection: str, retention_seconds: float = 3600):
+        if not collection:
+            raise ValueError("Collection name must be set")
+        self._client = clients.firestore_client(project_id)
+        self._collection = collection
+        self._retention = datetime.timedelta(seconds=retention_seconds)
+        self._purged = 0.0
+
+    def _ref(self, job_id: str):
+        return self._client.collection(self._collection).document(job_id)
+
+    @staticmethod
+    def _data(job: Job) -> dict:
+        # Retries are stored with the job so stats() can sum them in Firestore.
+        return {**job.model_dump(), "retries": max(0, job.attempts - 1)}
+
+    def enqueue(self, job_id: str, payload: dict) -> Job:
+        now = _now()
+        job = Job(id=job_id, payload=payload, enqueuedAt=now, availableAt=now)
+        self._ref(job_id).set(self._data(job))
+        return job
+
+    def lease(self, lease_seconds: float = 300) -> Optional[Job]:
+        from google.cloud import firestore
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        now = _now()
+        query = (
+            self._client.collection(self._collection)
+            .where(filter=FieldFilter("status", "in", [QUEUED, RUNNING]))
+            .where(filter=FieldFilter("availableAt", "<=", now))
+            .order_by("availableAt")
+            .limit(1)
+        )
+
+        @firestore.transactional
+        def claim(transaction) -> Optional[Job]:
+            for snapshot in query.stream(transaction=transaction):
+                job = Job(**snapshot.to_dict())
+                job.status = RUNNING
+                job.attempts += 1
+                job.startedAt = now
+                job.availableAt = now + datetime.timedelta(seconds=lease_seconds)
+                transaction.set(snapshot.reference, self._data(job))
+                return job
+            return None
+
+        return claim(self._client.transaction())
+
+    def complete(self, job_id: str, attempt: int) -> bool:
+        return self.fail(job_id, attempt, None)
+
+    def fail(self, job_id: str, attempt: int, error: Optional[str], retry_in: Optional[float] = None) -> bool:
+        from google.cloud import firestore
+        ref = self._ref(job_id)
+
+        @firestore.transactional
+        def finish(transaction) -> bool:
+            snapshot = ref.get(transaction=transaction)
+            job = Job(**snapshot.to_dict()) if snapshot.exists else None
+            if not _holds(job, attempt):
+                return False
+            transaction.set(ref, self._data(_finish(job, error, retry_in)))
+            return True
+
+        held = finish(self._client.transaction())
+        if held and retry_in is None:
+            self._purge()
+        return held
+
+    def _purge(self, batch_size: int = 500):
+        if time.monotonic() - self._purged < PURGE_INTERVAL:
+            return
+        self._purged = time.monotonic()
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        query = (
+            self._client.collection(self._collection)
+            .where(filter=FieldFilter("status", "in", [DONE, FAILED]))
+            .where(filter=FieldFilter("availableAt", "<", _now() - self._retention))
+            .limit(batch_size)
+        )
+        try:
+            batch = self._client.batch()
+            for snapshot in query.stream():
+                batch.delete(snapshot.reference)
+            batch.commit()
+        except Exception as e:
+            # Purged again at the next interval, a failed purge only keeps the jobs longer.
+            print(f"An error occurred while purging finished jobs: {e}")
+
+    def get(self, job_id: str) -> Optional[Job]:
+        snapshot = self._ref(job_id).get()
+        return Job(**snapshot.to_dict()) if snapshot.exists else None
+
+    def stats(self) -> dict[str, int]:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        collection = self._client.collection(self._collection)
+        counts = {}
+        for status in (QUEUED, RUNNING, DONE, FAILED):
+            result = collection.where(filter=FieldFilter("status", "==", status)).count().get()
+            counts[status] = int(result[0][0].value)
+        # Only the retries of the jobs still in flight are counted.
+        result = collection.where(filter=FieldFilter("status", "in", [QUEUED, RUNNING])).sum("retries").get()
+        counts["retries"] = int(result[0][0].value or 0)
+        return counts
+
+
+def create_queue(backend: str, project_id: str = None, path: str = None, collection: str = None,
+                 retention_seconds: float = 3600, max_finished: int = 10000) -> WorkQueue:
+    """
+    Finished jobs are kept `retention_seconds`, and at most `max_finished` of them by the memory queue.
+    """
+    if not backend or backend == "memory":
+        return InMemoryQueue(retention_seconds, max_finished)
+    if backend == "sqlite":
+        return SQLiteQueue(path or ".cache/ingest-queue.sqlite", retention_seconds)
+    if backend == "firestore":
+        return FirestoreQueue(project_id, collection or "ingest-queue", retention_seconds)
+    raise ValueError(f"Unknown queue backend {backend}")
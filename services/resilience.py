@@ -0,0 +1,257 @@
+from google.api_core import exceptions
+from typing import Awaitable, Callable, Optional
+import asyncio
+import random
+import threading
+import time
+
+# Errors of an unhealthy or overloaded upstream, worth another attempt and counted by the circuit breaker.
+# Anything else, such as an invalid argument, fails straight away and says nothing about the upstream's health.
+RETRYABLE_ERRORS = (
+    exceptions.ServiceUnavailable,
+    exceptions.GatewayTimeout,
+    exceptions.TooManyRequests,
+    exceptions.InternalServerError,
+    exceptions.Aborted,
+    TimeoutError,
+    ConnectionError,
+)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is unavailable, retry in {retry_after:.0f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class UpstreamTimeoutError(TimeoutError):
+    pass
+
+
+def is_retryable(error: BaseException) -> bool:
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def is_unavailable(error: BaseException) -> bool:
+    """
+    Whether a call failed because its upstream is down or overloaded, rather than because of the request.
+    """
+    return isinstance(error, CircuitOpenError) or is_retryable(error)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive retryable failures and rejects calls for `reset_timeout`
+    seconds. Then a single probe call is let through: its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._state = CLOSED
+        self._probing = False
+        # Shared by the event loop and the threads running blocking Firestore calls.
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self._reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self._reset_timeout:
+                    return False
+                self._state = HALF_OPEN
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._state = CLOSED
+
+    def record_failure(self) -> bool:
+        """
+        Returns True when this failure opened the circuit.
+        """
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == HALF_OPEN or self._failures >= self._failure_threshold:
+                opened = self._state != OPEN
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                return opened
+            return False
+
+    def release(self):
+        # A probe cancelled before it had an outcome, let the next call probe instead.
+        with self._lock:
+            self._probing = False
+
+
+class Policy:
+    """
+    How calls to one upstream are made: a `timeout` per attempt, up to `attempts` attempts with full jitter
+    exponential backoff between them, all within an overall `deadline`, and a circuit breaker failing fast
+    while the upstream is unhealthy. With `hedge_after` set, an attempt still running after that many
+    seconds is raced against a second identical one, only use it for idempotent calls.
+    """
+
+    def __init__(self, name: str, timeout: float = None, attempts: int = 3, deadline: float = None,
+                 initial_backoff: float = 0.2, max_backoff: float = 5, hedge_after: float = None,
+                 breaker: CircuitBreaker = None):
+        self.name = name
+        self.timeout = timeout or None
+        self.attempts = max(1, attempts)
+        self.deadline = deadline or (timeout * self.attempts + max_backoff if timeout else None)
+        self.hedge_after = hedge_after or None
+        self.breaker = breaker or CircuitBreaker()
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "timeouts": 0, "rejected": 0, "failed": 0}
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self._max_backoff, self._initial_backoff * 2 ** (attempt - 1)))
+
+    def _admit(self):
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(self.name, self.breaker.retry_after())
+
+    def _failed(self, error: BaseException, attempt: int, start: float) -> Optional[float]:
+        """
+        Record a failed attempt and return the delay before the next one, or None to give up.
+        """
+        if not is_retryable(error):
+            # The upstream answered, the request was wrong.
+            self.breaker.record_success()
+            self.stats["failed"] += 1
+            return None
+
+        if self.breaker.record_failure():
+            print(f"Opened the {self.name} circuit for {self.breaker.retry_after():.0f}s after: {error!r}")
+        delay = self.backoff(attempt)
+        if attempt >= self.attempts or (self.deadline and time.monotonic() - start + delay >= self.deadline):
+            self.stats["failed"] += 1
+            return None
+        self.stats["retries"] += 1
+        print(f"Retrying {self.name} in {delay:.2f}s after attempt {attempt} failed: {error!r}")
+        return delay
+
+    async def _hedged(self, call: Callable[[], Awaitable]):
+        tasks = [asyncio.ensure_future(call())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                self.stats["hedges"] += 1
+                tasks.append(asyncio.ensure_future(call()))
+
+            # The first attempt to succeed wins, a failure only counts once both have failed.
+            error = None
+            for task in asyncio.as_completed(tasks):
+                try:
+                    return await task
+                except Exception as e:
+                    error = error or e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _attempt(self, call: Callable[[], Awaitable]):
+        try:
+            return await asyncio.wait_for(self._hedged(call) if self.hedge_after else call(), self.timeout)
+        except asyncio.TimeoutError as e:
+            # The blocking SDK call keeps its thread until it returns, but the caller is released.
+            self.stats["timeouts"] += 1
+            raise UpstreamTimeoutError(f"{self.name} did not answer within {self.timeout}s") from e
+
+    async def run_async(self, call: Callable[[], Awaitable], before: Callable[[], Awaitable] = None):
+        """
+        Await `call()` under the policy. `before` is awaited ahead of every attempt outside of its
+        timeout, for instance to acquire a rate limiter.
+        """
+        self.stats["calls"] += 1
+        start = time.monotonic()
+        for attempt in range(1, self.attempts + 1):
+            self._admit()
+            try:
+                if before is not None:
+                    await before()
+                result = await self._attempt(call)
+            except Exception as e:
+                delay = self._failed(e, attempt, start)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call a blocking `func` under the policy. Its timeout is not enforced here, pass
+        `self.timeout` on to the SDK call. Hedging only applies to async calls.
+        """
+        self.stats["calls"] += 1
+        start = time.monotonic()
+        for attempt in range(1, self.attempts + 1):
+            self._admit()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._failed(e, attempt, start)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    def check(self):
+        """
+        Fail fast while the circuit is open, for calls such as streams that cannot be retried as a whole.
+        """
+        if self.breaker.state == OPEN:
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(self.name, self.breaker.retry_after())
+
+    def report(self) -> dict:
+        return {**self.stats, "state": self.breaker.state}
+
+
+def create_policies(timeouts: dict[str, float], attempts: int = 3, hedge_after: dict[str, float] = None,
+                    failure_threshold: int = 5, reset_timeout: float = 30) -> dict[str, Policy]:
+    """
+    One policy, with its own circuit breaker, per upstream in `timeouts`. A timeout of 0 leaves the calls
+    to that upstream untimed.
+    """
+    hedge_after = hedge_after or {}
+    return {
+        name: Policy(name, timeout, attempts, hedge_after=hedge_after.get(name),
+                     breaker=CircuitBreaker(failure_threshold, reset_timeout))
+        for name, timeout in timeouts.items()
+    }
@@ -0,0 +1,109 @@
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import os
+import sys
+import time
+
+# Imports taking a large share of a cold start, reported as loaded or not to check they stay lazy.
+HEAVY_MODULES = (
+    "vertexai",
+    "google.cloud.vision",
+    "google.cloud.storage",
+    "google.cloud.firestore_v1",
+    "scipy.spatial",
+    "PIL.Image",
+)
+
+
+def _process_age() -> Optional[float]:
+    """
+    Seconds since the process started, from /proc on Linux, None elsewhere.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the command name, which may contain spaces, start with the third one.
+            fields = f.read().rpartition(")")[2].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"), 0.0)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfile:
+    """
+    Where the time to the first request goes. Times are in seconds since the process started, or since
+    this module was imported when the process start time is not available.
+    """
+
+    def __init__(self):
+        age = _process_age()
+        self._origin = time.perf_counter() - (age or 0.0)
+        self._last = time.perf_counter()
+        self.phases: dict[str, float] = {"process": age} if age is not None else {}
+        self.events: dict[str, float] = {}
+        self.first_request: Optional[str] = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._origin
+
+    def mark(self, name: str):
+        """
+        Record the time since the previous mark as phase `name`, for instance once a module is imported.
+        """
+        now = time.perf_counter()
+        self.phases[name] = now - self._last
+        self._last = now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+            self._last = time.perf_counter()
+
+    def add(self, prefix: str, timings: dict[str, float]):
+        for name, seconds in timings.items():
+            self.phases[f"{prefix}.{name}"] = seconds
+
+    def event(self, name: str):
+        """
+        Record when `name` first happened, "ready" when the app accepts requests for instance.
+        """
+        self.events.setdefault(name, self.elapsed())
+
+    def report(self) -> dict:
+        return {
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "events": {name: round(seconds, 4) for name, seconds in self.events.items()},
+            "first_request": self.first_request,
+            "modules": len(sys.modules),
+            "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+        }
+
+
+profile = StartupProfile()
+
+
+class StartupMiddleware:
+    """
+    ASGI middleware recording when the first HTTP request was answered in the startup profile.
+    """
+
+    def __init__(self, app, startup_profile: StartupProfile = None):
+        self.app = app
+        self.profile = startup_profile or profile
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.profile.first_request is not None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if self.profile.first_request is None:
+                self.profile.first_request = f"{scope['method']} {scope['path']}"
+                self.profile.event("first_request")
@@ -0,0 +1,474 @@
+from contextvars import ContextVar
+from typing import Iterable, Iterator, Optional
+import bisect
+import json
+import math
+import os
+import threading
+import time
+
+# Seconds, from a cached Firestore read to a slow Gemini call.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Bytes, from a small document read to a full size upload.
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Spans kept per trace, the rest of the calls of a long request are only counted.
+MAX_TRACE_SPANS = 256
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.samples().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, in the Prometheus exposition format.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # Per label set: a count per bucket plus one for +Inf, the sum and the count.
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> dict[tuple, tuple[list[int], float, int]]:
+        with self._lock:
+            return {labels: (list(counts), total, count) for labels, (counts, total, count) in self._values.items()}
+
+    def quantile(self, q: float, labels: tuple) -> Optional[float]:
+        """
+        Estimate a quantile by interpolating inside its bucket, as histogram_quantile does.
+        """
+        sample = self.samples().get(labels)
+        if not sample or not sample[2]:
+            return None
+        counts, _, count = sample
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self.samples().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self, prefix: str = ""):
+        self._prefix = prefix
+        self._metrics: list = []
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(self._prefix + name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(self._prefix + name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.reset()
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+registry = Registry("image_service_")
+
+CALL_SECONDS = registry.histogram(
+    "upstream_call_seconds", "Latency of calls to external services.", ("upstream", "operation"))
+CALL_ERRORS = registry.counter(
+    "upstream_call_errors_total", "Failed calls to external services.", ("upstream", "operation", "error"))
+PAYLOAD_BYTES = registry.histogram(
+    "upstream_payload_bytes", "Approximate size of what is sent to and received from external services.",
+    ("upstream", "operation", "direction"), SIZE_BUCKETS)
+REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "Latency of the HTTP requests served.", ("method", "route", "status"))
+
+_enabled = True
+_current: ContextVar[Optional["Span"]] = ContextVar("telemetry_span", default=None)
+
+
+def configure(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def payload_size(value) -> int:
+    """
+    Approximate size in bytes of a call argument or result: protobuf messages report their
+    encoded size, numbers count as 8 bytes as Firestore does, vectors as 8 bytes per value.
+    """
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value) + 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, dict):
+        return sum(len(str(key)) + 1 + payload_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], float):
+            return 8 * len(value)
+        return sum(payload_size(item) for item in value)
+    nbytes = getattr(value, "nbytes", None)
+    if isinstance(nbytes, int):
+        return nbytes
+    vector = getattr(value, "_value", None)
+    if isinstance(vector, tuple):
+        return 8 * len(vector)
+    pb = getattr(type(value), "pb", None)
+    if pb is not None:
+        try:
+            return pb(value).ByteSize()
+        except Exception:
+            return 0
+    byte_size = getattr(value, "ByteSize", None)
+    return byte_size() if callable(byte_size) else 0
+
+
+class Span:
+    """
+    A timed call to an external service, or the HTTP request (root) the calls were made for.
+
+    Closing a span records its latency, payload sizes and failure in the metrics. Spans opened
+    while a root is current are also collected into the trace of that root.
+    """
+
+    __slots__ = ("upstream", "operation", "trace_id", "span_id", "parent_id", "root", "start", "duration",
+                 "error", "attributes", "children", "dropped", "_request", "_response", "_request_bytes",
+                 "_response_bytes", "_token")
+
+    def __init__(self, upstream: str, operation: str, parent: "Span" = None, trace_id: str = None, parent_id: str = None):
+        self.upstream = upstream
+        self.operation = operation
+        self.root = parent.root if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else trace_id
+        self.parent_id = parent.span_id if parent is not None else parent_id
+        self.span_id = os.urandom(8).hex() if self.trace_id else None
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self.attributes: dict = {}
+        self.children: list[Span] = []
+        self.dropped = 0
+        self._request = self._response = None
+        self._request_bytes = self._response_bytes = None
+        self._token = None
+
+    def payload(self, request=None, response=None, request_bytes: int = None, response_bytes: int = None):
+        """
+        Attach the request or response of the call, they are only sized when the span closes.
+        Sizes already known, such as the length of an upload, are given as `request_bytes` and `response_bytes`.
+        """
+        if request is not None:
+            self._request = request
+        if response is not None:
+            self._response = response
+        if request_bytes is not None:
+            self._request_bytes = request_bytes
+        if response_bytes is not None:
+            self._response_bytes = response_bytes
+
+    def fail(self, error: BaseException):
+        self.error = type(error).__name__
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, _):
+        self.duration = time.perf_counter() - self.start
+        _current.reset(self._token)
+        if exc is not None and self.error is None:
+            self.fail(exc)
+        self._record()
+        return False
+
+    def _record(self):
+        labels = (self.upstream, self.operation)
+        CALL_SECONDS.observe(labels, self.duration)
+        if self.error:
+            CALL_ERRORS.inc(labels + (self.error,))
+        if self._request_bytes is None and self._request is not None:
+            self._request_bytes = payload_size(self._request)
+        if self._response_bytes is None and self._response is not None:
+            self._response_bytes = payload_size(self._response)
+        if self._request_bytes is not None:
+            PAYLOAD_BYTES.observe(labels + ("request",), self._request_bytes)
+            self.attributes["requestBytes"] = self._request_bytes
+        if self._response_bytes is not None:
+            PAYLOAD_BYTES.observe(labels + ("response",), self._response_bytes)
+            self.attributes["responseBytes"] = self._response_bytes
+        self._request = self._response = None
+
+        root = self.root
+        if root is not None:
+            if len(root.children) < MAX_TRACE_SPANS:
+                root.children.append(self)
+            else:
+                root.dropped += 1
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": f"{self.upstream}.{self.operation}",
+            "spanId": self.span_id,
+            "parentId": self.parent_id,
+            "startMs": round((self.start - origin) * 1000, 2),
+            "durationMs": round((self.duration or 0) * 1000, 2),
+            **({"error": self.error} if self.error else {}),
+            **self.attributes,
+        }
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def payload(self, request=None, response=None, request_bytes: int = None, response_bytes: int = None):
+        pass
+
+    def fail(self, error: BaseException):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(upstream: str, operation: str) -> Span | _NoopSpan:
+    """
+    Time a call to `upstream`, for instance `with telemetry.span("firestore", "get") as call: ...`.
+    """
+    if not _enabled:
+        return _NOOP
+    return Span(upstream, operation, _current.get())
+
+
+def current_span() -> Span | _NoopSpan:
+    return _current.get() or _NOOP
+
+
+def stream(upstream: str, operation: str, items: Iterable) -> Iterator:
+    """
+    Iterate a streamed result, timing only the waits for the next item rather than the work of the consumer.
+    """
+    if not _enabled:
+        yield from items
+        return
+
+    call = Span(upstream, operation, _current.get())
+    count = 0
+    waited = 0.0
+    iterator = iter(items)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            finally:
+                waited += time.perf_counter() - start
+            count += 1
+            yield item
+    except StopIteration:
+        pass
+    except GeneratorExit:
+        # The consumer stopped early.
+        raise
+    except BaseException as e:
+        call.fail(e)
+        raise
+    finally:
+        call.duration = waited
+        call.attributes["items"] = count
+        call._record()
+
+
+def summary() -> dict[str, dict]:
+    """
+    Calls, errors and estimated p50/p95 latency per upstream operation, for the logs of the scripts.
+    """
+    errors: dict[tuple, float] = {}
+    for (upstream, operation, _), value in CALL_ERRORS.samples().items():
+        errors[(upstream, operation)] = errors.get((upstream, operation), 0) + value
+
+    result = {}
+    for labels, (_, total, count) in sorted(CALL_SECONDS.samples().items()):
+        result[".".join(labels)] = {
+            "calls": count,
+            "errors": int(errors.get(labels, 0)),
+            "mean": round(total / count, 4),
+            "p50": round(CALL_SECONDS.quantile(0.5, labels), 4),
+            "p95": round(CALL_SECONDS.quantile(0.95, labels), 4),
+        }
+    return result
+
+
+def _parse_traceparent(value: str) -> tuple[Optional[str], Optional[str]]:
+    # W3C trace context: version-trace id-parent id-flags.
+    parts = value.split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16 and parts[1] != "0" * 32:
+        try:
+            int(parts[1], 16), int(parts[2], 16)
+            return parts[1], parts[2]
+        except ValueError:
+            pass
+    return None, None
+
+
+def _route_template(scope) -> str:
+    # The path with its parameters put back as {name}, so the label does not grow with the image ids.
+    if "route" not in scope:
+        return "unmatched"
+    names = {str(value): name for name, value in scope.get("path_params", {}).items()}
+    return "/".join(f"{{{names[segment]}}}" if segment in names else segment for segment in scope["path"].split("/"))
+
+
+class TelemetryMiddleware:
+    """
+    ASGI middleware opening a root span per HTTP request.
+
+    The trace id is taken from an incoming `traceparent` header or generated, and returned in the
+    `traceparent` header of the response. Requests slower than `slow_request_seconds` are logged as
+    one JSON line with the spans of their upstream calls, 0 turns the log off.
+    """
+
+    def __init__(self, app, slow_request_seconds: float = 1.0):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _enabled:
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = parent_id = None
+        for name, value in scope.get("headers", ()):
+            if name == b"traceparent":
+                trace_id, parent_id = _parse_traceparent(value.decode("latin-1"))
+                break
+        root = Span("http", scope["method"], trace_id=trace_id or os.urandom(16).hex(), parent_id=parent_id)
+        root.root = root
+        status = 500
+
+        async def send_with_trace(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"traceparent", f"00-{root.trace_id}-{root.span_id}-01".encode()),
+                ]
+            await send(message)
+
+        token = _current.set(root)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as e:
+            root.fail(e)
+            raise
+        finally:
+            _current.reset(token)
+            root.duration = time.perf_counter() - root.start
+            path = _route_template(scope)
+            REQUEST_SECONDS.observe((scope["method"], path, str(status)), root.duration)
+            if self.slow_request_seconds and root.duration >= self.slow_request_seconds:
+                self._log(root, path, status)
+
+    @staticmethod
+    def _log(root: Span, path: str, status: int):
+        print(json.dumps({
+            "severity": "WARNING" if status < 500 else "ERROR",
+            "message": f"Slow request {root.operation} {path}: {root.duration * 1000:.0f}ms",
+            "traceId": root.trace_id,
+            "status": status,
+            "durationMs": round(root.duration * 1000, 2),
+            "spans": [child.to_dict(root.start) for child in sorted(root.children, key=lambda child: child.start)],
+            **({"droppedSpans": root.dropped} if root.dropped else {}),
+        }))
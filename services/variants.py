@@ -0,0 +1,177 @@
+from services import clients, telemetry
+from services.database import ImageVariant
+from PIL import Image, ImageOps
+from concurrent.futures import ProcessPoolExecutor
+from pydantic import BaseModel
+from typing import BinaryIO, Optional
+import asyncio
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# name:longest edge:format:quality, comma separated.
+DEFAULT_VARIANTS = "thumb:256:webp:75,small:640:webp:80,medium:1280:webp:80,large:2048:jpeg:85"
+
+# Pillow format, content type and file extension per variant format.
+FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+
+class VariantSpec(BaseModel):
+    name: str
+    size: int
+    format: str = "webp"
+    quality: int = 80
+
+    @property
+    def content_type(self) -> str:
+        return FORMATS[self.format][1]
+
+
+def parse_variants(value: str) -> list[VariantSpec]:
+    if value == "none":
+        return []
+    specs = []
+    for item in (value or DEFAULT_VARIANTS).split(","):
+        name, size, fmt, quality = item.strip().split(":")
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown variant format {fmt}")
+        specs.append(VariantSpec(name=name, size=int(size), format=fmt, quality=int(quality)))
+    return specs
+
+
+def render_variants(path: str, specs: list[tuple[str, int, str, int]]) -> list[tuple[str, bytes, int, int]]:
+    """
+    Render (name, size, format, quality) specs of the image file at `path`, returning (name, bytes, width, height)
+    for each. Runs in a worker process, so it takes a path rather than the image and returns plain tuples.
+    """
+    specs = sorted(specs, key=lambda spec: spec[1], reverse=True)
+    with Image.open(path) as original:
+        # JPEGs are decoded at the smallest scale still larger than the biggest variant.
+        original.draft("RGB", (specs[0][1], specs[0][1]))
+        image = ImageOps.exif_transpose(original)
+
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+    results = []
+    # Each variant is resized from the previous, larger one rather than from the original.
+    for name, size, fmt, quality in specs:
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        mode = "RGBA" if has_alpha and fmt == "webp" else "RGB"
+        out = io.BytesIO()
+        (image if image.mode == mode else image.convert(mode)).save(out, FORMATS[fmt][0], quality=quality)
+        results.append((name, out.getvalue(), image.width, image.height))
+    return results
+
+
+class VariantService:
+    """
+    Generates resized variants of the stored images with Pillow in a process pool and stores
+    them in GCS next to the original, as `<object>.<variant>.<extension>`.
+    """
+
+    def __init__(self, specs: list[VariantSpec], max_workers: int = None):
+        self.specs = {spec.name: spec for spec in specs}
+        self._max_workers = max_workers
+        self._pool: ProcessPoolExecutor = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Spawned rather than forked, the gRPC clients of this process do not survive a fork.
+            self._pool = ProcessPoolExecutor(self._max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    @staticmethod
+    def _blob(path: str):
+        bucket_name, _, name = path.partition("/")
+        return clients.storage_client().bucket(bucket_name).blob(name)
+
+    def _upload(self, path: str, data: bytes, content_type: str):
+        with telemetry.span("gcs", "upload_variant") as call:
+            call.payload(request_bytes=len(data))
+            self._blob(path).upload_from_string(data, content_type=content_type)
+
+    def download(self, path: str) -> bytes:
+        with telemetry.span("gcs", "download") as call:
+            data = self._blob(path).download_as_bytes()
+            call.payload(response_bytes=len(data))
+            return data
+
+    def _spool(self, image_path: str, file: Optional[BinaryIO]) -> str:
+        """
+        Path of a temporary copy of the original for the worker processes, copied in chunks from `file`
+        or downloaded from GCS, so the original is never held in memory whole.
+        """
+        with tempfile.NamedTemporaryFile(prefix="variant-", delete=False) as out:
+            try:
+                if file is not None:
+                    file.seek(0)
+                    shutil.copyfileobj(file, out)
+                else:
+                    with telemetry.span("gcs", "download"):
+                        self._blob(image_path).download_to_file(out)
+            except BaseException:
+                out.close()
+                os.remove(out.name)
+                raise
+        return out.name
+
+    async def generate(self, image_path: str, file: BinaryIO = None, names: list[str] = None) -> list[ImageVariant]:
+        """
+        Render and store the variants of the image at `image_path` (bucket/object), from `file` when
+        the original is at hand, a spooled upload for instance. `names` limits the variants to generate.
+        """
+        specs = [spec for spec in self.specs.values() if names is None or spec.name in names]
+        if not specs:
+            return []
+
+        path = await asyncio.to_thread(self._spool, image_path, file)
+        try:
+            loop = asyncio.get_running_loop()
+            rendered = await loop.run_in_executor(
+                self._executor(), render_variants, path, [(spec.name, spec.size, spec.format, spec.quality) for spec in specs],
+            )
+        finally:
+            os.remove(path)
+
+        variants = []
+        for name, content, width, height in rendered:
+            spec = self.specs[name]
+            variants.append(ImageVariant(
+                name=name,
+                path=f"{image_path}.{name}.{FORMATS[spec.format][2]}",
+                format=spec.format,
+                width=width,
+                height=height,
+                size=len(content),
+            ))
+        await asyncio.gather(*(
+            asyncio.to_thread(self._upload, variant.path, content, self.specs[variant.name].content_type)
+            for variant, (_, content, _, _) in zip(variants, rendered)
+        ))
+        return variants
+
+    async def generate_or_none(self, image_path: str, file: BinaryIO = None) -> Optional[list[ImageVariant]]:
+        """
+        Generate every variant, a failure is logged and leaves the image served from its original only.
+        """
+        try:
+            return await self.generate(image_path, file) or None
+        except Exception as e:
+            print(f"An error occurred while generating the variants of {image_path}: {e}")
+            return None
+
+    def delete(self, variants: list[ImageVariant]):
+        for variant in variants or []:
+            try:
+                self._blob(variant.path).delete()
+            except Exception as e:
+                print(f"An error occurred while deleting variant {variant.path}: {e}")
@@ -1,24 +1,217 @@
-from services.database import DBService, ImageDocument
-from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
-from google.cloud.firestore_v1.vector import Vector
+from services.ann import IVFIndex, distances_to, load_indexes, recall_at_k
+from services.database import DBService, ImageDocument, DOCUMENT_FIELDS, EMBEDDING_FIELDS, FILTER_FIELDS
+from services import telemetry
+from pydantic import BaseModel
+from typing import TYPE_CHECKING, Optional
+import numpy as np
+import os
+import time
+
+# Firestore is imported on first use like the other SDKs, see clients.py.
+if TYPE_CHECKING:
+    from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
+
+DISTANCE_RESULT_FIELD = "vector_distance"
+
+
+class SearchResult(BaseModel):
+    imageId: str
+    distance: float
+    document: ImageDocument
 
 
 class VectorSearchService(DBService):
-    def __init__(self, project_id, collection):
-        super().__init__(project_id, collection)
+    def __init__(self, project_id, collection, index_dir: str = None, codec=None, policy=None, max_index_age: float = 0):
+        super().__init__(project_id, collection, codec=codec, policy=policy)
+        self._index_dir = index_dir
+        # Optional local ANN indexes keyed by vector field, Firestore stays the fallback.
+        self._indexes: dict[str, IVFIndex] = load_indexes(index_dir) if index_dir else {}
+        # Seconds after its build an index misses too many writes of other instances to be searched, 0 never expires.
+        self._max_index_age = max_index_age
+        self._stale: set[str] = set()
+
+    def _fresh(self, vector_field: str, index: IVFIndex) -> bool:
+        if not self._max_index_age or time.time() - index.built_at <= self._max_index_age:
+            return True
+        if vector_field not in self._stale:
+            self._stale.add(vector_field)
+            print(f"The {vector_field} index is older than {self._max_index_age:.0f}s, searching Firestore until build_index.py is run again")
+        return False
+
+    def build_index(self, vector_field: str, metric: str = "DOT_PRODUCT", nlist: int = None, nprobe: int = 8) -> IVFIndex:
+        """
+        Build a local index from a snapshot of `vector_field` across the collection and use it for searches.
+        """
+        if vector_field not in EMBEDDING_FIELDS.values():
+            raise ValueError(f"Unknown vector field {vector_field}")
+
+        batch = self.load_columns([vector_field])
+        present = batch.present[vector_field]
+        vectors = batch.vectors[vector_field][present]
+        ids = [document_id for document_id, has_vector in zip(batch.ids, present) if has_vector]
+
+        index = IVFIndex(vectors.shape[1], metric, nprobe)
+        index.build(ids, vectors, nlist=nlist)
+        self._indexes[vector_field] = index
+        self._stale.discard(vector_field)
+        return index
+
+    def save_indexes(self, index_dir: str = None):
+        index_dir = index_dir or self._index_dir
+        for vector_field, index in self._indexes.items():
+            index.save(os.path.join(index_dir, vector_field))
+
+    def index_document(self, document_id: str, data: ImageDocument):
+        for vector_field, index in self._indexes.items():
+            vector = getattr(data, vector_field)
+            if vector is not None and len(vector):
+                index.add(document_id, self._codec.prepare(vector_field, vector) if self._codec else vector)
+
+    def unindex_document(self, document_id: str):
+        for index in self._indexes.values():
+            index.remove(document_id)
+
+    def _local_search(self, index: IVFIndex, vector: list[float], limit: int, nprobe: int = None) -> list[SearchResult]:
+        matches = index.search(vector, limit, nprobe)
+        if not matches:
+            return []
+
+        collection = self._client.collection(self._collection)
+        refs = [collection.document(document_id) for document_id, _ in matches]
+        docs = self._run(lambda: {
+            doc.id: doc for doc in telemetry.stream("firestore", "get_all", self._client.get_all(refs, field_paths=DOCUMENT_FIELDS, **self._options()))
+            if doc.exists
+        })
+
+        return [
+            SearchResult(imageId=document_id, distance=distance, document=self._document(docs[document_id].to_dict()))
+            for document_id, distance in matches if document_id in docs
+        ]
+
+    def compacts(self, vector_field: str) -> bool:
+        return bool(self._codec and self._codec.compacts(vector_field))
 
-    def find_nearest(self, vector: list[float], limit: int = 5) -> list[ImageDocument]:
-        collection_ref = self._client.collection(self._collection)
+    def _rerank(self, vector: list[float], primary_vector: list[float], limit: int, vector_field: str,
+                distance_measure: "DistanceMeasure", filters: Optional[dict], oversample: int, nprobe: int = None) -> list[SearchResult]:
+        # Candidates come from the primary field in Firestore, then the compact vectors of `vector_field` order them.
+        if primary_vector is None:
+            raise ValueError(f"{vector_field} is stored compactly, searching it needs a query vector for {self._codec.primary_fields[0]}")
+        candidates = self.find_nearest(primary_vector, limit * oversample, self._codec.primary_fields[0], distance_measure,
+                                       filters, nprobe=nprobe)
+        if not candidates:
+            return []
 
-        vector_query = collection_ref.find_nearest(
-            vector_field="image_embedding_field",
+        collection = self._client.collection(self._collection)
+        refs = [collection.document(result.imageId) for result in candidates]
+        stored = self._run(lambda: {
+            doc.id: self._codec.decode_field(doc.to_dict(), vector_field)
+            for doc in telemetry.stream("firestore", "get_all", self._client.get_all(
+                refs, field_paths=self._codec.field_paths(vector_field), **self._options()))
+            if doc.exists
+        })
+        candidates = [result for result in candidates if stored.get(result.imageId) is not None]
+        if not candidates:
+            return []
+
+        query = np.asarray(vector, dtype=np.float32)
+        vectors = np.stack([stored[result.imageId] for result in candidates])
+        if distance_measure.name == "COSINE":
+            query = query / (np.linalg.norm(query) or 1)
+            vectors = vectors / np.where((norms := np.linalg.norm(vectors, axis=1, keepdims=True)) == 0, 1, norms)
+        distances = distances_to(distance_measure.name, query, vectors)
+        order = np.argsort(-distances if distance_measure.name == "DOT_PRODUCT" else distances)[:limit]
+        return [
+            SearchResult(imageId=candidates[i].imageId, distance=float(distances[i]), document=candidates[i].document)
+            for i in order
+        ]
+
+    def find_nearest(self, vector: list[float], limit: int = 5, vector_field: str = "image_embedding_field",
+                     distance_measure: "DistanceMeasure" = None,
+                     filters: Optional[dict] = None, use_index: bool = True, nprobe: int = None,
+                     primary_vector: list[float] = None, oversample: int = 8) -> list[SearchResult]:
+        """
+        Nearest neighbour search on one of the embedding fields.
+
+        When a local index exists for `vector_field` with the same distance measure and no filters
+        are given, it serves the search and only the matched documents are read from Firestore.
+        Otherwise the search runs in Firestore. Fields the codec stores compactly cannot be searched
+        in Firestore: `limit * oversample` candidates are found with `primary_vector` on the primary
+        field and re-ranked locally on the decoded vectors of `vector_field`.
+
+        `filters` maps keys of FILTER_FIELDS to the value they must equal, they are applied
+        before the vector search and need a composite vector index covering the filtered
+        fields and `vector_field`. Results leave the embedding vectors out. The distance measure
+        defaults to DOT_PRODUCT.
+        """
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
+        from google.cloud.firestore_v1.vector import Vector
+
+        distance_measure = distance_measure or DistanceMeasure.DOT_PRODUCT
+        if vector_field not in EMBEDDING_FIELDS.values():
+            raise ValueError(f"Unknown vector field {vector_field}")
+
+        if self.compacts(vector_field):
+            vector = self._codec.prepare(vector_field, vector)
+
+        index = self._indexes.get(vector_field)
+        has_filters = any(value is not None for value in (filters or {}).values())
+        if (use_index and index is not None and index.metric == distance_measure.name and not has_filters
+                and self._fresh(vector_field, index)):
+            return self._local_search(index, vector, limit, nprobe)
+
+        if self.compacts(vector_field):
+            return self._rerank(vector, primary_vector, limit, vector_field, distance_measure, filters, oversample, nprobe)
+
+        query = self._client.collection(self._collection)
+        for name, value in (filters or {}).items():
+            if name not in FILTER_FIELDS:
+                raise ValueError(f"Unknown filter {name}")
+            if value is not None:
+                query = query.where(filter=FieldFilter(FILTER_FIELDS[name], "==", value))
+
+        vector_query = query.select(DOCUMENT_FIELDS + [DISTANCE_RESULT_FIELD]).find_nearest(
+            vector_field=vector_field,
             query_vector=Vector(vector),
-            distance_measure=DistanceMeasure.DOT_PRODUCT,
-            limit=limit
+            distance_measure=distance_measure,
+            limit=limit,
+            distance_result_field=DISTANCE_RESULT_FIELD,
         )
 
-        docs = []
-        for doc in vector_query.stream():
-            docs.append(doc.to_dict())
+        def search() -> list[SearchResult]:
+            results = []
+            for doc in telemetry.stream("firestore", "find_nearest", vector_query.stream(**self._options())):
+                data = doc.to_dict()
+                distance = data.pop(DISTANCE_RESULT_FIELD, None)
+                results.append(SearchResult(imageId=doc.id, distance=distance, document=self._document(data)))
+            return results
+
+        # A search returns at most `limit` documents, so unlike a listing it is retried as a whole.
+        return self._run(search)
+
+    def recall_check(self, vectors: list[list[float]], vector_field: str, limit: int = 10, nprobe: int = None) -> dict[str, float]:
+        """
+        Compare the local index against Firestore, the ground truth, for a set of query vectors.
+        Returns the mean recall@limit and the mean latency of both searches in milliseconds.
+        """
+        from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
+        index = self._indexes[vector_field]
+        distance_measure = DistanceMeasure[index.metric]
+        recalls, local_ms, firestore_ms = [], [], []
+
+        for vector in vectors:
+            start = time.perf_counter()
+            found = [document_id for document_id, _ in index.search(vector, limit, nprobe)]
+            local_ms.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            expected = self.find_nearest(vector, limit, vector_field, distance_measure, use_index=False)
+            firestore_ms.append((time.perf_counter() - start) * 1000)
+
+            recalls.append(recall_at_k([result.imageId for result in expected], found, limit))
 
-        return docs
+        return {
+            "recall": float(np.mean(recalls)) if recalls else 1.0,
+            "local_ms": float(np.mean(local_ms)) if local_ms else 0.0,
+            "firestore_ms": float(np.mean(firestore_ms)) if firestore_ms else 0.0,
+        }
@@ -1,2 +1,2 @@
-from .image_size import get_image_dimensions
-from .save_to_gcs import save_to_gcs
+from .image_size import get_image_dimensions, DimensionSniffer
+from .save_to_gcs import save_to_gcs, describe_gcs_object, UploadResult
@@ -2,8 +2,40 @@ from PIL import Image
 from fastapi import UploadFile
 import io
 
+# Give up sniffing the dimensions from the stream after this many bytes, large EXIF or ICC blocks can come first.
+SNIFF_LIMIT = 4 * 1024 * 1024
+
 
 def get_image_dimensions(file: UploadFile):
     file.file.seek(0)  # Reset file pointer to the beginning
-    img = Image.open(io.BytesIO(file.file.read()))
-    return img.size
+    # Image.open only parses the header, the pixels are never decoded.
+    with Image.open(file.file) as img:
+        return img.size
+
+
+class DimensionSniffer:
+    """
+    Finds the (width, height) of an image from the first chunks of its bytes while they stream past.
+    Only the header is parsed and the buffered bytes are released once the size is known.
+    """
+
+    def __init__(self, limit: int = SNIFF_LIMIT):
+        self._limit = limit
+        self._buffer = bytearray()
+        self.size: tuple[int, int] = None
+        self.done = False
+
+    def feed(self, chunk: bytes):
+        if self.done:
+            return
+
+        self._buffer += chunk
+        try:
+            with Image.open(io.BytesIO(self._buffer)) as img:
+                self.size = img.size
+        except Exception:
+            pass  # not enough data yet
+
+        if self.size or len(self._buffer) >= self._limit:
+            self.done = True
+            self._buffer = bytearray()
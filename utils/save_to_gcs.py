@@ -1,14 +1,109 @@
 from fastapi import UploadFile
-from google.cloud import storage
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from typing import Optional
+import base64
+import hashlib
 
 from config import settings
+from services import clients, telemetry
+from .image_size import DimensionSniffer, get_image_dimensions, SNIFF_LIMIT
 
+# Resumable uploads need chunks in multiples of 256 KiB.
+CHUNK_SIZE = 4 * 1024 * 1024
+# Bytes fetched per ranged read when sniffing the dimensions of an object already in GCS.
+SNIFF_CHUNK_SIZE = 256 * 1024
 
-async def save_to_gcs(file: UploadFile, name: str) -> str:
-    gcs_client = storage.Client()
-    bucket = gcs_client.bucket(settings.bucket)
-    blob = bucket.blob(name)
-    content = await file.read()
-    blob.upload_from_string(content, content_type=file.content_type)
 
-    return f"{settings.bucket}/{name}"
+class UploadResult(BaseModel):
+    path: str
+    digest: Optional[str] = None
+    size: int
+    width: int
+    height: int
+    content_type: Optional[str] = None
+
+
+def _stream_to_gcs(file: UploadFile, name: str) -> UploadResult:
+    """
+    Upload in one pass over the file: every chunk is hashed, the first ones are sniffed for the
+    image dimensions and all of them are streamed to GCS, so only one chunk is held in memory.
+    Files smaller than a chunk go up in a single request, larger ones use a resumable upload.
+    """
+    bucket = clients.storage_client().bucket(settings.bucket)
+    blob = bucket.blob(name, chunk_size=CHUNK_SIZE)
+    md5 = hashlib.md5()
+    sniffer = DimensionSniffer()
+    size = 0
+
+    file.file.seek(0)
+    chunk = file.file.read(CHUNK_SIZE)
+    if len(chunk) < CHUNK_SIZE:
+        md5.update(chunk)
+        sniffer.feed(chunk)
+        size = len(chunk)
+        blob.upload_from_string(chunk, content_type=file.content_type)
+    else:
+        with blob.open("wb", content_type=file.content_type) as writer:
+            while chunk:
+                md5.update(chunk)
+                sniffer.feed(chunk)
+                writer.write(chunk)
+                size += len(chunk)
+                chunk = file.file.read(CHUNK_SIZE)
+
+    # Formats with the size past the sniff limit fall back to parsing the header from the spooled upload.
+    width, height = sniffer.size or get_image_dimensions(file)
+
+    return UploadResult(
+        path=f"{settings.bucket}/{name}",
+        digest=md5.hexdigest(),
+        size=size,
+        width=width,
+        height=height,
+        content_type=file.content_type,
+    )
+
+
+async def save_to_gcs(file: UploadFile, name: str) -> UploadResult:
+    with telemetry.span("gcs", "upload") as call:
+        result = await run_in_threadpool(_stream_to_gcs, file, name)
+        call.payload(request_bytes=result.size)
+        return result
+
+
+def _describe_gcs_object(uri: str) -> UploadResult:
+    """
+    Describe an image already stored in the bucket, reading the digest from the object metadata
+    and the dimensions from ranged reads of its header rather than downloading the whole object.
+    """
+    bucket_name, _, name = uri.removeprefix("gs://").partition("/")
+    if not uri.startswith("gs://") or bucket_name != settings.bucket or not name:
+        raise ValueError(f"{uri} is not an object in gs://{settings.bucket}")
+
+    blob = clients.storage_client().bucket(bucket_name).get_blob(name)
+    if blob is None:
+        raise FileNotFoundError(f"Object {uri} does not exist")
+
+    sniffer = DimensionSniffer()
+    offset = 0
+    while not sniffer.done and offset < min(blob.size, SNIFF_LIMIT):
+        sniffer.feed(blob.download_as_bytes(start=offset, end=offset + SNIFF_CHUNK_SIZE - 1))
+        offset += SNIFF_CHUNK_SIZE
+    if not sniffer.size:
+        raise ValueError(f"Could not read the dimensions of {uri}")
+
+    width, height = sniffer.size
+    return UploadResult(
+        path=f"{bucket_name}/{name}",
+        digest=base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None,
+        size=blob.size,
+        width=width,
+        height=height,
+        content_type=blob.content_type,
+    )
+
+
+async def describe_gcs_object(uri: str) -> UploadResult:
+    with telemetry.span("gcs", "describe"):
+        return await run_in_threadpool(_describe_gcs_object, uri)
@@ -0,0 +1,101 @@
+from services.ai import AIService
+from services.cache import create_enrichment_cache
+from services.database import DBService
+from services.ingest import IngestWorker, document_hashes, load_duplicates
+from services.phash import DuplicateIndex
+from services.quantize import EmbeddingCodec
+from services.queue import create_queue
+from services.rate_limit import TokenBucket
+from services.resilience import create_policies
+from services.variants import VariantService, parse_variants
+from services import telemetry
+import os
+from dotenv import load_dotenv
+import asyncio
+import json
+
+os.environ["GRPC_VERBOSITY"] = "ERROR"
+os.environ["GRPC_TRACE"] = ""
+
+load_dotenv()
+
+project_id = os.getenv("GCP_PROJECT_ID")
+region = os.getenv("GCP_REGION")
+firestore_collection = os.getenv("FIRESTORE_COLLECTION", "image-data")
+concurrency = int(os.getenv("CONCURRENCY", 8))
+max_attempts = int(os.getenv("INGEST_MAX_ATTEMPTS", 3))
+stats_interval = float(os.getenv("STATS_INTERVAL", 60))
+dedupe_reuse = os.getenv("DEDUPE_REUSE", "false").lower() == "true"
+
+telemetry.configure(os.getenv("TELEMETRY_ENABLED", "true").lower() == "true")
+
+policies = create_policies(
+    {
+        "vision": float(os.getenv("VISION_TIMEOUT", 30)),
+        "gemini": float(os.getenv("GEMINI_TIMEOUT", 60)),
+        "embedding": float(os.getenv("EMBEDDING_TIMEOUT", 20)),
+        "firestore": float(os.getenv("FIRESTORE_TIMEOUT", 10)),
+    },
+    int(os.getenv("UPSTREAM_ATTEMPTS", 3)),
+    hedge_after={"embedding": float(os.getenv("EMBEDDING_HEDGE_AFTER", 0))},
+    failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5)),
+    reset_timeout=float(os.getenv("CIRCUIT_RESET_SECONDS", 30)),
+)
+
+ai = AIService(project_id, region, create_enrichment_cache(
+    os.getenv("ENRICHMENT_CACHE", ""),
+    project_id=project_id,
+    path=os.getenv("ENRICHMENT_CACHE_PATH"),
+    max_mb=int(os.getenv("ENRICHMENT_CACHE_MAX_MB", 512)),
+    collection=os.getenv("ENRICHMENT_CACHE_COLLECTION"),
+), os.getenv("COLOR_NAMING", "local"), rate_limits={
+    "vision": TokenBucket(float(os.getenv("VISION_QPS", 0))),
+    "gemini": TokenBucket(float(os.getenv("GEMINI_QPS", 0))),
+    "embedding": TokenBucket(float(os.getenv("EMBEDDING_QPS", 0))),
+}, policies=policies, partial=os.getenv("PARTIAL_ENRICHMENT", "true").lower() == "true",
+   upstream_workers=int(os.getenv("UPSTREAM_WORKERS", 32)))
+codec = EmbeddingCodec(os.getenv("EMBEDDING_STORAGE", "full"), (os.getenv("EMBEDDING_PRIMARY_FIELD", "image_embedding_field"),),
+                      int(os.getenv("EMBEDDING_TRUNCATE_DIMENSION", 256)))
+db = DBService(project_id, firestore_collection, codec=codec, policy=policies["firestore"])
+variants = VariantService(parse_variants(os.getenv("IMAGE_VARIANTS", "")), int(os.getenv("VARIANT_WORKERS", 0)) or None)
+# The queue has to be shared with the app, so it defaults to Firestore rather than memory.
+queue = create_queue(
+    os.getenv("INGEST_QUEUE", "firestore"),
+    project_id=project_id,
+    path=os.getenv("INGEST_QUEUE_PATH"),
+    collection=os.getenv("INGEST_QUEUE_COLLECTION"),
+    retention_seconds=float(os.getenv("INGEST_QUEUE_RETENTION", 3600)),
+)
+
+
+async def report(worker: IngestWorker):
+    while True:
+        await asyncio.sleep(stats_interval)
+        print(f"Queue: {await asyncio.to_thread(queue.stats)}, workers: {worker.stats()}")
+        if telemetry.enabled():
+            print(f"Upstream calls: {json.dumps(telemetry.summary())}")
+        print(f"Upstreams: {json.dumps({name: policy.report() for name, policy in policies.items()})}")
+
+
+async def main():
+    duplicates = None
+    if dedupe_reuse:
+        duplicates = DuplicateIndex(int(os.getenv("DEDUPE_RADIUS", 6)))
+        print(f"Indexed the hashes of {await asyncio.to_thread(load_duplicates, db, duplicates)} images")
+
+    def on_complete(image_id: str, doc):
+        if duplicates is not None and (hashes := document_hashes(doc)):
+            duplicates.add(image_id, hashes)
+
+    worker = IngestWorker(queue, ai, db, concurrency, max_attempts, on_complete=on_complete, variants=variants,
+                          duplicates=duplicates)
+    reporter = asyncio.create_task(report(worker))
+    try:
+        await worker.run()
+    finally:
+        reporter.cancel()
+        variants.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())